@@ -1,23 +1,35 @@
+from dotenv import load_dotenv
+
+# 底下的模組在 import 時就會讀取設定（例如 MODEL_SERVER_HOST / PORT），要先載入 .env
+load_dotenv()
+
 from flask import Flask
 from flask_cors import CORS
 from extensions import db, jwt
 from service.auth_controller import auth_bp
 from service.utils_controller import utils_bp
-from service.train_model_controller import process_requests, train_model_bp
+from service.train_model_controller import train_model_bp
 from service.userinfo_controller import userinfo_bp
 from service.eventjournal_controller import event_bp
-from dotenv import load_dotenv
 from flask_swagger_ui import get_swaggerui_blueprint
 from flasgger import Swagger
+from train_model.model_client import (
+    ensure_model_server_authkey,
+    supervise_model_server,
+)
+from train_model.training_scheduler import start_training_scheduler
 
 from waitress import serve
+import os
 import threading
 
-load_dotenv()
-
 app = Flask(__name__)
-# 註冊inference的queue
-threading.Thread(target=process_requests, daemon=True, args=(app,)).start()
+# 在子程序啟動 model server（inference 的 queue），崩潰時自動重啟；
+# 多個 web process 共用同一個 model server 時，其餘的 process 設 START_MODEL_SERVER=false
+if os.getenv("START_MODEL_SERVER", "true").lower() == "true":
+    # 先產生金鑰再接受 request，這個 process 的 client 與 model server 子程序使用同一把
+    ensure_model_server_authkey()
+    threading.Thread(target=supervise_model_server, daemon=True).start()
 app.config.from_prefixed_env()
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SWAGGER"] = {
@@ -68,6 +80,17 @@ def create_tables():
     db.create_all()
 
 
+# 依序執行資料庫裡排隊的微調工作；多個 web process 時其餘的 process 設 START_TRAINING_SCHEDULER=false
+if os.getenv("START_TRAINING_SCHEDULER", "true").lower() == "true":
+    start_training_scheduler(app)
+
+
 if __name__ == "__main__":
     # app.run(host='0.0.0.0', port=8080, debug=True)
-    serve(app, host="0.0.0.0", port=8080)
+    # /chat-result 的 long-poll 會佔住執行緒，預設的 4 條不夠用
+    serve(
+        app,
+        host="0.0.0.0",
+        port=8080,
+        threads=int(os.getenv("WAITRESS_THREADS", 32)),
+    )
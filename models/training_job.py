@@ -0,0 +1,87 @@
+from typing import Optional
+from sqlalchemy import DateTime, func
+from extensions import db
+
+
+class TrainingJob(db.Model):
+    """
+    排隊中的微調工作，由 TrainingScheduler 依序取出執行。
+
+    status：queued → running → done / failed / cancelled；
+    running 的工作太久沒有 heartbeat（process 重啟或崩潰）會被放回 queued 重跑。
+    """
+
+    __tablename__ = "training_job"
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+    id: int = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id: int = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    model_id: int = db.Column(
+        db.Integer, db.ForeignKey("trained_model.id"), nullable=False
+    )
+    training_file_id: int = db.Column(
+        db.Integer, db.ForeignKey("training_file.id"), nullable=False
+    )
+    # 從哪個模型開始訓練（base model 或上一次訓練的 adapter）、存到哪裡、訓練資料
+    base_model_dir: str = db.Column(db.String(255), nullable=False)
+    save_dir: str = db.Column(db.String(255), nullable=False)
+    data_path: str = db.Column(db.String(255), nullable=False)
+    status: str = db.Column(db.String(20), nullable=False, default=QUEUED, index=True)
+    # 執行時使用的裝置，例如 cuda:0
+    device: Optional[str] = db.Column(db.String(20), nullable=True)
+    attempts: int = db.Column(db.Integer, nullable=False, default=0)
+    error_msg: Optional[str] = db.Column(db.Text, nullable=True)
+    cancel_requested: bool = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(DateTime(timezone=True), default=func.now())
+    started_at = db.Column(DateTime(timezone=True), nullable=True)
+    finished_at = db.Column(DateTime(timezone=True), nullable=True)
+    heartbeat_at = db.Column(DateTime(timezone=True), nullable=True)
+    # 開始訓練前準備模型花的秒數，以及是否沿用上一個工作留下的常駐 base model
+    startup_seconds: Optional[float] = db.Column(db.Float, nullable=True)
+    base_reused: Optional[bool] = db.Column(db.Boolean, nullable=True)
+
+    # 同一個模型同時只能有一個 queued / running 的工作，由資料庫保證，
+    # 兩個 request 同時送出時後寫入的一方會違反這個 partial unique index
+    __table_args__ = (
+        db.Index(
+            "training_job_one_active_per_model",
+            "model_id",
+            unique=True,
+            postgresql_where=status.in_(ACTIVE_STATUSES),
+            sqlite_where=status.in_(ACTIVE_STATUSES),
+        ),
+    )
+
+    def __init__(
+        self, user_id, model_id, training_file_id, base_model_dir, save_dir, data_path
+    ):
+        self.user_id = user_id
+        self.model_id = model_id
+        self.training_file_id = training_file_id
+        self.base_model_dir = base_model_dir
+        self.save_dir = save_dir
+        self.data_path = data_path
+        self.status = TrainingJob.QUEUED
+        self.attempts = 0
+        self.cancel_requested = False
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "model_id": self.model_id,
+            "status": self.status,
+            "device": self.device,
+            "attempts": self.attempts,
+            "error_msg": self.error_msg,
+            "startup_seconds": self.startup_seconds,
+            "base_reused": self.base_reused,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
@@ -0,0 +1,188 @@
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+import logging
+
+from models.training_job import TrainingJob
+from extensions import db
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class TrainingJobRepo:
+    @staticmethod
+    def create_job(
+        user_id, model_id, training_file_id, base_model_dir, save_dir, data_path
+    ) -> Optional[TrainingJob]:
+        """
+        寫入 queued 的工作。這個模型已經有 queued / running 的工作時，
+        training_job_one_active_per_model 會擋下寫入並回傳 None。
+        """
+        job = TrainingJob(
+            user_id=user_id,
+            model_id=model_id,
+            training_file_id=training_file_id,
+            base_model_dir=base_model_dir,
+            save_dir=save_dir,
+            data_path=data_path,
+        )
+        db.session.add(job)
+        if TrainingJobRepo.save():
+            return job
+        return None
+
+    @staticmethod
+    def save() -> bool:
+        try:
+            db.session.commit()
+            return True
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Error saving training job: {e}")
+            return False
+
+    @staticmethod
+    def find_job_by_id(job_id) -> Optional[TrainingJob]:
+        return TrainingJob.query.filter_by(id=job_id).first()
+
+    @staticmethod
+    def find_job_by_user_and_job_id(user_id, job_id) -> Optional[TrainingJob]:
+        return TrainingJob.query.filter_by(user_id=user_id, id=job_id).first()
+
+    @staticmethod
+    def find_jobs_by_user_id(user_id) -> List[TrainingJob]:
+        return (
+            TrainingJob.query.filter_by(user_id=user_id)
+            .order_by(TrainingJob.id.desc())
+            .all()
+        )
+
+    @staticmethod
+    def find_active_job_by_model_id(model_id) -> Optional[TrainingJob]:
+        """同一個模型同時只能有一個排隊中或訓練中的工作"""
+        return TrainingJob.query.filter(
+            TrainingJob.model_id == model_id,
+            TrainingJob.status.in_(TrainingJob.ACTIVE_STATUSES),
+        ).first()
+
+    @staticmethod
+    def queue_position(job: TrainingJob) -> int:
+        """排在這個工作前面的 queued 工作數"""
+        return TrainingJob.query.filter(
+            TrainingJob.status == TrainingJob.QUEUED, TrainingJob.id < job.id
+        ).count()
+
+    @staticmethod
+    def find_running_jobs() -> List[TrainingJob]:
+        return TrainingJob.query.filter_by(status=TrainingJob.RUNNING).all()
+
+    @staticmethod
+    def claim_next_job(device: str) -> Optional[TrainingJob]:
+        """
+        取出最早的 queued 工作並標成 running。
+
+        以 status 當條件更新，多個 process 同時取同一個工作時只有一個會成功，
+        失敗的一方回傳 None，下一輪再取。
+        """
+        job = (
+            TrainingJob.query.filter_by(status=TrainingJob.QUEUED)
+            .order_by(TrainingJob.id)
+            .first()
+        )
+        if job is None:
+            return None
+        now = _now()
+        updated = TrainingJob.query.filter_by(
+            id=job.id, status=TrainingJob.QUEUED
+        ).update(
+            {
+                "status": TrainingJob.RUNNING,
+                "device": device,
+                "attempts": TrainingJob.attempts + 1,
+                "started_at": now,
+                "heartbeat_at": now,
+                "error_msg": None,
+            },
+            synchronize_session=False,
+        )
+        if not TrainingJobRepo.save() or updated != 1:
+            return None
+        db.session.refresh(job)
+        return job
+
+    @staticmethod
+    def heartbeat(job_ids: List[int]):
+        if not job_ids:
+            return
+        TrainingJob.query.filter(
+            TrainingJob.id.in_(job_ids), TrainingJob.status == TrainingJob.RUNNING
+        ).update({"heartbeat_at": _now()}, synchronize_session=False)
+        TrainingJobRepo.save()
+
+    @staticmethod
+    def recover_stale_jobs(stale_after: float, max_attempts: int) -> List[TrainingJob]:
+        """
+        running 但超過 stale_after 秒沒有 heartbeat 的工作（執行它的 process 已經結束），
+        還沒超過 max_attempts 次的放回 queued，否則標成 failed。
+        """
+        cutoff = _now() - timedelta(seconds=stale_after)
+        jobs = TrainingJob.query.filter(
+            TrainingJob.status == TrainingJob.RUNNING,
+            TrainingJob.heartbeat_at < cutoff,
+        ).all()
+        for job in jobs:
+            if job.cancel_requested:
+                job.status = TrainingJob.CANCELLED
+                job.finished_at = _now()
+            elif job.attempts >= max_attempts:
+                job.status = TrainingJob.FAILED
+                job.error_msg = "Training process exited unexpectedly"
+                job.finished_at = _now()
+            else:
+                job.status = TrainingJob.QUEUED
+                job.device = None
+        TrainingJobRepo.save()
+        return jobs
+
+    @staticmethod
+    def record_startup(job_id, startup_seconds: float, base_reused: bool):
+        job = TrainingJobRepo.find_job_by_id(job_id)
+        if job is None:
+            return None
+        job.startup_seconds = round(startup_seconds, 1)
+        job.base_reused = base_reused
+        TrainingJobRepo.save()
+        return job
+
+    @staticmethod
+    def finish_job(job_id, status: str, error_msg: Optional[str] = None):
+        job = TrainingJobRepo.find_job_by_id(job_id)
+        if job is None:
+            return None
+        job.status = status
+        job.error_msg = error_msg
+        job.finished_at = _now()
+        TrainingJobRepo.save()
+        return job
+
+    @staticmethod
+    def request_cancel(job: TrainingJob) -> bool:
+        """queued 的工作直接取消；running 的工作標記後由 scheduler 在下一個 step 停止"""
+        if job.status == TrainingJob.QUEUED:
+            job.status = TrainingJob.CANCELLED
+            job.finished_at = _now()
+        elif job.status == TrainingJob.RUNNING:
+            job.cancel_requested = True
+        else:
+            return False
+        return TrainingJobRepo.save()
+
+    @staticmethod
+    def is_cancel_requested(job_id) -> bool:
+        return (
+            db.session.query(TrainingJob.cancel_requested)
+            .filter_by(id=job_id)
+            .scalar()
+            is True
+        )
@@ -1,5 +1,12 @@
-from typing import Optional
-from flask import Blueprint, current_app, request, jsonify
+from typing import List, Optional
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    request,
+    jsonify,
+    stream_with_context,
+)
 from flasgger import swag_from
 import logging
 import json
@@ -7,17 +14,30 @@ from flask_jwt_extended import get_jwt_identity, jwt_required
 
 
 from models.trained_model import TrainedModel
+from models.training_job import TrainingJob
 from models.user import User
 from repository.shared_model_repo import SharedModelRepo
 from repository.trainedmodel_repo import TrainedModelRepo
 from repository.trainingfile_repo import TrainingFileRepo
+from repository.trainingjob_repo import TrainingJobRepo
 from service.utils_controller import FILE_DIRECTORY
-from train_model.finetune import BASE_MODEL_DIR, train
-from train_model.inference import inference
+from train_model.finetune import BASE_MODEL_DIR
+from train_model.model_client import (
+    ModelServerBusy,
+    ModelServerUnavailable,
+    pop_result,
+    request_traces,
+    server_health,
+    server_stats,
+    stream_chat,
+    submit_chat,
+)
 import os
-import threading
+from train_model.training_scheduler import (
+    notify_training_scheduler,
+    training_scheduler_stats,
+)
 
-import queue
 import time
 
 
@@ -25,13 +45,27 @@ train_model_bp = Blueprint("finetune", __name__)
 logger = logging.getLogger(__name__)
 
 
+def active_job_response(job: TrainingJob):
+    """同一個模型已經有 queued / running 的工作"""
+    return (
+        jsonify(
+            {
+                "error": "Model is already queued or training",
+                "job_id": job.id,
+                "job_status": job.status,
+            }
+        ),
+        409,
+    )
+
+
 @train_model_bp.post("/train_model")
 @jwt_required()
 @swag_from(
     {
         "tags": ["Train"],
         "description": """
-    此API用來啟動微調，會回傳開始訓練或是失敗。
+    此API用來送出微調工作，工作會排進訓練佇列，由 TrainingScheduler 依序在 GPU 上執行。
 
     Input:
     - 可以接受與微調相關的任何參數，若未填寫則使用 default 參數。
@@ -39,7 +73,7 @@ logger = logging.getLogger(__name__)
 
     Returns:
     - JSON 回應訊息：
-      - 成功時：返回開始訓練。
+      - 成功時：立即返回 job_id，可用 /finetune/train_jobs/<job_id> 查詢進度。
       - 失敗時：返回錯誤消息及相應的 HTTP 狀態碼。
     """,
         "parameters": [
@@ -60,10 +94,14 @@ logger = logging.getLogger(__name__)
         ],
         "responses": {
             200: {
-                "description": "Training started successfully",
+                "description": "Training job queued",
                 "examples": {
                     "application/json": {
-                        "status": "Training started successfully",
+                        "status": "Training queued",
+                        "model_id": 123,
+                        "job_id": 45,
+                        "job_status": "queued",
+                        "queue_position": 1,
                     }
                 },
             },
@@ -79,6 +117,16 @@ logger = logging.getLogger(__name__)
                 "description": "User or model not found",
                 "examples": {"application/json": {"message": "使用者或模型不存在"}},
             },
+            409: {
+                "description": "這個模型已經有排隊中或訓練中的工作",
+                "examples": {
+                    "application/json": {
+                        "error": "Model is already queued or training",
+                        "job_id": 45,
+                        "job_status": "running",
+                    }
+                },
+            },
             500: {
                 "description": "Internal server error",
                 "examples": {
@@ -107,6 +155,10 @@ def train_model():
         if trained_model is None:
             return jsonify({"error": "Model not found"}), 404
 
+        active_job = TrainingJobRepo.find_active_job_by_model_id(trained_model.id)
+        if active_job is not None:
+            return active_job_response(active_job)
+
         training_file = TrainingFileRepo.find_first_training_file_by_user_and_model_id(
             user_id=user.id, model_id=model_id
         )
@@ -123,49 +175,45 @@ def train_model():
             user_id=user.id
         )
 
-        training_file.start_train = True
-        TrainingFileRepo.save_training_file()
-
-        TrainedModelRepo.start_trainedmodel(user_id=user.id, model_id=model_id)
-
         model_path = os.path.join("..\\saved_models", trained_model.modelname)
         print(model_path)
-        app = current_app.app_context()
         # 如果是第一次训练
         if len(saved_models) == 0 or str(trained_model.id) == model_id:
             print("第一次訓練")
-            threading.Thread(
-                target=start_train,
-                args=(
-                    app,
-                    str(trained_model.id),
-                    training_file.id,
-                    BASE_MODEL_DIR,
-                    model_path,
-                    os.path.join(FILE_DIRECTORY, file_path),
-                ),
-            ).start()
+            base_model_dir = BASE_MODEL_DIR
         else:
             last_model = saved_models[-1]
             print(f"接續舊的model: {last_model.id} 繼續訓練")
             # 已經練過了，接續之前練過的model再訓練
-            threading.Thread(
-                target=start_train,
-                args=(
-                    app,
-                    str(trained_model.id),
-                    training_file.id,
-                    os.path.join("..\\saved_models", last_model.modelname),
-                    model_path,
-                    os.path.join(FILE_DIRECTORY, file_path),
-                ),
-            ).start()
+            base_model_dir = os.path.join("..\\saved_models", last_model.modelname)
+
+        job = TrainingJobRepo.create_job(
+            user_id=user.id,
+            model_id=trained_model.id,
+            training_file_id=training_file.id,
+            base_model_dir=base_model_dir,
+            save_dir=model_path,
+            data_path=os.path.join(FILE_DIRECTORY, file_path),
+        )
+        if job is None:
+            # 與同時送出的另一個 request 競爭，被 unique index 擋下
+            active_job = TrainingJobRepo.find_active_job_by_model_id(trained_model.id)
+            if active_job is not None:
+                return active_job_response(active_job)
+            return jsonify({"status": "Error", "message": "無法建立訓練工作"}), 500
+
+        training_file.start_train = True
+        TrainingFileRepo.save_training_file()
+        notify_training_scheduler()
 
         return (
             jsonify(
                 {
-                    "status": "Training started successfully",
+                    "status": "Training queued",
                     "model_id": trained_model.id,
+                    "job_id": job.id,
+                    "job_status": job.status,
+                    "queue_position": TrainingJobRepo.queue_position(job),
                 }
             ),
             200,
@@ -175,98 +223,34 @@ def train_model():
         return jsonify({"status": "Error", "message": str(e)}), 500
 
 
-def start_train(
-    app_ctx,
-    id: str,
-    training_file_id: int,
-    model_dir: str,
-    save_dir: str,
-    data_path: str,
-):
-    with app_ctx:
-        train(id, training_file_id, model_dir, save_dir, data_path)
-
-
-# 最多存10個工作入排程
-request_queue = queue.Queue(maxsize=10)
-result_store = {}
-
-
-def clean_result_store():
-    while True:
-        time.sleep(3600)  # 每小時執行一次清理
-        now = time.time()
-        expired_keys = [
-            key
-            for key, value in result_store.items()
-            if now - float(key.split("_")[0]) > 3600  # 清理超過一小時的結果
-        ]
-        for key in expired_keys:
-            del result_store[key]
-
-
-threading.Thread(target=clean_result_store, daemon=True).start()
-
-
-def process_requests(app):
-    with app.app_context():
-        while True:
-            try:
-                (
-                    request_id,
-                    model_dir,
-                    modelname,
-                    input_text,
-                    user_id,
-                    session_history,
-                ) = request_queue.get()
-
-                try:
-                    responses = inference(
-                        model_dir, modelname, input_text, user_id, session_history
-                    )
-                    if responses is None:
-                        result_store[request_id] = {
-                            "status": "error",
-                            "message": "Inference failed",
-                        }
-                    else:
-                        result_store[request_id] = {
-                            "status": "success",
-                            "result": [
-                                {"input": input_text, "output": response}
-                                for response in responses
-                            ],
-                            "msg": f"成功取得{len(responses)}筆回答",
-                        }
-                except Exception as e:
-                    result_store[request_id] = {"status": "error", "message": str(e)}
-
-            except Exception as e:
-                logger.error(f"Error in process_requests: {str(e)}")
-            finally:
-                request_queue.task_done()
+training_job_example = {
+    "job_id": 45,
+    "model_id": 123,
+    "status": "running",
+    "device": "cuda:0",
+    "attempts": 1,
+    "error_msg": None,
+    "startup_seconds": 2.4,
+    "base_reused": True,
+    "created_at": "2024-11-01T10:00:00+00:00",
+    "started_at": "2024-11-01T10:02:00+00:00",
+    "finished_at": None,
+}
 
 
-@train_model_bp.post("/chat")
+def training_job_response(job: TrainingJob) -> dict:
+    response = job.to_dict()
+    if job.status == TrainingJob.QUEUED:
+        response["queue_position"] = TrainingJobRepo.queue_position(job)
+    return response
+
+
+@train_model_bp.get("/train_jobs")
 @jwt_required()
 @swag_from(
     {
-        "tags": ["Chat"],
-        "description": """
-        這個 API 用來與已訓練模型進行聊天。它接收使用者的輸入文本並返回模型的生成回應。
-
-        Input:
-        - Authorization header 必須包含 Bearer token 以進行身份驗證。
-        - user_info: 包含使用者的基本訊息 (例如 user_Id)。
-        - input_text: 使用者的聊天輸入。
-        - session_history: JSON 格式的對話歷史，包含最近幾次的用戶輸入與模型回應。
-
-        Returns:
-        - JSON 回應訊息：
-          - 成功時：返回生成的聊天回應。
-          - 失敗時：返回錯誤消息及相應的 HTTP 狀態碼。
-        """,
+        "tags": ["Train"],
+        "description": "列出使用者所有的微調工作（最新的在最前面）。",
         "parameters": [
             {
                 "name": "Authorization",
@@ -275,76 +259,148 @@ def process_requests(app):
                 "description": "Bearer token for authorization",
                 "schema": {"type": "string", "example": "Bearer "},
             },
+        ],
+        "responses": {
+            200: {
+                "description": "微調工作",
+                "examples": {"application/json": {"jobs": [training_job_example]}},
+            },
+            404: {
+                "description": "User not found",
+                "examples": {"application/json": {"message": "使用者不存在"}},
+            },
+        },
+    }
+)
+def list_train_jobs():
+    user = User.get_user_by_email(get_jwt_identity())
+    if user is None:
+        return jsonify(message="使用者不存在"), 404
+    jobs = TrainingJobRepo.find_jobs_by_user_id(user.id)
+    return jsonify({"jobs": [training_job_response(job) for job in jobs]}), 200
+
+
+@train_model_bp.get("/train_jobs/<int:job_id>")
+@jwt_required()
+@swag_from(
+    {
+        "tags": ["Train"],
+        "description": "查詢微調工作的狀態：queued、running、done、failed 或 cancelled。",
+        "parameters": [
             {
-                "name": "is_shared",
-                "in": "formData",
-                "type": "string",
-                "description": "是不是分享來的 model",
+                "name": "Authorization",
+                "in": "header",
                 "required": True,
+                "description": "Bearer token for authorization",
+                "schema": {"type": "string", "example": "Bearer "},
             },
             {
-                "name": "modelname",
-                "in": "formData",
-                "type": "string",
-                "description": "選擇要聊天的 modelname（注意：不是 model_id，是 modelname）",
+                "name": "job_id",
+                "in": "path",
+                "type": "integer",
                 "required": True,
+                "description": "/train_model 回傳的 job_id",
             },
+        ],
+        "responses": {
+            200: {
+                "description": "工作狀態",
+                "examples": {"application/json": training_job_example},
+            },
+            404: {
+                "description": "User or job not found",
+                "examples": {"application/json": {"message": "找不到訓練工作"}},
+            },
+        },
+    }
+)
+def get_train_job(job_id):
+    user = User.get_user_by_email(get_jwt_identity())
+    if user is None:
+        return jsonify(message="使用者不存在"), 404
+    job = TrainingJobRepo.find_job_by_user_and_job_id(user.id, job_id)
+    if job is None:
+        return jsonify(message="找不到訓練工作"), 404
+    return jsonify(training_job_response(job)), 200
+
+
+@train_model_bp.post("/train_jobs/<int:job_id>/cancel")
+@jwt_required()
+@swag_from(
+    {
+        "tags": ["Train"],
+        "description": "取消微調工作：排隊中的工作立即取消，訓練中的工作在下一個 step 停止（不會存檔）。",
+        "parameters": [
             {
-                "name": "input_text",
-                "in": "formData",
-                "type": "string",
-                "description": "使用者的聊天輸入文本",
+                "name": "Authorization",
+                "in": "header",
                 "required": True,
+                "description": "Bearer token for authorization",
+                "schema": {"type": "string", "example": "Bearer "},
             },
             {
-                "name": "session_history",
-                "in": "formData",
-                "type": "string",
-                "description": """JSON 格式的對話歷史，包含最近幾次的用戶輸入與模型回應。
-                例如：[{"user": "哈囉", "model": "哈囉"},{"user": "你起床了嗎", "model": "剛起來怎麼嘞"}]
-                """,
-                "required": False,
+                "name": "job_id",
+                "in": "path",
+                "type": "integer",
+                "required": True,
+                "description": "/train_model 回傳的 job_id",
             },
         ],
         "responses": {
             200: {
-                "description": "回應成功",
+                "description": "已取消或已要求停止",
                 "examples": {
-                    "application/json": {
-                        "request_id": "request_id",
-                    }
+                    "application/json": {**training_job_example, "status": "cancelled"}
                 },
             },
-            400: {
-                "description": "輸入錯誤",
-                "examples": {"application/json": {"error": "Input text is required"}},
-            },
             404: {
-                "description": "模型未找到",
-                "examples": {
-                    "application/json": {"error": "Model directory not found"}
-                },
+                "description": "User or job not found",
+                "examples": {"application/json": {"message": "找不到訓練工作"}},
             },
-            500: {
-                "description": "內部錯誤",
-                "examples": {"application/json": {"error": "Internal server error"}},
+            409: {
+                "description": "工作已經結束",
+                "examples": {"application/json": {"error": "Job already finished"}},
             },
         },
     }
 )
-def chat():
+def cancel_train_job(job_id):
+    user = User.get_user_by_email(get_jwt_identity())
+    if user is None:
+        return jsonify(message="使用者不存在"), 404
+    job = TrainingJobRepo.find_job_by_user_and_job_id(user.id, job_id)
+    if job is None:
+        return jsonify(message="找不到訓練工作"), 404
+    if not TrainingJobRepo.request_cancel(job):
+        return jsonify({"error": "Job already finished"}), 409
+    if job.status == TrainingJob.CANCELLED:
+        training_file = TrainingFileRepo.find_training_file_by_id(job.training_file_id)
+        if training_file is not None:
+            training_file.start_train = False
+            TrainingFileRepo.save_training_file()
+    return jsonify(training_job_response(job)), 200
+
+
+def parse_chat_request():
+    """
+    解析 /chat 與 /chat-stream 共用的表單欄位。
+
+    Returns:
+    - (chat_request, None)：解析成功，chat_request 是要送給 model server 的 dict。
+    - (None, (response, status))：輸入錯誤時直接回傳給使用者的回應。
+    """
     current_email = get_jwt_identity()
 
     # 從資料庫中查詢使用者
     user = User.get_user_by_email(current_email)
     if user is None:
-        return jsonify(message="使用者不存在"), 404
+        return None, (jsonify(message="使用者不存在"), 404)
 
     user_id = user.id
     is_shared = request.form.get("is_shared")
     modelname = request.form.get("modelname")
     if not modelname:
-        return jsonify({"error": "modelname is required"}), 400
+        return None, (jsonify({"error": "modelname is required"}), 400)
 
     # 取得模型
     trained_model = (
@@ -355,7 +411,7 @@ def chat():
         )
     )
     if trained_model is None:
-        return jsonify({"error": "未找到模型，請確認有模型訪問權限"}), 404
+        return None, (jsonify({"error": "未找到模型，請確認有模型訪問權限"}), 404)
 
     model_dir = os.path.abspath(
         os.path.join("..", "saved_models", trained_model.modelname)
@@ -367,43 +423,318 @@ def chat():
     print(modelname)
     input_text = request.form.get("input_text", "")
     if not input_text:
-        return jsonify({"error": "Input text is required"}), 400
+        return None, (jsonify({"error": "Input text is required"}), 400)
 
     history_json = request.form.get("session_history", "[]")
     try:
         session_history = json.loads(history_json)
         if not isinstance(session_history, list):
-            return (
+            return None, (
                 jsonify({"error": "Invalid session_history format. Must be a list."}),
                 400,
             )
     except json.JSONDecodeError:
-        return jsonify({"error": "Invalid session_history JSON"}), 400
+        return None, (jsonify({"error": "Invalid session_history JSON"}), 400)
+
+    priority = request.form.get("priority", "interactive")
+    if priority not in ("interactive", "batch"):
+        return None, (jsonify({"error": "priority must be interactive or batch"}), 400)
 
     # 創建唯一的請求 ID
     request_id = f"{time.time()}_{user.id}"
-    request_data = (
-        request_id,
-        model_dir,
-        modelname,
-        input_text,
-        user.id,
-        session_history,
+    chat_request = {
+        "request_id": request_id,
+        "model_dir": model_dir,
+        "modelname": modelname,
+        "input_text": input_text,
+        "user_id": user.id,
+        "session_history": session_history,
+        "priority": priority,
+    }
+    return chat_request, None
+
+
+chat_parameters = [
+    {
+        "name": "Authorization",
+        "in": "header",
+        "required": True,
+        "description": "Bearer token for authorization",
+        "schema": {"type": "string", "example": "Bearer "},
+    },
+    {
+        "name": "is_shared",
+        "in": "formData",
+        "type": "string",
+        "description": "是不是分享來的 model",
+        "required": True,
+    },
+    {
+        "name": "modelname",
+        "in": "formData",
+        "type": "string",
+        "description": "選擇要聊天的 modelname（注意：不是 model_id，是 modelname）",
+        "required": True,
+    },
+    {
+        "name": "input_text",
+        "in": "formData",
+        "type": "string",
+        "description": "使用者的聊天輸入文本",
+        "required": True,
+    },
+    {
+        "name": "session_history",
+        "in": "formData",
+        "type": "string",
+        "description": """JSON 格式的對話歷史，包含最近幾次的用戶輸入與模型回應。
+        例如：[{"user": "哈囉", "model": "哈囉"},{"user": "你起床了嗎", "model": "剛起來怎麼嘞"}]
+        """,
+        "required": False,
+    },
+    {
+        "name": "priority",
+        "in": "formData",
+        "type": "string",
+        "description": "排程的優先等級：interactive（預設，一般聊天）或 batch（批次評估）",
+        "required": False,
+    },
+]
+
+
+def busy_response(e: ModelServerBusy):
+    """429：附上依實際服務時間估計的等待秒數"""
+    retry_after = max(round(e.estimated_wait, 1), 1)
+    response = jsonify(
+        {
+            "error": "The server is busy. Please try again later.",
+            "estimated_wait": retry_after,
+        }
     )
+    response.headers["Retry-After"] = str(int(retry_after + 0.5))
+    return response, 429
+
+
+@train_model_bp.post("/chat")
+@jwt_required()
+@swag_from(
+    {
+        "tags": ["Chat"],
+        "description": """
+        這個 API 用來與已訓練模型進行聊天。它接收使用者的輸入文本並返回模型的生成回應。
+
+        Input:
+        - Authorization header 必須包含 Bearer token 以進行身份驗證。
+        - user_info: 包含使用者的基本訊息 (例如 user_Id)。
+        - input_text: 使用者的聊天輸入。
+        - session_history: JSON 格式的對話歷史，包含最近幾次的用戶輸入與模型回應。
 
-    # 將請求放入隊列
+        Returns:
+        - JSON 回應訊息：
+          - 成功時：返回生成的聊天回應。
+          - 失敗時：返回錯誤消息及相應的 HTTP 狀態碼。
+        """,
+        "parameters": chat_parameters,
+        "responses": {
+            200: {
+                "description": "回應成功",
+                "examples": {
+                    "application/json": {
+                        "request_id": "request_id",
+                    }
+                },
+            },
+            400: {
+                "description": "輸入錯誤",
+                "examples": {"application/json": {"error": "Input text is required"}},
+            },
+            404: {
+                "description": "模型未找到",
+                "examples": {
+                    "application/json": {"error": "Model directory not found"}
+                },
+            },
+            429: {
+                "description": "排程已滿（或這個使用者排隊的訊息太多）",
+                "examples": {
+                    "application/json": {
+                        "error": "The server is busy. Please try again later.",
+                        "estimated_wait": 4.5,
+                    }
+                },
+            },
+            500: {
+                "description": "內部錯誤",
+                "examples": {"application/json": {"error": "Internal server error"}},
+            },
+        },
+    }
+)
+def chat():
+    chat_request, error_response = parse_chat_request()
+    if error_response is not None:
+        return error_response
+
+    # 將請求放入 model server 的隊列（問候語由 model server 直接回覆）
     try:
-        request_queue.put_nowait(request_data)
-    except queue.Full:
-        return jsonify({"error": "The server is busy. Please try again later."}), 429
+        submit_chat(chat_request)
+    except ModelServerBusy as e:
+        return busy_response(e)
+    except ModelServerUnavailable as e:
+        logger.error(f"Model server unavailable: {e}")
+        return jsonify({"error": "Model server is unavailable"}), 503
 
     # 返回請求 ID 供用戶查詢
-    return jsonify({"status": "queued", "request_id": request_id}), 200
+    return jsonify({"status": "queued", "request_id": chat_request["request_id"]}), 200
+
+
+@train_model_bp.post("/chat-stream")
+@jwt_required()
+@swag_from(
+    {
+        "tags": ["Chat"],
+        "description": """
+        與 /chat 相同的輸入，但以 Server-Sent Events 逐步回傳模型生成的文字。
+
+        Events:
+        - token: {"index": 第幾個回答, "text": 新生成的文字}（尚未經過後處理）
+        - retry: {"attempt": 重試次數}，回答為空時重新生成，先前的 token 作廢
+        - done: 與 /chat-result 相同格式的最終結果（已經過標記清理與 GPT 修正）
+        """,
+        "parameters": chat_parameters,
+        "produces": ["text/event-stream"],
+        "responses": {
+            200: {"description": "text/event-stream"},
+            400: {
+                "description": "輸入錯誤",
+                "examples": {"application/json": {"error": "Input text is required"}},
+            },
+            404: {
+                "description": "模型未找到",
+                "examples": {
+                    "application/json": {"error": "Model directory not found"}
+                },
+            },
+            429: {
+                "description": "排程已滿（或這個使用者排隊的訊息太多）",
+                "examples": {
+                    "application/json": {
+                        "error": "The server is busy. Please try again later.",
+                        "estimated_wait": 4.5,
+                    }
+                },
+            },
+        },
+    }
+)
+def chat_stream():
+    chat_request, error_response = parse_chat_request()
+    if error_response is not None:
+        return error_response
+
+    try:
+        events = stream_chat(chat_request)
+    except ModelServerBusy as e:
+        return busy_response(e)
+    except ModelServerUnavailable as e:
+        logger.error(f"Model server unavailable: {e}")
+        return jsonify({"error": "Model server is unavailable"}), 503
+
+    def generate():
+        yield f"event: queued\ndata: {json.dumps({'request_id': chat_request['request_id']})}\n\n"
+        for event, data in events:
+            yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# /chat-result 的 wait 參數上限（秒）
+MAX_RESULT_WAIT = float(os.getenv("MAX_RESULT_WAIT", 30))
+
+# 可以查看 /metrics 與 /traces 的帳號（逗號分隔的 email），裡面有 request_id、使用者與模型路徑
+OPERATOR_EMAILS = {
+    email.strip()
+    for email in os.getenv("OPERATOR_EMAILS", "").split(",")
+    if email.strip()
+}
+
+
+def is_operator(email: Optional[str]) -> bool:
+    return email is not None and email in OPERATOR_EMAILS
+
+
+def forbidden_response():
+    return jsonify({"message": "沒有查看權限"}), 403
 
 
 @train_model_bp.get("/chat-result/<request_id>")
+@swag_from(
+    {
+        "tags": ["Chat"],
+        "description": """
+        取得 /chat 的結果，結果只能取一次。
+
+        帶 wait 參數時會等待最多 wait 秒（上限 MAX_RESULT_WAIT），結果一完成就回傳，
+        不需要頻繁輪詢；不帶 wait 時立即回傳。
+        """,
+        "parameters": [
+            {
+                "name": "request_id",
+                "in": "path",
+                "type": "string",
+                "required": True,
+                "description": "/chat 回傳的 request_id",
+            },
+            {
+                "name": "wait",
+                "in": "query",
+                "type": "number",
+                "required": False,
+                "description": "最多等待幾秒",
+            },
+        ],
+        "responses": {
+            200: {
+                "description": "結果",
+                "examples": {
+                    "application/json": {
+                        "status": "success",
+                        "result": [{"input": "你在幹嘛", "output": "在家耍廢"}],
+                        "msg": "成功取得1筆回答",
+                    }
+                },
+            },
+            202: {
+                "description": "還在處理中（或等待逾時）",
+                "examples": {
+                    "application/json": {
+                        "status": "pending",
+                        "message": "Request is still processing",
+                    }
+                },
+            },
+            503: {
+                "description": "model server 無法連線",
+                "examples": {"application/json": {"error": "Model server is unavailable"}},
+            },
+        },
+    }
+)
 def chat_result(request_id):
-    result = result_store.pop(request_id, None)
+    try:
+        wait = min(max(float(request.args.get("wait", 0)), 0), MAX_RESULT_WAIT)
+    except ValueError:
+        return jsonify({"error": "wait must be a number"}), 400
+
+    try:
+        result = pop_result(request_id, wait=wait)
+    except ModelServerUnavailable as e:
+        logger.error(f"Model server unavailable: {e}")
+        return jsonify({"error": "Model server is unavailable"}), 503
     if result is None:
         return (
             jsonify({"status": "pending", "message": "Request is still processing"}),
@@ -412,6 +743,283 @@ def chat_result(request_id):
     return jsonify(result), 200
 
 
+@train_model_bp.get("/metrics")
+@jwt_required()
+@swag_from(
+    {
+        "tags": ["Chat"],
+        "description": "推論服務的運作指標（每個 inference worker 的模型快取、few-shot 前綴 KV cache、GPT 修正階段，以及排程、重複請求的合併與尚未取走的結果）；這個 process 有啟動訓練排程時另外附上 training（各 GPU 上執行中的工作與常駐的訓練 base model）。只有 OPERATOR_EMAILS 裡的帳號可以查看。",
+        "responses": {
+            200: {
+                "description": "指標",
+                "examples": {
+                    "application/json": {
+                        "workers": [
+                            {
+                                "index": 0,
+                                "device": "cuda:0",
+                                "alive": True,
+                                "ready": True,
+                                "restarts": 0,
+                                "in_flight": 3,
+                                "loaded": ["/srv/saved_models/uuid"],
+                                "warm_up_seconds": {
+                                    "/srv/saved-taide-model": 41.2,
+                                    "/srv/saved_models/uuid": 3.8,
+                                },
+                                "model_cache": {
+                                    "entries": 12,
+                                    "pinned": 1,
+                                    "used_bytes": 201326592,
+                                    "budget_bytes": 4294967296,
+                                    "hits": 340,
+                                    "misses": 12,
+                                    "evictions": 0,
+                                    "hit_ratio": 0.97,
+                                },
+                                "memory": {
+                                    "device": "cuda:0",
+                                    "used_bytes": 17179869184,
+                                    "total_bytes": 25769803776,
+                                    "used_ratio": 0.67,
+                                    "high_watermark": 0.9,
+                                    "pressure_evictions": 0,
+                                    "allocated_bytes": 16106127360,
+                                    "peak_allocated_bytes": 20401094656,
+                                },
+                                "prefix_cache": {
+                                    "entries": 30,
+                                    "used_bytes": 52428800,
+                                    "hits": 800,
+                                    "misses": 30,
+                                    "prompt_tokens": 150000,
+                                    "prompt_tokens_saved": 96000,
+                                    "saved_ratio": 0.64,
+                                },
+                                "post_edit": {
+                                    "cache_entries": 120,
+                                    "hits": 35,
+                                    "misses": 400,
+                                    "timeouts": 3,
+                                    "hit_ratio": 0.08,
+                                },
+                                "stopping": {
+                                    "replies": 400,
+                                    "stopped_early": 310,
+                                    "tokens_generated": 7200,
+                                    "tokens_saved": 9800,
+                                    "tokens_saved_per_reply": 24.5,
+                                },
+                            }
+                        ],
+                        "result_store": {
+                            "backend": "memory",
+                            "entries": 4,
+                            "used_bytes": 1024,
+                            "max_bytes": 67108864,
+                            "expired": 2,
+                            "evicted": 0,
+                        },
+                        "request_queue": {
+                            "queued": 3,
+                            "maxsize": 32,
+                            "per_user_limit": 4,
+                            "users": 2,
+                            "classes": {
+                                "interactive": {"queued": 3, "users": 2, "weight": 4},
+                                "batch": {"queued": 0, "users": 0, "weight": 1},
+                            },
+                            "service_time_s": 2.4,
+                            "served": 180,
+                            "rejected": 5,
+                        },
+                        "coalescer": {
+                            "in_flight": 3,
+                            "submitted": 400,
+                            "coalesced": 24,
+                            "coalesced_ratio": 0.06,
+                            "reply_cache_entries": 50,
+                            "reply_cache_hits": 12,
+                            "reply_cache_hit_ratio": 0.03,
+                        },
+                        "tracing": {
+                            "generate": {
+                                "count": 180,
+                                "sum": 270.0,
+                                "mean": 1.5,
+                                "max": 4.2,
+                                "p50": 2.5,
+                                "p90": 2.5,
+                                "p99": 5.0,
+                                "buckets": [[1.0, 40], [2.5, 170], [5.0, 180], ["+Inf", 180]],
+                            },
+                        },
+                        "training": {
+                            "devices": ["cuda:0"],
+                            "concurrency_per_device": 1,
+                            "running": {"45": "cuda:0"},
+                            "training_base": {
+                                "enabled": True,
+                                "resident": [
+                                    {
+                                        "model_dir": "/srv/saved-taide-model",
+                                        "device": "cuda:0",
+                                        "in_use": True,
+                                        "load_seconds": 38.5,
+                                    }
+                                ],
+                                "loads": 1,
+                                "reuses": 6,
+                                "saved_seconds": 231.0,
+                            },
+                        },
+                    }
+                },
+            },
+            403: {
+                "description": "不是 OPERATOR_EMAILS 裡的帳號",
+                "examples": {"application/json": {"message": "沒有查看權限"}},
+            },
+        },
+    }
+)
+def metrics():
+    if not is_operator(get_jwt_identity()):
+        return forbidden_response()
+    try:
+        stats = server_stats()
+    except ModelServerUnavailable as e:
+        logger.error(f"Model server unavailable: {e}")
+        return jsonify({"error": "Model server is unavailable"}), 503
+    training = training_scheduler_stats()
+    if training is not None:
+        stats["training"] = training
+    return jsonify(stats), 200
+
+
+@train_model_bp.get("/traces")
+@jwt_required()
+@swag_from(
+    {
+        "tags": ["Chat"],
+        "description": "最近完成的聊天請求各階段的耗時（排程等待、載入模型、few-shot、RAG、tokenize、生成、標記清理與 GPT 修正）。只有 OPERATOR_EMAILS 裡的帳號可以查看。",
+        "parameters": [
+            {
+                "name": "request_id",
+                "in": "query",
+                "type": "string",
+                "required": False,
+                "description": "只查詢這個 request_id",
+            },
+            {
+                "name": "limit",
+                "in": "query",
+                "type": "integer",
+                "required": False,
+                "description": "最多回傳幾筆，預設 50",
+            },
+        ],
+        "responses": {
+            200: {
+                "description": "每個請求的耗時記錄，最新的在最前面",
+                "examples": {
+                    "application/json": {
+                        "traces": [
+                            {
+                                "request_id": "uuid",
+                                "user_id": "1",
+                                "model_dir": "/srv/saved_models/uuid",
+                                "priority": "interactive",
+                                "worker": 0,
+                                "status": "success",
+                                "enqueued_at": 1700000000.0,
+                                "total_seconds": 3.1,
+                                "spans": [
+                                    {"name": "queue_wait", "seconds": 0.4},
+                                    {"name": "worker_queue", "seconds": 0.01},
+                                    {"name": "load_model", "seconds": 0.002, "cache_hit": True},
+                                    {"name": "few_shot", "seconds": 0.003},
+                                    {"name": "retrieval", "seconds": 0.08},
+                                    {"name": "assemble_prompt", "seconds": 0.004},
+                                    {"name": "tokenize", "seconds": 0.002},
+                                    {
+                                        "name": "prefill",
+                                        "seconds": 0.05,
+                                        "prompt_tokens": 600,
+                                        "reused_tokens": 420,
+                                    },
+                                    {"name": "generate", "seconds": 1.6, "tokens": 38},
+                                    {"name": "sanitize", "seconds": 0.001},
+                                    {"name": "post_edit", "seconds": 0.9},
+                                ],
+                            }
+                        ]
+                    }
+                },
+            },
+            403: {
+                "description": "不是 OPERATOR_EMAILS 裡的帳號",
+                "examples": {"application/json": {"message": "沒有查看權限"}},
+            },
+            503: {
+                "description": "model server 無法連線",
+                "examples": {"application/json": {"error": "Model server is unavailable"}},
+            },
+        },
+    }
+)
+def traces():
+    if not is_operator(get_jwt_identity()):
+        return forbidden_response()
+    try:
+        limit = int(request.args.get("limit", 50))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+
+    try:
+        records = request_traces(request.args.get("request_id"), limit=limit)
+    except ModelServerUnavailable as e:
+        logger.error(f"Model server unavailable: {e}")
+        return jsonify({"error": "Model server is unavailable"}), 503
+    return jsonify({"traces": records}), 200
+
+
+@train_model_bp.get("/health")
+@swag_from(
+    {
+        "tags": ["Chat"],
+        "description": "推論服務是否就緒：所有 inference worker 都已啟動，並預熱完 base model 與最近常用的模型。",
+        "responses": {
+            200: {
+                "description": "已就緒",
+                "examples": {
+                    "application/json": {
+                        "ready": True,
+                        "workers": [{"index": 0, "alive": True, "ready": True}],
+                    }
+                },
+            },
+            503: {
+                "description": "預熱中或 model server 無法連線",
+                "examples": {
+                    "application/json": {
+                        "ready": False,
+                        "workers": [{"index": 0, "alive": True, "ready": False}],
+                    }
+                },
+            },
+        },
+    }
+)
+def health():
+    try:
+        health = server_health()
+    except ModelServerUnavailable as e:
+        logger.error(f"Model server unavailable: {e}")
+        return jsonify({"ready": False, "error": "Model server is unavailable"}), 503
+    return jsonify(health), 200 if health["ready"] else 503
+
+
 @train_model_bp.post("/share-model")
 @jwt_required()
 @swag_from(
@@ -11,6 +11,7 @@ from repository.trainedmodel_repo import TrainedModelRepo
 from repository.trainingfile_repo import TrainingFileRepo
 from repository.userphoto_repo import UserPhotoRepo
 from models.user import User
+from train_model.model_client import invalidate_few_shot
 
 userinfo_bp = Blueprint("userinfo", __name__)
 logger = logging.getLogger(__name__)
@@ -530,6 +531,7 @@ def delete_model(model_id):
                 os.remove(file_path)
             # delete_trainingfile_success = TrainingFileRepo.delete_training_file_by_user_and_model_id(user_id=user_id, model_id=model_id)
             TrainingFileRepo.delete_training_file_by_file_id(model_training_file.id)
+            invalidate_few_shot(model_training_file.id)
 
         # 刪除資料庫中的模型記錄
         delete_model_success = (
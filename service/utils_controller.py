@@ -10,6 +10,7 @@ from repository.shared_model_repo import SharedModelRepo
 from repository.trainedmodel_repo import TrainedModelRepo
 from repository.trainingfile_repo import TrainingFileRepo
 from models.user import User
+from train_model.model_client import invalidate_few_shot, refresh_few_shot
 import json
 import os
 import logging
@@ -163,6 +164,7 @@ def upload_csv_file():
             delete_file_path = os.path.join(FILE_DIRECTORY, current_file.filename)
             os.remove(delete_file_path)
             TrainingFileRepo.delete_training_file_by_file_id(current_file.id)
+            invalidate_few_shot(current_file.id)
             is_renew = True
         # 儲存檔案
         saved_file = TrainingFileRepo.create_trainingfile(
@@ -174,6 +176,9 @@ def upload_csv_file():
                 500,
             )
         file.save(os.path.join(FILE_DIRECTORY, saved_file.filename))
+        refresh_few_shot(
+            saved_file.id, os.path.join(FILE_DIRECTORY, saved_file.filename)
+        )
         if is_renew:
             return jsonify({"message": "File update successfully"}), 200
         return jsonify({"message": "File uploaded successfully"}), 200
@@ -344,6 +349,7 @@ def upload_txt_file():
                     return jsonify({"error": f"File not found: {file_path}"}), 404
 
                 TrainingFileRepo.delete_training_file_by_file_id(current_file.id)
+                invalidate_few_shot(current_file.id)
             except OSError as e:
                 return jsonify({"error": f"Error deleting old file: {str(e)}"}), 500
 
@@ -356,6 +362,9 @@ def upload_txt_file():
         )
         if saved_file is None:
             return jsonify({"error": "Unable to create file."}), 500
+        refresh_few_shot(
+            saved_file.id, os.path.join(FILE_DIRECTORY, saved_file.filename)
+        )
 
         return jsonify({"message": "File uploaded successfully"}), 200
     else:
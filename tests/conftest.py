@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 讓測試可以 import repo 根目錄下的 train_model、repository 等套件
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,126 @@
+import queue
+
+import pytest
+
+from train_model.coalescer import RequestCoalescer, fingerprint
+from train_model.fair_queue import FairQueue
+
+
+class Routed:
+    def __init__(self, input_text="你在幹嘛", user_id="1", **payload):
+        self.user_id = user_id
+        self.payload = {
+            "model_dir": "/srv/saved_models/uuid",
+            "modelname": "小明",
+            "user_id": user_id,
+            "input_text": input_text,
+            **payload,
+        }
+
+
+SUCCESS = {"status": "success", "result": [{"input": "你在幹嘛", "output": "在家耍廢"}]}
+
+
+def test_fingerprint_normalizes_whitespace():
+    assert fingerprint(Routed("你在 幹嘛").payload) == fingerprint(
+        Routed("  你在   幹嘛\n").payload
+    )
+    assert fingerprint(Routed().payload) != fingerprint(Routed(user_id="2").payload)
+    assert fingerprint(Routed().payload) != fingerprint(
+        Routed(session_history=["User: 嗨"]).payload
+    )
+
+
+def test_duplicates_share_one_generation():
+    coalescer = RequestCoalescer()
+    enqueued = []
+    leader, follower, other = Routed(), Routed(" 你在幹嘛\n"), Routed("早安")
+
+    assert coalescer.submit(leader, enqueued.append) is None
+    assert coalescer.submit(follower, enqueued.append) is None
+    assert coalescer.submit(other, enqueued.append) is None
+    assert enqueued == [leader, other]
+
+    assert coalescer.complete(leader, SUCCESS) == [follower]
+    assert coalescer.complete(other, SUCCESS) == []
+    stats = coalescer.stats()
+    assert stats["in_flight"] == 0
+    assert stats["coalesced"] == 1
+    assert stats["submitted"] == 3
+
+    # 完成後相同的請求重新生成（沒有開 reply cache）
+    again = Routed()
+    coalescer.submit(again, enqueued.append)
+    assert enqueued[-1] is again
+
+
+def test_enqueue_full_leaves_no_record():
+    coalescer = RequestCoalescer()
+
+    def full(_):
+        raise queue.Full
+
+    with pytest.raises(queue.Full):
+        coalescer.submit(Routed(), full)
+    assert coalescer.stats()["in_flight"] == 0
+
+    # 下一個相同的請求會排進排程，而不是掛在不存在的請求後面
+    enqueued = []
+    coalescer.submit(Routed(), enqueued.append)
+    assert len(enqueued) == 1
+
+
+def test_followers_hold_the_per_user_limit():
+    coalescer = RequestCoalescer()
+    q = FairQueue(maxsize=32, per_user_limit=2)
+    leader = Routed()
+    coalescer.submit(leader, q.put_nowait, hold=q.hold)
+    follower = Routed()
+    coalescer.submit(follower, q.put_nowait, hold=q.hold)
+    with pytest.raises(queue.Full):
+        coalescer.submit(Routed(), q.put_nowait, hold=q.hold)
+    assert coalescer.stats()["coalesced"] == 1
+
+    q.get_nowait()
+    for routed in coalescer.complete(leader, SUCCESS):
+        q.release(routed)
+    assert q.stats()["users"] == 0
+
+
+def test_reply_cache(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("train_model.coalescer.time.time", lambda: now[0])
+    coalescer = RequestCoalescer(reply_ttl=60, reply_cache_size=1)
+    enqueued = []
+
+    leader = Routed()
+    coalescer.submit(leader, enqueued.append)
+    coalescer.complete(leader, SUCCESS)
+    reply = coalescer.submit(Routed(), enqueued.append)
+    assert reply == SUCCESS
+    # 回傳的是複本，修改不會影響快取
+    reply["result"][0]["output"] = "改掉"
+    assert coalescer.submit(Routed(), enqueued.append) == SUCCESS
+    assert coalescer.stats()["reply_cache_hits"] == 2
+
+    # 失敗的結果不快取
+    failed = Routed("早安")
+    coalescer.submit(failed, enqueued.append)
+    coalescer.complete(failed, {"status": "error", "message": "Inference failed"})
+    assert coalescer.submit(Routed("早安"), enqueued.append) is None
+
+    # 過期後重新生成
+    now[0] += 61
+    assert coalescer.submit(Routed(), enqueued.append) is None
+    assert len(enqueued) == 4
+
+
+def test_reply_cache_size_is_bounded():
+    coalescer = RequestCoalescer(reply_ttl=60, reply_cache_size=1)
+    first, second = Routed("早安"), Routed("晚安")
+    for routed in (first, second):
+        coalescer.submit(routed, lambda _: None)
+        coalescer.complete(routed, SUCCESS)
+    assert coalescer.stats()["reply_cache_entries"] == 1
+    assert coalescer.submit(Routed("早安"), lambda _: None) is None
+    assert coalescer.submit(Routed("晚安"), lambda _: None) == SUCCESS
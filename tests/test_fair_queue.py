@@ -0,0 +1,104 @@
+import queue
+
+import pytest
+
+from train_model.fair_queue import FairQueue
+
+
+class Item:
+    def __init__(self, user_id, name, priority="interactive"):
+        self.user_id = user_id
+        self.name = name
+        self.priority = priority
+
+
+def drain(q: FairQueue):
+    names = []
+    while not q.empty():
+        names.append(q.get_nowait().name)
+        q.task_done()
+    return names
+
+
+def test_users_take_turns():
+    q = FairQueue(maxsize=32, per_user_limit=8)
+    for i in range(3):
+        q.put_nowait(Item("a", f"a{i}"))
+    q.put_nowait(Item("b", "b0"))
+    q.put_nowait(Item("c", "c0"))
+
+    # a 先連發三則也不會擋住 b 和 c
+    assert drain(q) == ["a0", "b0", "c0", "a1", "a2"]
+
+
+def test_priority_weights():
+    q = FairQueue(maxsize=32, per_user_limit=32)
+    for i in range(8):
+        q.put_nowait(Item("a", f"i{i}"))
+        q.put_nowait(Item("b", f"b{i}", priority="batch"))
+
+    # 權重 4:1，每 5 筆有 1 筆 batch，batch 不會被餓死；interactive 取完後只剩 batch
+    assert drain(q) == [
+        "i0", "i1", "b0", "i2", "i3",
+        "i4", "i5", "b1", "i6", "i7",
+        "b2", "b3", "b4", "b5", "b6", "b7",
+    ]  # fmt: skip
+
+
+def test_unknown_priority_uses_default():
+    q = FairQueue()
+    q.put_nowait(Item("a", "x", priority="urgent"))
+    assert q.stats()["classes"]["interactive"]["queued"] == 1
+
+
+def test_per_user_limit_and_maxsize():
+    q = FairQueue(maxsize=3, per_user_limit=2)
+    q.put_nowait(Item("a", "a0"))
+    q.put_nowait(Item("a", "a1"))
+    with pytest.raises(queue.Full):
+        q.put_nowait(Item("a", "a2"))
+
+    q.put_nowait(Item("b", "b0"))
+    with pytest.raises(queue.Full):
+        q.put_nowait(Item("c", "c0"))
+    assert q.stats()["rejected"] == 2
+
+    # 取出後名額歸還
+    q.get_nowait()
+    q.put_nowait(Item("c", "c0"))
+
+
+def test_hold_counts_against_per_user_limit():
+    q = FairQueue(maxsize=32, per_user_limit=2)
+    follower = Item("a", "follower")
+    q.hold(follower)
+    q.put_nowait(Item("a", "a0"))
+    with pytest.raises(queue.Full):
+        q.hold(Item("a", "another"))
+    with pytest.raises(queue.Full):
+        q.put_nowait(Item("a", "a1"))
+
+    # hold 不會排進佇列
+    assert q.qsize() == 1
+    q.release(follower)
+    q.put_nowait(Item("a", "a1"))
+    assert drain(q) == ["a0", "a1"]
+    assert q.stats()["users"] == 0
+
+
+def test_get_times_out_when_empty():
+    q = FairQueue()
+    with pytest.raises(queue.Empty):
+        q.get(timeout=0.01)
+    with pytest.raises(queue.Empty):
+        q.get_nowait()
+
+
+def test_estimated_wait_uses_service_time():
+    q = FairQueue(concurrency=2)
+    q.record_service_time(2.0)
+    q.put_nowait(Item("a", "a0"))
+    assert q.estimated_wait() == pytest.approx(2.0)
+    q.record_service_time(4.0)
+    # EWMA：2 + 0.2 * (4 - 2)
+    assert q.stats()["service_time_s"] == pytest.approx(2.4)
@@ -0,0 +1,97 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from train_model.packing import PackedCollator, block_causal_mask, pack_examples
+
+
+def test_pack_examples_fills_blocks_in_order():
+    batch = {
+        "input_ids": [[1, 2, 3], [4, 5], [6, 7, 8, 9], [10] * 12],
+        "labels": [[1, 2, 3], [4, 5], [6, 7, 8, 9], [10] * 12],
+    }
+    packed = pack_examples(batch, block_size=6)
+
+    assert packed["input_ids"] == [[1, 2, 3, 4, 5], [6, 7, 8, 9], [10] * 6]
+    assert packed["segment_ids"] == [[0, 0, 0, 1, 1], [0, 0, 0, 0], [0] * 6]
+    assert packed["position_ids"] == [[0, 1, 2, 0, 1], [0, 1, 2, 3], list(range(6))]
+    # 每筆樣本的第一個 token 不計 loss
+    assert packed["labels"] == [
+        [-100, 2, 3, -100, 5],
+        [-100, 7, 8, 9],
+        [-100] + [10] * 5,
+    ]
+    assert packed["length"] == [5, 4, 6]
+
+
+def test_pack_examples_keeps_masked_labels():
+    batch = {"input_ids": [[1, 2, 3]], "labels": [[-100, -100, 3]]}
+    assert pack_examples(batch, block_size=8)["labels"] == [[-100, -100, 3]]
+
+
+def test_collator_pads_to_multiple():
+    collator = PackedCollator(pad_token_id=0, pad_to_multiple_of=4)
+    features = [
+        {"input_ids": [1, 2, 3], "labels": [-100, 2, 3], "position_ids": [0, 1, 2],
+         "segment_ids": [0, 0, 0]},
+        {"input_ids": [4, 5, 6, 7, 8], "labels": [-100, 5, -100, 7, 8],
+         "position_ids": [0, 1, 0, 1, 2], "segment_ids": [0, 0, 1, 1, 1]},
+    ]  # fmt: skip
+    batch = collator(features)
+
+    assert batch["input_ids"].shape == (2, 8)
+    assert batch["input_ids"][0].tolist() == [1, 2, 3, 0, 0, 0, 0, 0]
+    assert batch["labels"][0, 3:].tolist() == [-100] * 5
+    assert batch["segment_ids"][0, 3:].tolist() == [-1] * 5
+
+
+def test_block_causal_mask():
+    segment_ids = torch.tensor([[0, 0, 1, 1, 1, -1]])
+    mask = block_causal_mask(segment_ids, torch.float32)
+    allowed = (mask[0, 0] == 0).int().tolist()
+
+    assert mask.shape == (1, 1, 6, 6)
+    assert allowed == [
+        [1, 0, 0, 0, 0, 0],
+        [1, 1, 0, 0, 0, 0],
+        [0, 0, 1, 0, 0, 0],
+        [0, 0, 1, 1, 0, 0],
+        [0, 0, 1, 1, 1, 0],
+        # padding 只看得到自己
+        [0, 0, 0, 0, 0, 1],
+    ]
+    assert mask[0, 0, 0, 1] == torch.finfo(torch.float32).min
+
+
+def test_packed_forward_matches_separate_examples():
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+        vocab_size=32,
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        num_key_value_heads=2,
+    )
+    model = transformers.LlamaForCausalLM(config).eval()
+    examples = [[1, 5, 7, 9], [2, 4, 6]]
+    packed = pack_examples({"input_ids": examples, "labels": examples}, block_size=8)
+    batch = PackedCollator(pad_token_id=0)(
+        [{key: values[0] for key, values in packed.items()}]
+    )
+
+    with torch.no_grad():
+        packed_logits = model(
+            input_ids=batch["input_ids"],
+            position_ids=batch["position_ids"],
+            attention_mask=block_causal_mask(batch["segment_ids"], torch.float32),
+        ).logits[0]
+        start = 0
+        for example in examples:
+            alone = model(input_ids=torch.tensor([example])).logits[0]
+            # 打包後每筆樣本的 logits 與單獨計算時相同，看不到前一筆樣本
+            torch.testing.assert_close(
+                packed_logits[start : start + len(example)], alone, atol=1e-5, rtol=1e-4
+            )
+            start += len(example)
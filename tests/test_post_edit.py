@@ -0,0 +1,72 @@
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+openai = pytest.importorskip("openai")
+if not hasattr(openai, "ChatCompletion") or openai.__version__.startswith("1."):
+    pytest.skip("trim.py 使用 openai<1.0 的 ChatCompletion", allow_module_level=True)
+
+from train_model import trim
+from train_model.post_edit import PostEditStage
+from train_model.stub_openai_server import StubOpenAIHandler
+
+
+@pytest.fixture
+def stub_server(monkeypatch):
+    handler = type("Handler", (StubOpenAIHandler,), {"log_message": lambda *a: None})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(openai, "api_key", "stub")
+    monkeypatch.setattr(
+        openai, "api_base", f"http://127.0.0.1:{server.server_address[1]}/v1"
+    )
+    yield handler
+    server.shutdown()
+    server.server_close()
+
+
+def post_edit(stage: PostEditStage, responses):
+    done = threading.Event()
+    result = {}
+
+    def callback(edited):
+        result["edited"] = edited
+        done.set()
+
+    stage.submit("你好嗎", responses, "小明", ["User: 嗨"], [], callback=callback)
+    assert done.wait(10)
+    return result["edited"]
+
+
+def test_successful_edit_is_cached(stub_server):
+    stage = PostEditStage(
+        max_workers=2, deadline=5, edit=trim.analyze_and_modify_response
+    )
+
+    assert post_edit(stage, ["還不錯"]) == ["[edited] 還不錯"]
+    assert post_edit(stage, ["還不錯"]) == ["[edited] 還不錯"]
+    stats = stage.stats()
+    assert stats["cache_entries"] == 1
+    assert stats["hits"] == 1
+
+
+def test_failed_edit_falls_back_and_is_not_cached(stub_server):
+    stub_server.status = 500
+    stage = PostEditStage(
+        max_workers=2, deadline=5, edit=trim.analyze_and_modify_response
+    )
+
+    assert post_edit(stage, ["還不錯"]) == ["還不錯"]
+    assert stage.stats()["cache_entries"] == 0
+
+    # API 恢復後要重新修正，而不是拿到快取的原始輸出
+    stub_server.status = 200
+    assert post_edit(stage, ["還不錯"]) == ["[edited] 還不錯"]
+
+
+def test_analyze_returns_none_on_failure(stub_server):
+    stub_server.status = 500
+    assert (
+        trim.analyze_and_modify_response("嗨", "好", "小明", "", [], timeout=5) is None
+    )
@@ -0,0 +1,83 @@
+from train_model.prompt_builder import (
+    assemble_prompt,
+    clip_input_ids,
+    count_tokens,
+    rag_header,
+)
+
+
+class CharTokenizer:
+    """一個字元一個 token"""
+
+    def __call__(self, text, add_special_tokens=True, **kwargs):
+        return {"input_ids": [ord(ch) for ch in text]}
+
+
+tokenizer = CharTokenizer()
+FEW_SHOT = ["User: 一", "Assistant: 甲", "User: 二", "Assistant: 乙"]
+# 每組 few-shot 與對話紀錄的 token 數都一樣（一個字元一個 token）
+PAIR_TOKENS = count_tokens(tokenizer, FEW_SHOT[:2])
+HISTORY = [{"user": "三", "model": "丙"}, {"user": "四", "model": "丁"}]
+
+
+def assemble(
+    input_text="你好", rag=None, history=HISTORY, budget=200, few_shot_budget=100
+):
+    return assemble_prompt(
+        tokenizer, input_text, FEW_SHOT, rag, history, budget, few_shot_budget
+    )
+
+
+def test_everything_fits_in_order():
+    prefix, rest = assemble(rag="文件一\n文件二")
+    assert prefix == FEW_SHOT
+    assert rest == [
+        rag_header,
+        "文件一",
+        "文件二",
+        "User: 三",
+        "Assistant: 丙",
+        "User: 四",
+        "Assistant: 丁",
+        "User: 你好",
+        "Assistant:",
+    ]
+
+
+def test_few_shot_keeps_most_recent_pairs_within_its_budget():
+    prefix, _ = assemble(few_shot_budget=PAIR_TOKENS)
+    assert prefix == FEW_SHOT[2:]
+    prefix, _ = assemble(few_shot_budget=PAIR_TOKENS - 1)
+    assert prefix == []
+
+
+def test_few_shot_does_not_depend_on_the_input():
+    # 輸入長短不同，前綴都一樣，PrefixCache 才能重用
+    short_prefix, _ = assemble("嗨", budget=60)
+    long_prefix, long_rest = assemble("嗨" * 40, budget=60)
+    assert short_prefix == long_prefix == FEW_SHOT
+    # 放不下的是對話紀錄，這次的輸入一定保留
+    assert long_rest == ["User: " + "嗨" * 40, "Assistant:"]
+
+
+def test_history_before_rag():
+    current = count_tokens(tokenizer, ["User: 你好", "Assistant:"])
+    budget = 1 + 2 * PAIR_TOKENS + current + PAIR_TOKENS
+    prefix, rest = assemble(
+        rag="文件一", budget=budget, few_shot_budget=2 * PAIR_TOKENS
+    )
+    assert prefix == FEW_SHOT
+    # 剩下的預算只夠最近一輪對話，RAG 放不下
+    assert rest == ["User: 四", "Assistant: 丁", "User: 你好", "Assistant:"]
+
+
+def test_rag_skips_documents_that_do_not_fit():
+    _, rest = assemble(
+        rag="很長的文件" * 20 + "\n\n短文件", history=[], few_shot_budget=0, budget=120
+    )
+    assert rest == [rag_header, "短文件", "User: 你好", "Assistant:"]
+
+
+def test_clip_input_ids_keeps_bos_and_tail():
+    assert clip_input_ids([1, 2, 3], budget=5) == [1, 2, 3]
+    assert clip_input_ids([1, 2, 3, 4, 5, 6], budget=4) == [1, 4, 5, 6]
@@ -0,0 +1,127 @@
+import json
+import threading
+
+import pytest
+
+from train_model.result_store import (
+    MemoryResultStore,
+    SQLiteResultStore,
+    build_result,
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("train_model.result_store.time.time", lambda: now[0])
+    return now
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_store(request, tmp_path):
+    def make(**kwargs):
+        if request.param == "sqlite":
+            return SQLiteResultStore(str(tmp_path / "results.db"), **kwargs)
+        return MemoryResultStore(**kwargs)
+
+    return make
+
+
+def result(text: str) -> dict:
+    return build_result("你在幹嘛", [text])
+
+
+def nbytes(value: dict) -> int:
+    return len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+
+def test_pop_once(make_store):
+    store = make_store()
+    store.put("a", result("在家耍廢"))
+    assert store.pop("a") == result("在家耍廢")
+    assert store.pop("a") is None
+    assert store.stats()["used_bytes"] == 0
+
+
+def test_put_replaces_existing_result(make_store):
+    store = make_store()
+    store.put("a", result("一"))
+    store.put("a", result("一二三"))
+    stats = store.stats()
+    assert stats["entries"] == 1
+    assert stats["used_bytes"] == nbytes(result("一二三"))
+
+
+def test_ttl(make_store, clock):
+    store = make_store(ttl=10)
+    store.put("a", result("早"))
+    clock[0] += 5
+    store.put("b", result("安"))
+    clock[0] += 6
+    store.expire()
+    assert store.pop("a") is None
+    assert store.pop("b") == result("安")
+    assert store.stats()["expired"] == 1
+
+
+def test_stale_heap_entry_does_not_expire_live_result(make_store, clock):
+    store = make_store(ttl=10)
+    store.put("a", result("早"))
+    store.pop("a")
+    # a 留在到期 heap 上的舊項目已到期，不能連帶刪掉還沒到期的 b
+    clock[0] += 11
+    store.put("b", result("安"))
+    store.expire()
+    assert store.pop("b") == result("安")
+    assert store.stats()["expired"] == 0
+
+
+def test_budget_evicts_earliest_expiry(make_store, clock):
+    size = nbytes(result("早"))
+    store = make_store(max_bytes=2 * size)
+    for request_id in ("a", "b", "c"):
+        store.put(request_id, result("早"))
+        clock[0] += 1
+    stats = store.stats()
+    assert stats["evicted"] == 1
+    assert stats["entries"] == 2
+    assert stats["used_bytes"] == 2 * size
+    assert store.pop("a") is None
+    assert store.pop("c") == result("早")
+
+
+def test_deliver_at(make_store, clock):
+    store = make_store()
+    store.put("a", result("早安"), deliver_at=clock[0] + 3)
+    assert store.pop("a") is None
+    assert store.deliver_at("a") == clock[0] + 3
+    clock[0] += 3
+    assert store.deliver_at("a") is None
+    assert store.pop("a") == result("早安")
+
+
+def test_wait_pop_wakes_on_put(make_store):
+    store = make_store()
+    threading.Timer(0.05, store.put, args=("a", result("早"))).start()
+    assert store.wait_pop("a", timeout=5) == result("早")
+    assert store.wait_pop("b", timeout=0.01) is None
+
+
+def test_sqlite_byte_counter_survives_restart(tmp_path):
+    path = str(tmp_path / "results.db")
+    store = SQLiteResultStore(path)
+    store.put("a", result("早"))
+    store.put("b", result("早安"))
+    store.pop("a")
+
+    reopened = SQLiteResultStore(path)
+    assert reopened.stats()["used_bytes"] == nbytes(result("早安"))
+    assert reopened.pop("b") == result("早安")
+
+
+def test_build_result_errors():
+    assert build_result("嗨", None) == {
+        "status": "error",
+        "message": "Inference failed",
+    }
+    assert build_result("嗨", ["好"], error="Timeout")["message"] == "Timeout"
@@ -0,0 +1,39 @@
+import pytest
+
+from train_model.bench_sanitizer import (
+    GOLDEN_CASES,
+    fuzz_samples,
+    legacy_sanitize_response,
+)
+from train_model.sanitizer import limit_stickers, remove_tags, sanitize_response
+
+
+@pytest.mark.parametrize("generated_text, input_text, expected", GOLDEN_CASES)
+def test_golden(generated_text, input_text, expected):
+    assert sanitize_response(generated_text, input_text) == expected
+    assert legacy_sanitize_response(generated_text, input_text) == expected
+
+
+def test_fuzz_matches_legacy_replace_chain():
+    # 一半是把標記拆開、移除其他標記後才接起來的輸出
+    mismatches = [
+        sample
+        for sample in fuzz_samples(5000)
+        if sanitize_response(*sample) != legacy_sanitize_response(*sample)
+    ]
+    assert mismatches == []
+
+
+def test_tags_joined_after_removal():
+    # 移除 ANS 後接出排在後面的 User 會被移除，接出排在前面的 ANS 則保留
+    assert remove_tags("UsANSer hi") == "hi"
+    assert remove_tags("AN/S 好") == "ANS 好"
+
+
+def test_plain_text_skips_replace_chain():
+    assert remove_tags("  今天天氣很好  ") == "今天天氣很好"
+
+
+def test_limit_stickers():
+    assert limit_stickers("a[貼圖]b[貼圖]c") == "a[貼圖]bc"
+    assert limit_stickers("a[貼圖]b") == "a[貼圖]b"
@@ -0,0 +1,163 @@
+import queue
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from train_model import scheduler as scheduler_module
+from train_model.bench_scheduler import StubTokenizer
+from train_model.inference import cache_key_for, prefix_cache
+from train_model.prefix_cache import PrefixCache
+from train_model.scheduler import BatchScheduler, ChatRequest
+
+VOCAB_SIZE = 64
+# 長度不同的輸入，prompt 長度不一、併入 batch 時需要左補齊（不能是問候語）
+MESSAGES = [
+    "你在幹嘛",
+    "今天好嗎",
+    "晚餐要吃什麼呢",
+    "週末有空嗎",
+    "明天一起去看電影好不好",
+]
+
+
+class NewlineTokenizer(StubTokenizer):
+    """token id 27 解碼成換行，讓部分序列遇到停止標記提早結束、先移出 batch"""
+
+    eos_token_id = VOCAB_SIZE - 1
+
+    def __call__(self, text, **kwargs):
+        encoded = super().__call__(text, **kwargs)
+        encoded["input_ids"] = [i % (VOCAB_SIZE - 1) for i in encoded["input_ids"]]
+        return encoded
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        return "".join(
+            "\n" if token_id % 28 == 27 else chr(65 + token_id % 26)
+            for token_id in token_ids
+        )
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(1)
+    config = transformers.LlamaConfig(
+        vocab_size=VOCAB_SIZE,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=512,
+        initializer_range=0.2,
+    )
+    return transformers.LlamaForCausalLM(config).eval()
+
+
+@pytest.fixture(autouse=True)
+def greedy(monkeypatch):
+    # 固定取機率最高的 token，batch 與單獨生成的結果才能逐一比對
+    monkeypatch.setattr(
+        BatchScheduler, "_sample", lambda self, logits: logits.argmax(-1)
+    )
+    monkeypatch.setattr(scheduler_module, "max_new_tokens", 12)
+    prefix_cache.invalidate_model(cache_key_for("stub"))
+    yield
+    prefix_cache.invalidate_model(cache_key_for("stub"))
+
+
+def generate(model, max_batch_size, use_prefix=True, num_return_sequences=1):
+    request_queue = queue.Queue()
+    finished = {}
+    few_shot = ["User: 範例", "Assistant: 好"]
+
+    def prepare(input_text, user_id, session_history, tokenizer):
+        current = [f"User: {input_text}", "Assistant:"]
+        if use_prefix:
+            return few_shot, current
+        return [], few_shot + current
+
+    scheduler = BatchScheduler(
+        request_queue,
+        on_complete=lambda request, responses, error=None: finished.update(
+            {request.request_id: (request, responses, error)}
+        ),
+        max_batch_size=max_batch_size,
+        load_model=lambda model_dir, user_id: (model, NewlineTokenizer(), None),
+        prepare=prepare,
+        sanitize=lambda generated_text, input_text: generated_text or "-",
+        post_edit=None,
+        max_retries=1,
+    )
+    for i, message in enumerate(MESSAGES):
+        request = ChatRequest(str(i), "stub", "stub", message, str(i), [])
+        request.num_return_sequences = num_return_sequences
+        request_queue.put(request)
+    scheduler.run(stop_when_idle=True)
+
+    assert scheduler.batches == {}
+    return {
+        request_id: [request.token_ids[index] for index in sorted(request.token_ids)]
+        for request_id, (request, _, _) in finished.items()
+    }
+
+
+def test_batched_decode_matches_one_at_a_time(model):
+    alone = generate(model, max_batch_size=1)
+    batched = generate(model, max_batch_size=4)
+
+    assert set(batched) == {str(i) for i in range(len(MESSAGES))}
+    assert batched == alone
+    # 每個請求的輸出都不同，而且有序列遇到停止標記提早移出 batch，
+    # 其他序列繼續 decode 到 max_new_tokens
+    assert len({tuple(outputs[0]) for outputs in batched.values()}) == len(MESSAGES)
+    lengths = {len(token_ids) for outputs in batched.values() for token_ids in outputs}
+    assert len(lengths) > 1
+    assert max(lengths) == 12
+
+
+def test_return_sequences_share_the_prompt(model):
+    batched = generate(model, max_batch_size=8, num_return_sequences=2)
+    for first, second in batched.values():
+        assert first == second
+    assert {key: [outputs[0]] for key, outputs in batched.items()} == generate(
+        model, max_batch_size=1
+    )
+
+
+def test_prefix_reuse_matches_full_prefill(model):
+    full = generate(model, max_batch_size=4, use_prefix=False)
+    before = prefix_cache.stats()["prompt_tokens_saved"]
+    reused = generate(model, max_batch_size=4)
+
+    assert reused == full
+    # 第一個請求計算前綴並寫入快取，之後的請求直接從快取取得
+    assert prefix_cache.stats()["prompt_tokens_saved"] > before
+
+
+def test_prefix_is_dropped_when_ids_do_not_line_up(model):
+    tokenizer = NewlineTokenizer()
+    request = ChatRequest("0", "stub", "stub", "早", "0", [])
+    request.prefix = ["User: 範例", "Assistant: 好"]
+    request.chat = request.prefix + ["User: 早", "Assistant:"]
+    prefix_ids, input_ids = BatchScheduler._tokenize(None, request, tokenizer)
+    assert input_ids[: len(prefix_ids)] == prefix_ids
+    assert 0 < len(prefix_ids) < len(input_ids)
+
+    # prompt 被截斷時開頭對不上，不重用前綴
+    request.chat = request.prefix + ["User: " + "早" * 400, "Assistant:"]
+    assert BatchScheduler._tokenize(None, request, tokenizer)[0] == []
+
+
+def test_prefix_cache_invalidate_model():
+    cache = PrefixCache(budget_bytes=1 << 20)
+    kv = ((torch.zeros(1, 2, 3, 4), torch.zeros(1, 2, 3, 4)),)
+    cache.put(("a", (1, 2)), kv)
+    cache.put(("a", (1, 3)), kv)
+    cache.put(("b", (1, 2)), kv)
+
+    assert cache.stats()["used_bytes"] == 3 * 2 * 24 * 4
+    assert cache.invalidate_model("a") == 2
+    assert cache.get(("a", (1, 2))) is None
+    assert cache.get(("b", (1, 2))) is kv
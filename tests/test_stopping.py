@@ -0,0 +1,42 @@
+from train_model.stopping import StopStats, find_stop, truncate_at_stop
+
+STOPS = ["User:", "Assistant:", "\n"]
+
+
+def test_find_earliest_stop():
+    assert find_stop("在家耍廢 User: 你呢", STOPS) == 5
+    assert find_stop("好啊\nAssistant: 走", STOPS) == 2
+    assert find_stop("還沒有標記", STOPS) is None
+
+
+def test_leading_marker_is_not_a_stop():
+    # 模型一開頭先輸出換行或角色標記，不算空回答
+    assert find_stop("\nAssistant: 好啊", STOPS) is None
+    assert find_stop("Assistant: 好啊\nUser: 嗯", STOPS) == 13
+    assert find_stop("  \n\n好啊\n", STOPS) == 6
+
+
+def test_partial_marker_does_not_stop():
+    # 串流中還沒生成完的標記不會提早停止
+    assert find_stop("好啊 Use", STOPS) is None
+    assert find_stop("好啊 Use" + "r:", STOPS) == 3
+
+
+def test_truncate_at_stop():
+    assert truncate_at_stop("在家耍廢[User] 你呢") == "在家耍廢"
+    assert truncate_at_stop("問：你好") == "問：你好"
+    assert truncate_at_stop("好啊 [/INST] 問：") == "好啊 "
+    assert truncate_at_stop("沒有標記") == "沒有標記"
+
+
+def test_stop_stats():
+    stats = StopStats()
+    stats.record(generated=10, max_new_tokens=50, stopped=True)
+    stats.record(generated=50, max_new_tokens=50, stopped=False)
+    assert stats.stats() == {
+        "replies": 2,
+        "stopped_early": 1,
+        "tokens_generated": 60,
+        "tokens_saved": 40,
+        "tokens_saved_per_reply": 20.0,
+    }
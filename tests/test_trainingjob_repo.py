@@ -0,0 +1,132 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("flask_sqlalchemy")
+
+from flask import Flask
+from sqlalchemy.orm import Query
+
+from extensions import db
+from models.trained_model import TrainedModel  # noqa: F401  建立外鍵參照的資料表
+from models.training_file import TrainingFile  # noqa: F401
+from models.training_job import TrainingJob
+from models.user import User  # noqa: F401
+from repository.trainingjob_repo import TrainingJobRepo
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+def create_job(model_id: int) -> TrainingJob:
+    return TrainingJobRepo.create_job(
+        user_id=1,
+        model_id=model_id,
+        training_file_id=1,
+        base_model_dir="/srv/saved-taide-model",
+        save_dir=f"/srv/saved_models/{model_id}",
+        data_path="/srv/files/data.json",
+    )
+
+
+def make_stale(job: TrainingJob):
+    job.heartbeat_at = datetime.now(timezone.utc) - timedelta(hours=1)
+    TrainingJobRepo.save()
+
+
+def test_claim_in_fifo_order(app):
+    first, second = create_job(1), create_job(2)
+    assert TrainingJobRepo.queue_position(second) == 1
+
+    claimed = TrainingJobRepo.claim_next_job("cuda:0")
+    assert claimed.id == first.id
+    assert claimed.status == TrainingJob.RUNNING
+    assert claimed.device == "cuda:0"
+    assert claimed.attempts == 1
+    assert TrainingJobRepo.queue_position(second) == 0
+
+    assert TrainingJobRepo.claim_next_job("cuda:1").id == second.id
+    assert TrainingJobRepo.claim_next_job("cuda:0") is None
+
+
+def test_claim_loses_race(app, monkeypatch):
+    job = create_job(1)
+    original_update = Query.update
+    raced = []
+
+    # 另一個 process 在讀取與更新之間先把工作取走
+    def claimed_elsewhere(self, values, **kwargs):
+        if not raced:
+            raced.append(True)
+            TrainingJob.query.filter_by(id=job.id).update(
+                {"status": TrainingJob.RUNNING, "device": "cuda:1"},
+                synchronize_session=False,
+            )
+        return original_update(self, values, **kwargs)
+
+    monkeypatch.setattr(Query, "update", claimed_elsewhere)
+    assert TrainingJobRepo.claim_next_job("cuda:0") is None
+    monkeypatch.undo()
+
+    db.session.refresh(job)
+    assert job.device == "cuda:1"
+    assert job.attempts == 0
+
+
+def test_one_active_job_per_model(app):
+    job = create_job(1)
+    assert create_job(1) is None
+    assert TrainingJobRepo.find_active_job_by_model_id(1).id == job.id
+
+    TrainingJobRepo.claim_next_job("cuda:0")
+    assert create_job(1) is None
+
+    TrainingJobRepo.finish_job(job.id, TrainingJob.DONE)
+    assert TrainingJobRepo.find_active_job_by_model_id(1) is None
+    assert create_job(1) is not None
+
+
+def test_recover_stale_jobs(app):
+    retried, exhausted, cancelled, alive = (create_job(i) for i in range(1, 5))
+    for _ in range(4):
+        TrainingJobRepo.claim_next_job("cuda:0")
+    exhausted.attempts = 2
+    cancelled.cancel_requested = True
+    for job in (retried, exhausted, cancelled):
+        make_stale(job)
+    TrainingJobRepo.heartbeat([alive.id])
+
+    recovered = TrainingJobRepo.recover_stale_jobs(stale_after=60, max_attempts=2)
+
+    assert {job.id for job in recovered} == {retried.id, exhausted.id, cancelled.id}
+    assert retried.status == TrainingJob.QUEUED
+    assert retried.device is None
+    assert exhausted.status == TrainingJob.FAILED
+    assert exhausted.error_msg == "Training process exited unexpectedly"
+    assert cancelled.status == TrainingJob.CANCELLED
+    assert alive.status == TrainingJob.RUNNING
+
+    # 放回 queue 的工作再取一次時 attempts 累加
+    assert TrainingJobRepo.claim_next_job("cuda:1").id == retried.id
+    assert retried.attempts == 2
+
+
+def test_request_cancel(app):
+    running, queued = create_job(1), create_job(2)
+    TrainingJobRepo.claim_next_job("cuda:0")
+
+    assert TrainingJobRepo.request_cancel(queued)
+    assert queued.status == TrainingJob.CANCELLED
+    assert TrainingJobRepo.request_cancel(running)
+    assert running.status == TrainingJob.RUNNING
+    assert TrainingJobRepo.is_cancel_requested(running.id)
+    assert not TrainingJobRepo.request_cancel(queued)
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from train_model.usage_log import UsageLog
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("train_model.usage_log.time.time", lambda: now[0])
+    return now
+
+
+def test_top_orders_by_decayed_score(tmp_path, clock):
+    hot, cold = tmp_path / "hot", tmp_path / "cold"
+    hot.mkdir()
+    cold.mkdir()
+    log = UsageLog(str(tmp_path / "usage.json"), half_life=100)
+    for _ in range(3):
+        log.record(str(cold))
+    clock[0] += 200
+    log.record(str(hot))
+    log.record(str(hot))
+    # cold 的 3 分遞減兩個半衰期剩 0.75，比 hot 的 2 分低
+    assert log.top(2) == [str(hot), str(cold)]
+    # 已經不存在的目錄不會回傳
+    log.record(str(tmp_path / "deleted"))
+    assert str(tmp_path / "deleted") not in log.top(5)
+
+
+def test_decayed_entries_are_pruned(tmp_path, clock):
+    path = tmp_path / "usage.json"
+    log = UsageLog(str(path), half_life=100, min_score=0.1)
+    log.record("/srv/saved_models/old")
+    clock[0] += 300
+    log.record("/srv/saved_models/new")
+    log.save()
+    assert set(json.loads(path.read_text())) == {
+        "/srv/saved_models/old",
+        "/srv/saved_models/new",
+    }
+
+    # old 遞減到 1/16 < 0.1，儲存時移除
+    clock[0] += 100
+    log.save()
+    assert set(json.loads(path.read_text())) == {"/srv/saved_models/new"}
+
+    # 重新載入時也會清掉
+    clock[0] += 1000
+    assert len(UsageLog(str(path), half_life=100, min_score=0.1)) == 0
+
+
+def test_save_round_trip(tmp_path, clock):
+    path = str(tmp_path / "usage.json")
+    log = UsageLog(path)
+    log.record(str(tmp_path))
+    log.save()
+    assert not (tmp_path / "usage.json.tmp").exists()
+    assert UsageLog(path).top(1) == [str(tmp_path)]
@@ -0,0 +1,57 @@
+"""
+比較訓練資料在不同 padding 方式下 pad token 佔的比例，以及每個 epoch 實際送進模型的 token 數。
+
+    python -m train_model.bench_padding --data train_model/train.csv --sample 5000
+"""
+
+import argparse
+
+import pandas as pd
+from transformers import AutoTokenizer
+
+from train_model.finetune import (
+    BASE_MODEL_DIR,
+    CUTOFF_LEN,
+    TRAIN_BATCH_SIZE,
+    generate_prompt,
+    pad_token_ratio,
+    tokenize,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", default="train_model/train.csv")
+    parser.add_argument("--tokenizer", default=BASE_MODEL_DIR)
+    parser.add_argument("--sample", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=TRAIN_BATCH_SIZE)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    tokenizer.pad_token = tokenizer.eos_token
+
+    df = pd.read_csv(args.data).fillna("")
+    if args.sample and len(df) > args.sample:
+        df = df.sample(args.sample, random_state=42)
+    lengths = [
+        tokenize(tokenizer, generate_prompt(row))["length"]
+        for row in df.to_dict("records")
+    ]
+    real_tokens = sum(lengths)
+
+    print(
+        f"{len(lengths)} examples, mean length {real_tokens / len(lengths):.1f}, "
+        f"max {max(lengths)}, cutoff {CUTOFF_LEN}"
+    )
+    print(f"{'padding':<32}{'pad ratio':>10}{'tokens/epoch':>14}")
+    for name, kwargs in [
+        ("max_length (before)", {"dynamic": False}),
+        ("dynamic, random batches", {"group_by_length": False}),
+        ("dynamic + group_by_length", {}),
+    ]:
+        ratio = pad_token_ratio(lengths, args.batch_size, **kwargs)
+        print(f"{name:<32}{ratio:>10.3f}{int(real_tokens / (1 - ratio)):>14}")
+
+
+if __name__ == "__main__":
+    main()
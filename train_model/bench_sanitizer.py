@@ -0,0 +1,139 @@
+"""
+比較 sanitizer 與過去逐一 str.replace 的清理流程：先確認 golden 範例輸出完全相同，
+再以隨機組合的字串（一半是把一個標記拆開塞進另一個標記）比對一致率並量測速度。
+
+    python -m train_model.bench_sanitizer
+"""
+
+import random
+import sys
+import timeit
+
+from train_model.sanitizer import limit_stickers, sanitize_response, tags_to_remove
+
+
+def legacy_sanitize_response(generated_text: str, input_text: str) -> str:
+    """改寫前 inference() 內的清理流程"""
+    generated_text = limit_stickers(generated_text.strip())
+
+    if "Assistant:" in generated_text:
+        generated_text = generated_text.split("Assistant:")[-1].strip()
+
+    for tag in tags_to_remove:
+        generated_text = generated_text.replace(tag, "").strip()
+
+    if input_text in generated_text:
+        generated_text = generated_text.replace(input_text, "").strip()
+
+    return " ".join(line for line in generated_text.splitlines() if line.strip())
+
+
+# (模型輸出, 使用者輸入, 預期結果)
+GOLDEN_CASES = [
+    ("好啊 明天見", "要不要吃飯", "好啊 明天見"),
+    ("Assistant: 哈哈哈 對啊", "你看到了嗎", "哈哈哈 對啊"),
+    ("真的假的\nUser: 真的\nAssistant: 笑死", "他遲到了", "笑死"),
+    ("[/INST] 我在家 [貼圖]", "你在哪", "我在家 [貼圖]"),
+    ("回答：我也覺得 ANS", "這個好吃", "我也覺得"),
+    ("問題：什麼時候 答：下禮拜", "報告", "什麼時候 下禮拜"),
+    ("<<SYS>> INSTP 可以啊", "借我筆記", "可以啊"),
+    ("[User] 你呢 [Assistant] 還好", "最近好嗎", "你呢  還好"),
+    ("[貼圖][貼圖][貼圖]後面的字", "哈", "[貼圖]"),
+    ("好喔\\n: 等等見", "等等見", "好喔"),
+    ("(null) null 晚點說", "在嗎", "晚點說"),
+    ("11/20 要交 ERM [/D]", "作業", "1120 要交"),
+    ("ANCES ANCE 好 ANSION ANSE", "嗨嗨", "好 ION E"),
+    ("[照片] [貼文] [檔案] 給你看", "照片呢", "給你看"),
+    ("[你] [我] [輸入] 入題 吃了", "吃了嗎", "吃了"),
+    ("\n\n  ANTER 早安  \n\n  今天下雨  \n", "早", "安     今天下雨"),
+    ("好喔 ANCE [輸入]", "嗯", "好喔 ANCE"),
+    ("好喔 ANCE [照片]", "嗯", "好喔"),
+    ("ANTS 好 S] 喔", "hi", "好  喔"),
+    ("Assistant: User: Assistant:", "嗨", ""),
+    ("時間是 10:30", "幾點", "時間是 1030"),
+    # 移除一個標記後前後接成另一個標記
+    ("UsANSer hi", "嗨", "hi"),
+    ("nu/ll x", "嗨", "x"),
+    ("ANCE\\ 好", "嗨", "好"),
+    ("AN/S 好", "嗨", "ANS 好"),
+]
+
+FRAGMENTS = [
+    "好啊",
+    "明天",
+    "見",
+    "哈哈",
+    "[貼圖]",
+    " ",
+    "\n",
+    "吃飯",
+    "Assistant: ",
+    "User: ",
+    "10:30",
+]
+
+
+def random_output(rng: random.Random) -> str:
+    pieces = rng.choices(FRAGMENTS + tags_to_remove, k=rng.randint(1, 12))
+    return "".join(pieces)
+
+
+def split_tag_output(rng: random.Random) -> str:
+    """把一個標記從中間拆開、塞進另一個標記，移除裡面的標記後兩半會接回原本的標記"""
+    outer = rng.choice([tag for tag in tags_to_remove if len(tag) > 1])
+    cut = rng.randint(1, len(outer) - 1)
+    inner = rng.choice(tags_to_remove)
+    return random_output(rng) + outer[:cut] + inner + outer[cut:] + random_output(rng)
+
+
+def fuzz_samples(count: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    return [
+        (random_output(rng) if i % 2 else split_tag_output(rng), "吃飯")
+        for i in range(count)
+    ]
+
+
+def main() -> int:
+    failures = 0
+    for generated_text, input_text, expected in GOLDEN_CASES:
+        legacy = legacy_sanitize_response(generated_text, input_text)
+        result = sanitize_response(generated_text, input_text)
+        if not (legacy == result == expected):
+            failures += 1
+            print(
+                f"[FAIL] {generated_text!r}: legacy={legacy!r} "
+                f"sanitizer={result!r} expected={expected!r}"
+            )
+    print(f"golden: {len(GOLDEN_CASES) - failures}/{len(GOLDEN_CASES)} identical")
+
+    samples = fuzz_samples(20000)
+    mismatches = [
+        sample
+        for sample in samples
+        if legacy_sanitize_response(*sample) != sanitize_response(*sample)
+    ]
+    print(f"fuzz: {len(samples) - len(mismatches)}/{len(samples)} identical")
+    for generated_text, _ in mismatches[:3]:
+        print(f"[FAIL] {generated_text!r}")
+
+    realistic = [case[:2] for case in GOLDEN_CASES] * 50
+    for name, fn in (
+        ("legacy replace chain", legacy_sanitize_response),
+        ("compiled sanitizer", sanitize_response),
+    ):
+        seconds = min(
+            timeit.repeat(
+                lambda: [fn(text, input_text) for text, input_text in realistic],
+                number=20,
+                repeat=5,
+            )
+        )
+        per_call = seconds / (20 * len(realistic)) * 1e6
+        print(f"{name:>22}: {per_call:.2f} µs/call")
+
+    return 1 if failures or mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
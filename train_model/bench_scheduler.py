@@ -0,0 +1,115 @@
+"""
+用一個很小的隨機 Llama 模型量測 BatchScheduler 在不同 batch size 下的吞吐量與延遲。
+
+    python -m train_model.bench_scheduler --requests 32
+"""
+
+import argparse
+import queue
+import statistics
+import time
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from train_model.scheduler import BatchScheduler, ChatRequest
+
+VOCAB_SIZE = 1024
+
+
+class StubTokenizer:
+    """把每個字元對應到一個 token id，只提供 scheduler 需要的介面"""
+
+    eos_token_id = VOCAB_SIZE - 1
+
+    def __call__(self, text, return_tensors=None, add_special_tokens=True, **kwargs):
+        ids = [ord(ch) % (VOCAB_SIZE - 1) for ch in text]
+        if add_special_tokens:
+            ids = [1] + ids
+        return {"input_ids": ids, "attention_mask": [1] * len(ids)}
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        return "".join(chr(65 + token_id % 26) for token_id in token_ids)
+
+
+def build_stub_model():
+    config = LlamaConfig(
+        vocab_size=VOCAB_SIZE,
+        hidden_size=128,
+        intermediate_size=256,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=512,
+    )
+    model = LlamaForCausalLM(config)
+    model.eval()
+    return model
+
+
+def run_benchmark(max_batch_size: int, num_requests: int, model, tokenizer):
+    request_queue = queue.Queue()
+    finished = []
+
+    scheduler = BatchScheduler(
+        request_queue,
+        on_complete=lambda request, responses, error=None: finished.append(request),
+        max_batch_size=max_batch_size,
+        load_model=lambda model_dir, user_id: (model, tokenizer, None),
+        prepare=lambda input_text, user_id, session_history, tokenizer: (
+            [f"User: 範例{user_id % 2}", "Assistant: 好"],
+            [f"User: {input_text * (1 + user_id % 4)}", "Assistant:"],
+        ),
+        sanitize=lambda generated_text, input_text: generated_text or "-",
+        post_edit=None,
+    )
+
+    for i in range(num_requests):
+        request = ChatRequest(str(i), "stub", "stub", f"message {i}", i, [])
+        request.num_return_sequences = 1
+        request_queue.put(request)
+
+    start = time.perf_counter()
+    scheduler.run(stop_when_idle=True)
+    elapsed = time.perf_counter() - start
+
+    generated_tokens = sum(
+        len(token_ids) for request in finished for token_ids in request.token_ids.values()
+    )
+    latencies = sorted(request.finished_at - request.enqueued_at for request in finished)
+    first_token = [request.first_token_at - request.enqueued_at for request in finished]
+    return {
+        "batch_size": max_batch_size,
+        "requests": len(finished),
+        "tokens_per_s": generated_tokens / elapsed,
+        "requests_per_s": len(finished) / elapsed,
+        "p50_latency_s": statistics.median(latencies),
+        "p95_latency_s": latencies[int(len(latencies) * 0.95) - 1],
+        "mean_ttft_s": statistics.mean(first_token),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = build_stub_model()
+    tokenizer = StubTokenizer()
+
+    print(
+        f"{'batch':>5} {'req/s':>8} {'tok/s':>9} {'p50(s)':>8} {'p95(s)':>8} {'ttft(s)':>8}"
+    )
+    for batch_size in args.batch_sizes:
+        result = run_benchmark(batch_size, args.requests, model, tokenizer)
+        print(
+            f"{result['batch_size']:>5} {result['requests_per_s']:>8.2f} "
+            f"{result['tokens_per_s']:>9.1f} {result['p50_latency_s']:>8.3f} "
+            f"{result['p95_latency_s']:>8.3f} {result['mean_ttft_s']:>8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import copy
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+
+def fingerprint(payload: dict) -> str:
+    """
+    相同的請求會得到相同的 fingerprint：模型、使用者、正規化後的輸入與對話紀錄。
+    user_id 也算在內，因為 few-shot 與 RAG 內容是依使用者取得的。
+    """
+    normalized_input = " ".join(payload["input_text"].split())
+    data = json.dumps(
+        [
+            payload["model_dir"],
+            payload["modelname"],
+            payload["user_id"],
+            normalized_input,
+            payload.get("session_history", []),
+        ],
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+class RequestCoalescer:
+    """
+    合併重複的 /chat 請求。
+
+    - 同一個 fingerprint 已經在排程或生成中時，新的請求掛在原本的請求後面，
+      完成時共用同一份結果，不會再生成一次。
+    - reply_ttl > 0 時，成功的結果會保留 reply_ttl 秒，期間內相同的輸入直接回傳。
+    """
+
+    def __init__(self, reply_ttl: float = 0, reply_cache_size: int = 1024):
+        self.reply_ttl = reply_ttl
+        self.reply_cache_size = reply_cache_size
+        # fingerprint -> 排程或生成中的請求
+        self._in_flight: Dict[str, object] = {}
+        # fingerprint -> 掛在後面等待結果的請求
+        self._followers: Dict[str, List[object]] = {}
+        # fingerprint -> (結果, 寫入時間)
+        self._replies: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+
+    def submit(
+        self,
+        routed,
+        enqueue: Callable[[object], None],
+        hold: Optional[Callable[[object], None]] = None,
+    ) -> Optional[dict]:
+        """
+        送出請求：有快取的結果時直接回傳結果；重複的請求掛在原本的請求後面；
+        否則呼叫 enqueue 排進排程（enqueue 丟出 queue.Full 時不會留下任何記錄）。
+
+        掛在後面的請求不會經過 enqueue，改呼叫 hold 佔用 user 的排隊名額
+        （FairQueue.hold），同一個 user 不能靠重複送出同一句話繞過 per_user_limit；
+        hold 丟出 queue.Full 時同樣不會留下記錄。complete 回傳的請求要由呼叫端歸還名額。
+        """
+        routed.fingerprint = fingerprint(routed.payload)
+        with self._lock:
+            self.submitted += 1
+            reply = self._cached_reply(routed.fingerprint)
+            if reply is not None:
+                self.cache_hits += 1
+                return reply
+            if routed.fingerprint in self._in_flight:
+                if hold is not None:
+                    hold(routed)
+                self.coalesced += 1
+                self._followers.setdefault(routed.fingerprint, []).append(routed)
+                return None
+            enqueue(routed)
+            self._in_flight[routed.fingerprint] = routed
+            return None
+
+    def complete(self, routed, result: dict) -> List[object]:
+        """原本的請求完成時呼叫，回傳掛在它後面、要寫入同一份結果的請求"""
+        key = getattr(routed, "fingerprint", None)
+        if key is None:
+            return []
+        with self._lock:
+            if self._in_flight.get(key) is routed:
+                del self._in_flight[key]
+            followers = self._followers.pop(key, [])
+            if self.reply_ttl > 0 and result.get("status") == "success":
+                self._replies[key] = (result, time.time())
+                self._replies.move_to_end(key)
+                while len(self._replies) > self.reply_cache_size:
+                    self._replies.popitem(last=False)
+        return followers
+
+    def _cached_reply(self, key: str) -> Optional[dict]:
+        entry = self._replies.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[1] > self.reply_ttl:
+            del self._replies[key]
+            return None
+        self._replies.move_to_end(key)
+        return copy.deepcopy(entry[0])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": len(self._in_flight),
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "coalesced_ratio": self.coalesced / self.submitted if self.submitted else 0.0,
+                "reply_cache_entries": len(self._replies),
+                "reply_cache_hits": self.cache_hits,
+                "reply_cache_hit_ratio": (
+                    self.cache_hits / self.submitted if self.submitted else 0.0
+                ),
+            }
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Callable, List, Optional
+
+import datasets
+
+# tokenize 完的 Arrow dataset 存放位置，可以隨時整個刪掉，下次訓練會重新產生
+TOKENIZED_CACHE_DIR = os.getenv("TOKENIZED_CACHE_DIR", "./train_model/tokenized-cache")
+# 快取總大小與保留時間的上限，超過時從最久沒用到的開始刪除
+TOKENIZED_CACHE_MAX_BYTES = int(os.getenv("TOKENIZED_CACHE_MAX_BYTES", 5 << 30))
+TOKENIZED_CACHE_MAX_AGE = float(os.getenv("TOKENIZED_CACHE_MAX_AGE", 30 * 24 * 3600))
+# 寫到一半（process 崩潰）留下的暫存目錄超過這個時間就刪除
+STALE_TMP_AGE = 24 * 3600
+
+# 會影響 tokenizer 輸出的檔案，內容有變就視為不同的 tokenizer
+TOKENIZER_FILES = [
+    "tokenizer.json",
+    "tokenizer.model",
+    "tokenizer_config.json",
+    "special_tokens_map.json",
+    "added_tokens.json",
+]
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """以 tokenizer 的檔案內容識別；不是本機目錄時退回名稱、詞彙量與特殊 token"""
+    digest = hashlib.sha256()
+    digest.update(type(tokenizer).__name__.encode())
+    name_or_path = tokenizer.name_or_path
+    if os.path.isdir(name_or_path):
+        for filename in TOKENIZER_FILES:
+            path = os.path.join(name_or_path, filename)
+            if os.path.exists(path):
+                digest.update(filename.encode())
+                digest.update(file_sha256(path).encode())
+    else:
+        digest.update(name_or_path.encode())
+    digest.update(
+        json.dumps(
+            [len(tokenizer), tokenizer.eos_token_id, tokenizer.pad_token_id]
+        ).encode()
+    )
+    return digest.hexdigest()
+
+
+def cache_key(parts: List[object]) -> str:
+    return hashlib.sha256(
+        json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()[:32]
+
+
+def _dir_nbytes(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, filename))
+        for root, _, filenames in os.walk(path)
+        for filename in filenames
+    )
+
+
+def prune_cache(keep: str, now: Optional[float] = None) -> int:
+    """
+    刪除超過 TOKENIZED_CACHE_MAX_AGE 沒用到的快取，總大小仍超過 TOKENIZED_CACHE_MAX_BYTES 時
+    再從最久沒用到的開始刪（每次命中都會更新目錄的 mtime）。keep 是這次訓練使用的快取，不會被刪。
+    回傳刪除的數量。
+    """
+    if not os.path.isdir(TOKENIZED_CACHE_DIR):
+        return 0
+    now = now or time.time()
+    entries = []
+    removed = 0
+    for name in os.listdir(TOKENIZED_CACHE_DIR):
+        path = os.path.join(TOKENIZED_CACHE_DIR, name)
+        if not os.path.isdir(path) or name == keep:
+            continue
+        age = now - os.path.getmtime(path)
+        if ".tmp-" in name:
+            if age > STALE_TMP_AGE:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+            continue
+        if age > TOKENIZED_CACHE_MAX_AGE:
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+            continue
+        entries.append((os.path.getmtime(path), path, _dir_nbytes(path)))
+
+    keep_path = os.path.join(TOKENIZED_CACHE_DIR, keep)
+    total = sum(nbytes for _, _, nbytes in entries)
+    if os.path.isdir(keep_path):
+        total += _dir_nbytes(keep_path)
+    for _, path, nbytes in sorted(entries):
+        if total <= TOKENIZED_CACHE_MAX_BYTES:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= nbytes
+        removed += 1
+    if removed:
+        print(f"[INFO] Pruned {removed} tokenized dataset caches")
+    return removed
+
+
+def load_or_build(key: str, build: Callable[[], datasets.Dataset]) -> datasets.Dataset:
+    """
+    有快取時直接從磁碟載入（memory-mapped，不需要重新 tokenize），
+    否則呼叫 build 產生並寫入快取。先寫到暫存目錄再改名，
+    兩個訓練同時產生同一份快取或中途崩潰都不會留下寫到一半的 dataset。
+    每次使用後依大小與時間上限清理其他快取。
+    """
+    path = os.path.join(TOKENIZED_CACHE_DIR, key)
+    start = time.time()
+    if os.path.isdir(path):
+        try:
+            dataset = datasets.load_from_disk(path)
+            # mtime 當作最後使用時間，prune_cache 依此淘汰
+            os.utime(path)
+            prune_cache(key)
+            print(
+                f"[INFO] Loaded tokenized dataset from cache {path} "
+                f"in {time.time() - start:.1f}s"
+            )
+            return dataset
+        except Exception as e:
+            print(f"[WARN] Failed to load tokenized dataset cache {path}: {e}")
+            shutil.rmtree(path, ignore_errors=True)
+
+    dataset = build()
+    print(f"[INFO] Tokenized dataset in {time.time() - start:.1f}s")
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    try:
+        os.makedirs(TOKENIZED_CACHE_DIR, exist_ok=True)
+        dataset.save_to_disk(tmp_path)
+        os.replace(tmp_path, path)
+        prune_cache(key)
+    except OSError as e:
+        # 另一個訓練已經寫好同一份快取，或磁碟空間不足，都不影響這次訓練
+        print(f"[WARN] Failed to save tokenized dataset cache {path}: {e}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return dataset
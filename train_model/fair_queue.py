@@ -0,0 +1,176 @@
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional
+
+# 優先等級 -> 權重：兩個等級都有請求時，每 5 個請求有 4 個是 interactive
+DEFAULT_PRIORITY_WEIGHTS = {"interactive": 4, "batch": 1}
+
+
+class _PriorityClass:
+    def __init__(self, weight: int):
+        self.weight = weight
+        # smooth weighted round robin 的目前分數
+        self.current = 0
+        # user_id -> 該 user 排隊中的請求，依輪到的順序排列
+        self.users: "OrderedDict[object, Deque]" = OrderedDict()
+        self.size = 0
+
+
+class FairQueue:
+    """
+    取代單一 FIFO 的排程佇列，介面與 queue.Queue 相容（put_nowait / get / empty / task_done）。
+
+    - 每個 user 有自己的子佇列，同一個等級內的 user 輪流取出（round robin），
+      一個 user 連發很多則訊息也不會擋住其他人。
+    - 不同優先等級之間用 smooth weighted round robin，batch 不會被 interactive 完全餓死。
+    - maxsize 是所有請求的上限，per_user_limit 是單一 user 的上限（包含 hold 佔用的名額），
+      超過時丟出 queue.Full。
+    - 以 EWMA 記錄每筆請求的服務時間，用來估計新請求要等多久。
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 32,
+        per_user_limit: int = 4,
+        concurrency: int = 1,
+        weights: Optional[Dict[str, int]] = None,
+    ):
+        self.maxsize = maxsize
+        self.per_user_limit = per_user_limit
+        # 同時處理的請求數（scheduler 的 max_batch_size），估計等待時間用
+        self.concurrency = max(concurrency, 1)
+        self.classes = {
+            name: _PriorityClass(weight)
+            for name, weight in (weights or DEFAULT_PRIORITY_WEIGHTS).items()
+        }
+        self.default_priority = next(iter(self.classes))
+        self._user_sizes: Dict[object, int] = {}
+        self._size = 0
+        self._unfinished = 0
+        self._cond = threading.Condition()
+        self.service_time = 0.0
+        self.served = 0
+        self.rejected = 0
+
+    def put_nowait(self, item):
+        priority = getattr(item, "priority", self.default_priority)
+        priority_class = self.classes.get(priority) or self.classes[self.default_priority]
+        user_id = getattr(item, "user_id", None)
+        with self._cond:
+            if (
+                self._size >= self.maxsize
+                or self._user_sizes.get(user_id, 0) >= self.per_user_limit
+            ):
+                self.rejected += 1
+                raise queue.Full
+            priority_class.users.setdefault(user_id, deque()).append(item)
+            priority_class.size += 1
+            self._user_sizes[user_id] = self._user_sizes.get(user_id, 0) + 1
+            self._size += 1
+            self._unfinished += 1
+            self._cond.notify()
+
+    def hold(self, item):
+        """
+        佔用 item 所屬 user 的一個名額但不排進佇列（合併到重複請求後面、等待共用結果的請求），
+        超過 per_user_limit 時丟出 queue.Full。結果送出後要呼叫 release。
+        """
+        user_id = getattr(item, "user_id", None)
+        with self._cond:
+            if self._user_sizes.get(user_id, 0) >= self.per_user_limit:
+                self.rejected += 1
+                raise queue.Full
+            self._user_sizes[user_id] = self._user_sizes.get(user_id, 0) + 1
+
+    def release(self, item):
+        """歸還 hold 佔用的名額"""
+        user_id = getattr(item, "user_id", None)
+        with self._cond:
+            self._user_sizes[user_id] -= 1
+            if self._user_sizes[user_id] == 0:
+                del self._user_sizes[user_id]
+
+    def put(self, item, block: bool = True, timeout: Optional[float] = None):
+        self.put_nowait(item)
+
+    def get(self, block: bool = True, timeout: Optional[float] = None):
+        with self._cond:
+            if not block:
+                if self._size == 0:
+                    raise queue.Empty
+            elif not self._cond.wait_for(lambda: self._size > 0, timeout):
+                raise queue.Empty
+            item = self._pop()
+        item.dequeued_at = time.time()
+        return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def _pop(self):
+        # smooth weighted round robin：只在有請求的等級之間分配
+        candidates = [c for c in self.classes.values() if c.size > 0]
+        total = sum(c.weight for c in candidates)
+        for c in candidates:
+            c.current += c.weight
+        chosen = max(candidates, key=lambda c: c.current)
+        chosen.current -= total
+
+        # 同一個等級內，輪到的 user 取一筆後排到最後面
+        user_id, items = next(iter(chosen.users.items()))
+        item = items.popleft()
+        if items:
+            chosen.users.move_to_end(user_id)
+        else:
+            del chosen.users[user_id]
+        chosen.size -= 1
+
+        self._user_sizes[user_id] -= 1
+        if self._user_sizes[user_id] == 0:
+            del self._user_sizes[user_id]
+        self._size -= 1
+        return item
+
+    def task_done(self):
+        with self._cond:
+            self._unfinished -= 1
+
+    def empty(self) -> bool:
+        with self._cond:
+            return self._size == 0
+
+    def qsize(self) -> int:
+        with self._cond:
+            return self._size
+
+    def record_service_time(self, seconds: float, alpha: float = 0.2):
+        """請求完成時呼叫，seconds 是從被取出到完成的時間"""
+        with self._cond:
+            if self.served == 0:
+                self.service_time = seconds
+            else:
+                self.service_time += alpha * (seconds - self.service_time)
+            self.served += 1
+
+    def estimated_wait(self) -> float:
+        """新請求大約要等幾秒才會完成（排在前面的請求 + 自己）"""
+        with self._cond:
+            return (self._size + 1) * self.service_time / self.concurrency
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queued": self._size,
+                "maxsize": self.maxsize,
+                "per_user_limit": self.per_user_limit,
+                "users": len(self._user_sizes),
+                "classes": {
+                    name: {"queued": c.size, "users": len(c.users), "weight": c.weight}
+                    for name, c in self.classes.items()
+                },
+                "service_time_s": self.service_time,
+                "served": self.served,
+                "rejected": self.rejected,
+            }
@@ -0,0 +1,56 @@
+import os
+import threading
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+# 每個訓練檔取最後幾筆對話當作 few-shot 範例
+num_few_shot_samples = 5
+
+# training_file.id -> few-shot 的 prompt 行（"User: ..." / "Assistant: ..."）
+few_shot_cache: Dict[int, List[str]] = {}
+_lock = threading.Lock()
+
+
+def build_few_shot_block(path: str) -> List[str]:
+    """讀取訓練檔並組出 few-shot 區塊，只在上傳、訓練完成或快取 miss 時呼叫"""
+    if not os.path.exists(path):
+        return []
+
+    with open(path, "r") as f:
+        df = pd.read_csv(f)
+    df_sample = df.tail(n=num_few_shot_samples)
+
+    chat = []
+    for input_text, output_text in zip(df_sample["input"], df_sample["output"]):
+        chat.append(f"User: {input_text}")
+        chat.append(f"Assistant: {output_text}")
+    return chat
+
+
+def refresh_few_shot(training_file_id: int, path: str) -> List[str]:
+    """重新建立某個訓練檔的 few-shot 區塊（上傳新檔或訓練完成時呼叫）"""
+    try:
+        chat = build_few_shot_block(path)
+    except Exception as e:
+        print(f"[WARN] Failed to build few-shot block for file {training_file_id}: {e}")
+        chat = []
+    with _lock:
+        few_shot_cache[training_file_id] = chat
+    return chat
+
+
+def invalidate_few_shot(training_file_id: int):
+    """訓練檔被覆蓋或刪除時移除快取"""
+    with _lock:
+        few_shot_cache.pop(training_file_id, None)
+
+
+def get_few_shot(training_file_id: int, path: str) -> List[str]:
+    """取得 few-shot 區塊；快取中沒有時（例如剛重啟）才會讀檔一次"""
+    with _lock:
+        chat: Optional[List[str]] = few_shot_cache.get(training_file_id)
+    if chat is None:
+        print(f"[INFO] Few-shot cache miss for training file {training_file_id}")
+        chat = refresh_few_shot(training_file_id, path)
+    return chat
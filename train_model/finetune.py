@@ -1,12 +1,16 @@
 from transformers import (
+    DataCollatorForSeq2Seq,
     Trainer,
+    TrainerCallback,
     TrainingArguments,
     AutoModelForCausalLM,
     AutoTokenizer,
     BitsAndBytesConfig,
 )
+from transformers.trainer_pt_utils import get_length_grouped_indices
 from peft import (
     LoraConfig,
+    PeftModel,
     get_peft_model,
     prepare_model_for_kbit_training,
 )
@@ -14,14 +18,42 @@ import datasets
 import pandas as pd
 import torch
 import gc
+import json
+import os
+import time
+from typing import Callable, Dict, List, Optional
 
 
 from repository.trainedmodel_repo import TrainedModelRepo
 from repository.trainingfile_repo import TrainingFileRepo
+from train_model.dataset_cache import (
+    cache_key,
+    file_sha256,
+    load_or_build,
+    tokenizer_fingerprint,
+)
+from train_model.model_client import refresh_few_shot
+from train_model.packing import PackedCollator, PackedTrainer, pack_examples
+from train_model.training_base import ResidentBase
 
 CUTOFF_LEN = 512
+TRAIN_BATCH_SIZE = 8
+# collator 把 batch 補齊到 8 的倍數，對 tensor core 比較友善
+PAD_TO_MULTIPLE_OF = 8
+
+# tokenize 訓練資料使用的 process 數
+TOKENIZE_NUM_PROC = int(os.getenv("TOKENIZE_NUM_PROC", min(4, os.cpu_count() or 1)))
+# 把短對話接成 CUTOFF_LEN 的區塊訓練（train() 的 packing 參數未指定時使用）
+TRAINING_PACKING = os.getenv("TRAINING_PACKING", "false").lower() == "true"
 
-BASE_MODEL_DIR = "./train_model/saved-taide-model"
+# 可用 BASE_MODEL_DIR 換成很小的模型，在只有 CPU 的機器上壓測多個 inference worker
+BASE_MODEL_DIR = os.getenv("BASE_MODEL_DIR", "./train_model/saved-taide-model")
+
+# 連續的微調工作共用同一份量化後的 base model，閒置超過 TRAINING_BASE_IDLE_TIMEOUT 秒才釋放
+resident_bases = ResidentBase(
+    enabled=os.getenv("TRAINING_KEEP_BASE_RESIDENT", "true").lower() == "true",
+    idle_timeout=float(os.getenv("TRAINING_BASE_IDLE_TIMEOUT", 600)),
+)
 
 
 def cleanup_model(model):
@@ -30,33 +62,98 @@ def cleanup_model(model):
     torch.cuda.empty_cache()
 
 
-def tokenize(tokenizer, prompt, add_eos_token=True):
+def tokenize_batch(
+    tokenizer, prompts: List[str], add_eos_token=True
+) -> Dict[str, List[list]]:
+    """
+    一次 tokenize 多筆（fast tokenizer 在 Rust 端批次處理），
+    只截斷不補齊，padding 交給 collator 依每個 batch 最長的序列處理。
+    """
     result = tokenizer(
-        prompt,
+        prompts,
         truncation=True,
         max_length=CUTOFF_LEN,
-        padding="max_length",
+        padding=False,
         return_tensors=None,
     )
-    if (
-        result["input_ids"][-1] != tokenizer.eos_token_id
-        and len(result["input_ids"]) < CUTOFF_LEN
-        and add_eos_token
-    ):
-        result["input_ids"].append(tokenizer.eos_token_id)
-        result["attention_mask"].append(1)
+    for input_ids, attention_mask in zip(result["input_ids"], result["attention_mask"]):
+        if (
+            input_ids[-1] != tokenizer.eos_token_id
+            and len(input_ids) < CUTOFF_LEN
+            and add_eos_token
+        ):
+            input_ids.append(tokenizer.eos_token_id)
+            attention_mask.append(1)
 
-    result["labels"] = result["input_ids"].copy()
+    result = dict(result)
+    result["labels"] = [input_ids.copy() for input_ids in result["input_ids"]]
+    # group_by_length 依這個欄位把長度相近的樣本排在同一個 batch
+    result["length"] = [len(input_ids) for input_ids in result["input_ids"]]
 
     return result
 
 
+def tokenize(tokenizer, prompt, add_eos_token=True):
+    result = tokenize_batch(tokenizer, [prompt], add_eos_token)
+    return {key: values[0] for key, values in result.items()}
+
+
+def data_collator(tokenizer) -> DataCollatorForSeq2Seq:
+    """
+    每個 batch 補齊到該 batch 最長的序列；labels 的 padding 設為 -100 不計入 loss
+    （pad_token 就是 eos，不能用 DataCollatorForLanguageModeling，它會連 eos 一起遮掉）。
+    """
+    return DataCollatorForSeq2Seq(
+        tokenizer,
+        padding=True,
+        pad_to_multiple_of=PAD_TO_MULTIPLE_OF,
+        label_pad_token_id=-100,
+        return_tensors="pt",
+    )
+
+
+def pad_token_ratio(
+    lengths: List[int],
+    batch_size: int = TRAIN_BATCH_SIZE,
+    dynamic: bool = True,
+    group_by_length: bool = True,
+    seed: int = 42,
+) -> float:
+    """
+    估計一個 epoch 裡 pad token 佔全部 token 的比例。
+
+    - dynamic=False：每筆都補到 CUTOFF_LEN（舊的 padding="max_length"）。
+    - dynamic=True：每個 batch 補到最長的序列（再補到 PAD_TO_MULTIPLE_OF 的倍數），
+      group_by_length 時以 Trainer 相同的方式把長度相近的樣本分到同一個 batch。
+    """
+    if not lengths:
+        return 0.0
+    if not dynamic:
+        return 1 - sum(lengths) / (len(lengths) * CUTOFF_LEN)
+
+    generator = torch.Generator().manual_seed(seed)
+    if group_by_length:
+        indices = get_length_grouped_indices(lengths, batch_size, generator=generator)
+    else:
+        indices = torch.randperm(len(lengths), generator=generator).tolist()
+
+    padded = 0
+    for start in range(0, len(indices), batch_size):
+        batch = [lengths[i] for i in indices[start : start + batch_size]]
+        longest = -(-max(batch) // PAD_TO_MULTIPLE_OF) * PAD_TO_MULTIPLE_OF
+        padded += longest * len(batch)
+    return 1 - sum(lengths) / padded
+
+
+PROMPT_TEMPLATE_VERSION = 1
+
+
 def generate_prompt(data_point):
     instruction = data_point.get("instruction", "")
     input_text = data_point.get("input", "")
     output_text = data_point.get("output", "")
 
-    # 調整
+    # 調整（修改 prompt 時要更新 PROMPT_TEMPLATE_VERSION，已快取的 tokenize 結果才會失效）
     prompt = f"""<s>[INST] <<SYS>>請依照情境做正確、合理以及和過去類似語氣的回答。{instruction}<</SYS>>
         {input_text}
         [/INST]"""
@@ -64,10 +161,63 @@ def generate_prompt(data_point):
     return prompt + " " + output_text.strip() + "</s>"
 
 
-def train(
-    id: str, training_file_id: int, model_dir: str, save_dir: str, data_path: str
-):
-    device_map = "auto" if torch.cuda.is_available() else "cpu"
+def generate_and_tokenize_batch(batch: Dict[str, list], tokenizer) -> Dict[str, list]:
+    """dataset.map(batched=True) 用：batch 是 {欄位: [值, ...]}"""
+    rows = [dict(zip(batch, values)) for values in zip(*batch.values())]
+    return tokenize_batch(tokenizer, [generate_prompt(row) for row in rows])
+
+
+def load_tokenized_dataset(data_path: str, tokenizer) -> datasets.Dataset:
+    """
+    tokenize 訓練檔，結果依 (檔案內容、tokenizer、PROMPT_TEMPLATE_VERSION、CUTOFF_LEN)
+    快取在磁碟上，同一個檔案重新訓練或工作重跑時不需要再 tokenize。
+    """
+    key = cache_key(
+        [
+            file_sha256(data_path),
+            tokenizer_fingerprint(tokenizer),
+            PROMPT_TEMPLATE_VERSION,
+            CUTOFF_LEN,
+        ]
+    )
+
+    def build() -> datasets.Dataset:
+        dataset = datasets.Dataset.from_pandas(pd.read_csv(data_path))
+        num_proc = min(TOKENIZE_NUM_PROC, max(len(dataset) // 1000, 1))
+        if num_proc > 1:
+            # 已經用多個 process 平行，關掉 tokenizers 自己的執行緒避免 fork 後死結
+            os.environ["TOKENIZERS_PARALLELISM"] = "false"
+        return dataset.map(
+            generate_and_tokenize_batch,
+            batched=True,
+            batch_size=1000,
+            num_proc=num_proc if num_proc > 1 else None,
+            fn_kwargs={"tokenizer": tokenizer},
+        )
+
+    return load_or_build(key, build)
+
+
+class TrainingCancelled(Exception):
+    """使用者取消了訓練中的工作"""
+
+
+class StopTrainingCallback(TrainerCallback):
+    """每個 step 結束時詢問 should_stop，回傳 True 就停止訓練"""
+
+    def __init__(self, should_stop: Callable[[], bool]):
+        self.should_stop = should_stop
+        self.stopped = False
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self.should_stop():
+            self.stopped = True
+            control.should_training_stop = True
+        return control
+
+
+def load_training_base(model_dir: str, device_map) -> tuple:
+    """載入 4-bit 量化的 base model 並準備 k-bit 訓練，回傳 (model, tokenizer)"""
     nf4_config = BitsAndBytesConfig(
         load_in_4bit=True,
         bnb_4bit_quant_type="nf4",
@@ -89,21 +239,131 @@ def train(
         print("Failed to load model.")
 
     model = prepare_model_for_kbit_training(model)
+    return model, tokenizer
+
+
+def adapter_base_dir(model_dir: str) -> Optional[str]:
+    """model_dir 是上一次訓練存下的 adapter 時，回傳它的 base model 目錄"""
+    config_path = os.path.join(model_dir, "adapter_config.json")
+    if not os.path.exists(config_path):
+        return None
+    with open(config_path, "r", encoding="utf-8") as f:
+        return json.load(f).get("base_model_name_or_path") or BASE_MODEL_DIR
+
+
+def train(
+    id: str,
+    training_file_id: int,
+    model_dir: str,
+    save_dir: str,
+    data_path: str,
+    device: Optional[str] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+    packing: Optional[bool] = None,
+    on_started: Optional[Callable[[float, bool], None]] = None,
+):
+    """
+    device：TrainingScheduler 分配的裝置（例如 cuda:1），None 時由 accelerate 自動分配。
+    should_stop：回傳 True 時在下一個 step 停止並丟出 TrainingCancelled，不會存檔。
+    packing：把多筆短對話接成一個區塊訓練，None 時依 TRAINING_PACKING。
+    on_started：模型準備好、開始訓練前呼叫，參數為準備模型花的秒數與是否沿用常駐的 base。
+    """
+    if packing is None:
+        packing = TRAINING_PACKING
+    if device is not None:
+        device_map = {"": device}
+    else:
+        device_map = "auto" if torch.cuda.is_available() else "cpu"
 
-    peft_args = LoraConfig(
-        lora_alpha=16,
-        lora_dropout=0.05,
-        r=8,
-        bias="none",
-        task_type="CAUSAL_LM",
+    started_at = time.time()
+    # 從上一次的 adapter 繼續訓練時，常駐的是 adapter 底下的 base model
+    base_dir = adapter_base_dir(model_dir)
+    previous_adapter_dir = model_dir if base_dir is not None else None
+    base_dir = base_dir or model_dir
+    resident_key = (os.path.abspath(base_dir), str(device_map))
+    base_model, tokenizer, reused = resident_bases.acquire(
+        *resident_key, lambda: load_training_base(base_dir, device_map)
     )
 
-    model = get_peft_model(model, peft_args)
+    model = None
+    try:
+        if previous_adapter_dir is not None:
+            model = PeftModel.from_pretrained(
+                base_model, previous_adapter_dir, is_trainable=True
+            )
+        else:
+            peft_args = LoraConfig(
+                lora_alpha=16,
+                lora_dropout=0.05,
+                r=8,
+                bias="none",
+                task_type="CAUSAL_LM",
+            )
+            model = get_peft_model(base_model, peft_args)
 
+        startup_seconds = time.time() - started_at
+        print(
+            f"[INFO] Model ready in {startup_seconds:.1f}s "
+            f"({'resident base reused' if reused else 'base loaded'})"
+        )
+        if on_started is not None:
+            on_started(startup_seconds, reused)
+
+        _train_adapter(
+            model,
+            tokenizer,
+            id,
+            training_file_id,
+            save_dir,
+            data_path,
+            should_stop,
+            packing,
+        )
+    finally:
+        release_training_base(resident_key, base_model, model)
+        stats = resident_bases.stats()
+        print(
+            f"[INFO] Training base cache: {len(stats['resident'])} resident, "
+            f"{stats['loads']} loads, {stats['reuses']} reuses, "
+            f"{stats['saved_seconds']}s load time saved"
+        )
+
+
+def release_training_base(resident_key: tuple, base_model, model):
+    """把這次工作的 adapter 拔掉，讓 base 留給下一個工作；不是常駐的 base 直接釋放"""
+    if model is not None:
+        try:
+            # 移除 LoRA 層、換回原本的 Linear，base 的權重沒有被訓練改動
+            base_model = model.unload()
+            # get_peft_model 會把 peft_config 複製到 base 上，一併移除
+            if hasattr(base_model, "peft_config"):
+                del base_model.peft_config
+        except Exception as e:
+            print(f"[WARN] Failed to unload adapter, dropping training base: {e}")
+            resident_bases.discard(*resident_key, base_model)
+    del model
+    if not resident_bases.release(*resident_key, base_model):
+        cleanup_model(base_model)
+        return
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def _train_adapter(
+    model,
+    tokenizer,
+    id: str,
+    training_file_id: int,
+    save_dir: str,
+    data_path: str,
+    should_stop: Optional[Callable[[], bool]],
+    packing: bool,
+):
     training_args = TrainingArguments(
         output_dir=f"./ouput/{id}",
         num_train_epochs=3,
-        per_device_train_batch_size=8,
+        per_device_train_batch_size=TRAIN_BATCH_SIZE,
         gradient_accumulation_steps=2,
         learning_rate=3e-4,
         fp16=True,
@@ -114,26 +374,55 @@ def train(
         max_grad_norm=0.3,
         save_steps=25,
         logging_steps=25,
+        # packing 的區塊長度都差不多，不需要依長度分組
+        group_by_length=not packing,
+        # packing 需要保留 segment_ids 給 PackedTrainer 建立 attention mask
+        remove_unused_columns=not packing,
     )
 
-    def generate_and_tokenize_prompt(data_point):
-        full_prompt = generate_prompt(data_point)
-        tokenized_full_prompt = tokenize(tokenizer, full_prompt)
-        return tokenized_full_prompt
-
-    dataset = datasets.Dataset.from_pandas(pd.read_csv(data_path))
-    train_data = dataset.map(generate_and_tokenize_prompt, batched=False)
+    train_data = load_tokenized_dataset(data_path, tokenizer)
     print(f"[INFO] Dataset processed with {len(train_data)} examples.")
+    lengths = train_data["length"]
+    print(
+        f"[INFO] Pad token ratio: {pad_token_ratio(lengths, dynamic=False):.2f} "
+        f"with max_length padding, {pad_token_ratio(lengths):.2f} with dynamic "
+        f"padding and length grouping"
+    )
+
+    trainer_class = Trainer
+    collator = data_collator(tokenizer)
+    if packing:
+        num_examples = len(train_data)
+        train_data = train_data.map(
+            pack_examples,
+            batched=True,
+            batch_size=1000,
+            remove_columns=train_data.column_names,
+            fn_kwargs={"block_size": CUTOFF_LEN},
+        )
+        fill = sum(train_data["length"]) / (len(train_data) * CUTOFF_LEN)
+        print(
+            f"[INFO] Packed {num_examples} examples into {len(train_data)} blocks "
+            f"({num_examples / len(train_data):.1f} examples per block, "
+            f"{fill:.0%} filled)"
+        )
+        trainer_class = PackedTrainer
+        collator = PackedCollator(tokenizer.pad_token_id, PAD_TO_MULTIPLE_OF)
 
-    trainer = Trainer(
+    stop_callback = StopTrainingCallback(should_stop or (lambda: False))
+    trainer = trainer_class(
         model=model,
         train_dataset=train_data,
         tokenizer=tokenizer,
         args=training_args,
+        data_collator=collator,
+        callbacks=[stop_callback],
     )
 
     print("[INFO] Starting training...")
     trainer.train()
+    if stop_callback.stopped:
+        raise TrainingCancelled(f"Training job for model {id} was cancelled")
 
     print("[INFO] Saving model and tokenizer...")
     model.save_pretrained(save_dir)
@@ -142,8 +431,7 @@ def train(
     if training_file is not None:
         training_file.is_trained = True
         TrainingFileRepo.save_training_file()
+        refresh_few_shot(training_file.id, data_path)
     TrainedModelRepo.end_trainedmodel(id)
     # model.config.save_pretrained(save_dir)
-
-    cleanup_model(model)
     print("Training and saving completed.")
@@ -0,0 +1,43 @@
+import random
+
+# 問候語直接回覆同一句話，不需要經過模型（以小寫比對）
+greetings = frozenset(
+    greet.lower()
+    for greet in [
+        "晚上好",
+        "明天見",
+        "安安",
+        "午安",
+        "晚安",
+        "早安",
+        "早阿",
+        "早",
+        "你好",
+        "哈囉",
+        "嗨",
+        "掰掰",
+        "拜拜",
+        "掰",
+        "拜",
+        "掰囉",
+        "拜囉",
+        "掰掰囉",
+        "拜拜囉",
+        "再見",
+        "hello",
+        "hi",
+        "hey",
+        "good morning",
+        "good afternoon",
+        "good evening",
+    ]
+)
+
+
+def is_greeting(input_text: str) -> bool:
+    return input_text.lower().strip() in greetings
+
+
+def greeting_delay() -> float:
+    """問候語的回覆延遲幾秒才送出，讓回覆看起來像真人"""
+    return random.uniform(3, 7)
@@ -2,274 +2,316 @@ import os
 import random
 import torch
 import time
-import pandas as pd
+from contextlib import contextmanager
 from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModel
+from peft import LoraConfig, PeftModel, get_peft_model
 from repository.trainingfile_repo import TrainingFileRepo
-from train_model.trim import analyze_and_modify_response
-from typing import List
+from service.utils_controller import FILE_DIRECTORY
+from train_model.few_shot_cache import get_few_shot, refresh_few_shot
+from train_model.finetune import BASE_MODEL_DIR
+from train_model.memory import MemoryMonitor, relieve_memory_pressure
+from train_model.model_cache import ModelCache
+from train_model.prefix_cache import PrefixCache
+from train_model.prompt_builder import assemble_prompt
+from train_model.tracing import span
+from typing import List, Optional, Tuple
 from utils import chroma
 
 
-model_cache = {}
-model_usage_counter = {}
-max_cache_size = 3
-usage_threshold = 5
+# 所有使用者的 LoRA adapter 共用同一個 base model，只需載入一次
+base_model = None
+base_tokenizer = None
+# 載入時就掛上的空 adapter（不會被啟用），讓 base model 一開始就是 PeftModel
+PLACEHOLDER_ADAPTER = "base_placeholder"
 
-total_memory = torch.cuda.get_device_properties(0).total_memory
-threshold = int(total_memory * 0.75)
+# model server 會用 WORKER_DEVICE 指定每個 inference worker 使用的裝置（例如 cuda:1）
+device = torch.device(
+    os.getenv("WORKER_DEVICE") or ("cuda" if torch.cuda.is_available() else "cpu")
+)
+# GPU 量測 torch.cuda 的記憶體，CPU 量測 process RSS，兩種裝置都用同一套淘汰邏輯
+memory_monitor = MemoryMonitor(
+    device, high_watermark=float(os.getenv("MEMORY_HIGH_WATERMARK", 0.9))
+)
 
 
-def manage_model_cache():
-    global model_cache, model_usage_counter
+def evict_cached_model(key: str, value):
+    """
+    ModelCache 淘汰 entry 時的 callback：adapter 從 base model 卸載，完整模型直接釋放，
+    這個模型的 few-shot 前綴 KV cache 也一起移除，不必等 LRU 把它們擠出去。
+    """
+    if isinstance(value, str):
+        unload_adapter(key)
+    prefix_cache.invalidate_model(key)
+    memory_monitor.release()
 
-    current_memory = torch.cuda.memory_allocated()
-    print(
-        f"[INFO] Current memory allocated: {current_memory / 1e9:.2f} GB (Threshold: {threshold / 1e9:.2f} GB)"
+
+# adapter_name -> adapter 目錄；model_dir -> (model, tokenizer)（非 LoRA 的完整模型）
+model_cache = ModelCache(memory_monitor.cache_budget(), on_evict=evict_cached_model)
+for pinned_name in filter(None, os.getenv("PINNED_MODELS", "").split(",")):
+    model_cache.pin(pinned_name.strip().replace(".", "_"))
+
+
+# (模型, few-shot 前綴) -> past_key_values
+prefix_cache = PrefixCache(int(os.getenv("PREFIX_CACHE_BUDGET_BYTES", 1 << 30)))
+
+
+def model_nbytes(model, name_filter: Optional[str] = None) -> int:
+    """計算參數與 buffer 佔用的 byte 數，name_filter 用來只計算某個 adapter 的權重"""
+    tensors = list(model.named_parameters()) + list(model.named_buffers())
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for name, tensor in tensors
+        if name_filter is None or name_filter in name
     )
 
-    if current_memory >= threshold or len(model_cache) > max_cache_size:
-        print("[INFO] Memory or cache size exceeded. Cleaning up cache...")
-        least_used_models = sorted(model_usage_counter.items(), key=lambda x: x[1])
-        for user_id, _ in least_used_models:
-            if user_id in model_cache:
-                print(f"[INFO] Removing model for user_id: {user_id}")
-                del model_cache[user_id]
-                del model_usage_counter[user_id]
-                torch.cuda.empty_cache()
 
-                current_memory = torch.cuda.memory_allocated()
-                if current_memory < threshold and len(model_cache) <= max_cache_size:
-                    break
+def is_adapter_dir(model_dir: str) -> bool:
+    return os.path.exists(os.path.join(model_dir, "adapter_config.json"))
 
 
-def load_model_for_user(model_dir: str, user_id: str):
-    global model_cache, model_usage_counter
+def adapter_name_for(model_dir: str) -> str:
+    # PEFT 的 adapter 名稱不能包含 "."，saved_models 底下的目錄名稱是 uuid
+    return os.path.basename(os.path.normpath(model_dir)).replace(".", "_")
 
-    if user_id in model_cache:
-        print(f"[INFO] Using cached model for user_id: {user_id}")
-        model_usage_counter[user_id] += 1
-        manage_model_cache()
-        return model_cache[user_id]
 
-    print(f"[INFO] Loading model for user_id: {user_id}")
-    model = AutoModelForCausalLM.from_pretrained(model_dir)
+def cache_key_for(model_dir: str) -> str:
+    if is_adapter_dir(model_dir):
+        return adapter_name_for(model_dir)
+    return os.path.abspath(model_dir)
+
+
+def free_memory():
+    """生成時記憶體不足：淘汰最久沒用到的模型並釋放快取的記憶體"""
+    model_cache.evict_lru()
+    memory_monitor.release()
+
+
+def pin_model(model_dir: str):
+    model_cache.pin(cache_key_for(model_dir))
+
+
+def unpin_model(model_dir: str):
+    model_cache.unpin(cache_key_for(model_dir))
+
+
+def loaded_model_dirs() -> List[str]:
+    """目前已載入的模型目錄（絕對路徑），model server 依此把請求送到已經有該模型的 worker"""
+    model_dirs = [
+        os.path.abspath(value) if isinstance(value, str) else key
+        for key, value in model_cache.items()
+    ]
+    if base_model is not None:
+        model_dirs.append(os.path.abspath(BASE_MODEL_DIR))
+    return model_dirs
+
+
+def load_base_model():
+    """載入共用的 base model 與 tokenizer（只會載入一次）"""
+    global base_model, base_tokenizer
+
+    if base_model is None:
+        print(f"[INFO] Loading shared base model from {BASE_MODEL_DIR}")
+        model = AutoModelForCausalLM.from_pretrained(BASE_MODEL_DIR)
+        model.to(device)
+        model.eval()
+        base_tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_DIR)
+
+        if not os.getenv("MODEL_CACHE_BUDGET_BYTES"):
+            # base model 常駐，不算在快取內，預算要扣掉它
+            model_cache.set_budget(
+                max(model_cache.budget_bytes - model_nbytes(model), 0)
+            )
+
+        # 第一個 adapter 才包成 PeftModel 的話，PEFT 會直接改寫原本的模組，
+        # 正在 decode、拿著原始模型的 base model batch 會被套上新的 LoRA 權重。
+        # 載入時就包好，base model 與所有 adapter 的請求都使用同一個物件，
+        # base model 的請求由 adapter_context 以 disable_adapter() 停用 adapter。
+        base_model = get_peft_model(
+            model,
+            LoraConfig(r=1, task_type="CAUSAL_LM"),
+            adapter_name=PLACEHOLDER_ADAPTER,
+        )
+        base_model.eval()
+
+    return base_model, base_tokenizer
+
 
-    adapter_config_path = os.path.join(model_dir, "adapter_config.json")
-    if os.path.exists(adapter_config_path):
-        if not hasattr(model, "peft_config"):
-            model = PeftModel.from_pretrained(model, model_dir)
+def attach_adapter(model_dir: str) -> str:
+    """把 model_dir 的 LoRA adapter 掛到共用 base model 上，回傳 adapter 名稱"""
+    adapter_name = adapter_name_for(model_dir)
+    if model_cache.get(adapter_name) is not None:
+        return adapter_name
+
+    model, _ = load_base_model()
+    print(f"[INFO] Attaching adapter {adapter_name} from {model_dir}")
+    model.load_adapter(model_dir, adapter_name=adapter_name)
+    base_model.to(device)
+    base_model.eval()
+
+    nbytes = model_nbytes(base_model, name_filter=f".{adapter_name}.")
+    model_cache.put(adapter_name, model_dir, nbytes)
+    relieve_memory_pressure(memory_monitor, model_cache, keep=adapter_name)
+
+    return adapter_name
+
+
+def unload_adapter(adapter_name: str):
+    """從 base model 上移除 adapter"""
+    if adapter_name == PLACEHOLDER_ADAPTER:
+        return
+    if isinstance(base_model, PeftModel) and adapter_name in base_model.peft_config:
+        print(f"[INFO] Unloading adapter {adapter_name}")
+        base_model.delete_adapter(adapter_name)
+
+
+@contextmanager
+def adapter_context(model, adapter_name: Optional[str]):
+    """在 with 區塊內啟用指定的 adapter；adapter_name 為 None 時停用所有 adapter"""
+    if not isinstance(model, PeftModel):
+        yield model
+    elif adapter_name is not None:
+        model.set_adapter(adapter_name)
+        yield model
     else:
-        print(f"No PEFT adapter found in {model_dir}. Loading base model.")
+        with model.disable_adapter():
+            yield model
+
+
+def load_model_for_user(model_dir: str, user_id: str):
+    """
+    取得 user 要使用的模型。
+
+    saved_models 底下的 LoRA 目錄會掛到共用的 base model 上並切換成該 adapter；
+    只有在 model_dir 是完整模型（非 base、也沒有 adapter_config.json）時才會整個載入。
 
-    model.to(torch.device("cuda" if torch.cuda.is_available() else "cpu"))
+    Returns:
+    - (model, tokenizer, adapter_name)：adapter_name 為 None 代表不使用 adapter。
+    """
+    with span("load_model") as attrs:
+        attrs["cache_hit"] = os.path.abspath(model_dir) in loaded_model_dirs()
+        return _load_model_for_user(model_dir, user_id)
+
+
+def _load_model_for_user(model_dir: str, user_id: str):
+    if is_adapter_dir(model_dir):
+        adapter_name = attach_adapter(model_dir)
+        return base_model, base_tokenizer, adapter_name
+
+    if os.path.abspath(model_dir) == os.path.abspath(BASE_MODEL_DIR):
+        model, tokenizer = load_base_model()
+        return model, tokenizer, None
+
+    key = cache_key_for(model_dir)
+    cached = model_cache.get(key)
+    if cached is not None:
+        print(f"[INFO] Using cached model for user_id: {user_id}")
+        model, tokenizer = cached
+        return model, tokenizer, None
+
+    print(f"No PEFT adapter found in {model_dir}. Loading full model.")
+    model = AutoModelForCausalLM.from_pretrained(model_dir)
+    model.to(device)
     model.eval()
 
     tokenizer = AutoTokenizer.from_pretrained(model_dir)
 
-    model_cache[user_id] = (model, tokenizer)
-    model_usage_counter[user_id] = 1
-
-    manage_model_cache()
-
-    return model, tokenizer
-
-
-def limit_stickers(text: str) -> str:
-    max_stickers = 2
-    sticker_tokens = text.split("[貼圖]")
-    if len(sticker_tokens) > max_stickers:
-        text = "[貼圖]".join(sticker_tokens[:max_stickers]) + sticker_tokens[max_stickers]
-
-    return text
-
-
-def inference(
-    model_dir: str,
-    modelname: str,
-    input_text: str,
-    user_id: str,
-    session_history: List[dict],
-    max_retries: int = 3,
-) -> List[str] | None:
-    try:
-        greetings = [
-            "晚上好",
-            "明天見",
-            "安安",
-            "午安",
-            "晚安",
-            "早安",
-            "早阿",
-            "早",
-            "你好",
-            "哈囉",
-            "嗨",
-            "掰掰",
-            "拜拜",
-            "掰",
-            "拜",
-            "掰囉",
-            "拜囉",
-            "掰掰囉",
-            "拜拜囉",
-            "再見",
-            "hello",
-            "hi",
-            "hey",
-            "good morning",
-            "good afternoon",
-            "good evening",
-        ]
-
-        if input_text.lower().strip() in [greet.lower() for greet in greetings]:
-            delay_seconds = random.uniform(3, 7)
-            time.sleep(delay_seconds)
-            return [input_text]
-
-        model, tokenizer = load_model_for_user(model_dir, user_id)
-
-        chat = []
+    model_cache.put(key, (model, tokenizer), model_nbytes(model))
+    relieve_memory_pressure(memory_monitor, model_cache, keep=key)
+
+    return model, tokenizer, None
+
+
+# 生成參數，BatchScheduler 與預熱共用
+max_new_tokens = 50
+top_k = 30
+top_p = 0.85
+temperature = 0.7
+
+
+def choose_num_return_sequences() -> int:
+    # 一半的機率回兩句
+    return 2 if random.random() < 0.5 else 1
+
+
+def training_file_path(filename: str) -> str:
+    return os.path.join(FILE_DIRECTORY, filename)
+
+
+def warm_few_shot_cache():
+    """啟動時先把所有訓練檔的 few-shot 區塊建好，聊天時就不需要讀檔"""
+    for training_file in TrainingFileRepo.get_all_trainingfile():
+        refresh_few_shot(training_file.id, training_file_path(training_file.filename))
+
+
+def warm_up(model_dirs: List[str]) -> dict:
+    """
+    啟動時先載入 base model 與常用的模型，各跑一次很短的生成，
+    讓 CUDA kernel、cuBLAS handle 等在第一個使用者請求之前就初始化完成。
+
+    Returns:
+    - {model_dir: 載入加生成的秒數}，載入失敗的模型不會中斷其他模型的預熱。
+    """
+    timings = {}
+    start = time.time()
+    load_base_model()
+    base_dir = os.path.abspath(BASE_MODEL_DIR)
+    timings[base_dir] = time.time() - start
+
+    # 最常聊天的模型可能就是 base model，上面已經預熱過，不再載入與生成一次
+    other_dirs = [d for d in model_dirs if os.path.abspath(d) != base_dir]
+    for model_dir in [base_dir] + other_dirs:
+        start = time.time()
+        try:
+            model, tokenizer, adapter_name = load_model_for_user(model_dir, "warm-up")
+            input_ids = torch.tensor(
+                [tokenizer("User: 你好\nAssistant:")["input_ids"]], device=model.device
+            )
+            with torch.no_grad(), adapter_context(model, adapter_name):
+                model.generate(
+                    input_ids=input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    do_sample=True,
+                    max_new_tokens=2,
+                    top_k=top_k,
+                    top_p=top_p,
+                    temperature=temperature,
+                )
+        except Exception as e:
+            print(f"[WARN] Failed to warm up {model_dir}: {e}")
+            continue
+        timings[model_dir] = timings.get(model_dir, 0.0) + time.time() - start
+        print(f"[INFO] Warmed up {model_dir} in {timings[model_dir]:.1f}s")
+    return timings
+
+
+def build_prompt_parts(
+    input_text: str, user_id: str, session_history: List[dict], tokenizer
+) -> Tuple[List[str], List[str]]:
+    """
+    組出 prompt 的每一行，分成兩段：
+
+    - 固定的前綴：訓練檔的 few-shot 對話，同一個訓練檔每次都一樣，可以重用 KV cache。
+    - 動態的部分：RAG 內容、這次 session 的對話紀錄與這次的輸入。
+
+    各段落依優先順序放進 prompt_token_budget，詳見 assemble_prompt。
+    """
+    few_shot = []
+    with span("few_shot"):
         user_history = TrainingFileRepo.find_trainingfile_by_user_id(user_id=user_id)
         if isinstance(user_history, list) and user_history:
             training_file = random.choice(user_history)
         else:
             training_file = user_history
 
-        if training_file and os.path.exists(training_file.filename):
-            with open(training_file.filename, "r") as f:
-                df = pd.read_csv(f)
-            num_samples = 5
-            if len(df) > num_samples:
-                df_sample = df.tail(n=num_samples)
-            else:
-                df_sample = df
-
-            for _, row in df_sample.iterrows():
-                chat.append(f"User: {row['input']}")
-                chat.append(f"Assistant: {row['output']}")
+        if training_file:
+            few_shot = get_few_shot(
+                training_file.id, training_file_path(training_file.filename)
+            )
 
+    with span("retrieval"):
         rag_content = chroma.retrive_n_results(user_id=user_id, query_texts=input_text)
-        if rag_content:
-            chat.append("System: 以下是檢索到跟使用者相關內容，如果對話提及相關話題可以參考：")
-            chat.append(rag_content)
-        chat.append(f"User: {input_text}")
-        chat.append("Assistant:")
-
-        prompt = "\n".join(chat)
-
-        inputs = tokenizer(
-            prompt, return_tensors="pt", padding=True, truncation=True, max_length=256
-        ).to(model.device)
-
-        for attempt in range(max_retries):
-            try:
-                generate_two_responses = random.random() < 0.5
-                num_return_sequences = 2 if generate_two_responses else 1
-
-                with torch.no_grad():
-                    outputs = model.generate(
-                        input_ids=inputs["input_ids"],
-                        attention_mask=inputs["attention_mask"],
-                        do_sample=True,
-                        # max_length=150,
-                        max_new_tokens=50,
-                        top_k=30,
-                        top_p=0.85,
-                        temperature=0.7,
-                        num_return_sequences=num_return_sequences,
-                    )
-
-                responses = []
-                for i, output in enumerate(outputs):
-                    generated_text = tokenizer.decode(
-                        output, skip_special_tokens=True
-                    ).strip()
-                    generated_text = limit_stickers(generated_text)
-
-                    if "Assistant:" in generated_text:
-                        generated_text = generated_text.split("Assistant:")[-1].strip()
-
-                    tags_to_remove = [
-                        "ANTER",
-                        "問：",
-                        "問題：",
-                        "入題",
-                        "回答：",
-                        "答：",
-                        "問題：",
-                        "入題",
-                        "回答：",
-                        "[入戲]",
-                        "ANCES",
-                        "ANS",
-                        "ANSE",
-                        "ANSION",
-                        "ANTS",
-                        "[檔案]",
-                        "<<SYS>>",
-                        "INSTP",
-                        "[/INST]",
-                        "INST",
-                        "[You]",
-                        "[User]",
-                        "User",
-                        "[Assistant]",
-                        "Assistant",
-                        "\\n:",
-                        "\\",
-                        ":",
-                        "[你]",
-                        "[我]",
-                        "[輸入]",
-                        "ERM [/D]",
-                        "ANCE ",
-                        "S]",
-                        "\\",
-                        "/",
-                        "(null)",
-                        "null",
-                        "[貼文]",
-                        "[照片]",
-                    ]
-                    for tag in tags_to_remove:
-                        generated_text = generated_text.replace(tag, "").strip()
-
-                    if input_text in generated_text:
-                        generated_text = generated_text.replace(input_text, "").strip()
-
-                    generated_text = " ".join(
-                        line for line in generated_text.splitlines() if line.strip()
-                    )
-
-                    generated_text = analyze_and_modify_response(
-                        input_text, generated_text, modelname, chat, session_history
-                    )
-                    responses.append(generated_text)
-
-                    if any(responses):
-                        return responses
-
-                    print(f"[WARN] Attempt {attempt + 1}: Empty response. Retrying...")
-                    time.sleep(1)
-
-            except torch.cuda.OutOfMemoryError:
-                print(
-                    f"[ERROR] CUDA Out of Memory during attempt {attempt + 1}. Cleaning up..."
-                )
-                torch.cuda.empty_cache()
-                time.sleep(2)
-            except Exception as e:
-                if "524" in str(e):
-                    print(
-                        f"[WARN] 524 Timeout encountered on attempt {attempt + 1}. Retrying..."
-                    )
-                else:
-                    print(f"[ERROR] Inference attempt {attempt + 1} failed: {e}")
-
-            print("[ERROR] All inference attempts failed or returned empty responses.")
-            return None
-
-    except Exception as e:
-        print(f"Error in inference: {e}")
-        return None
+
+    with span("assemble_prompt"):
+        return assemble_prompt(
+            tokenizer, input_text, few_shot, rag_content, session_history
+        )
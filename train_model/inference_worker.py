@@ -0,0 +1,168 @@
+"""
+model server 底下的 inference worker process。
+
+每個 worker 使用一個裝置（GPU 或 CPU），有自己的 base model、模型快取與 BatchScheduler，
+透過 Pipe 接收 model server 分派的請求，並回傳 token 事件、結果與已載入的模型。
+啟動時先預熱 model server 指定的常用模型，完成後狀態的 ready 才會變成 True。
+"""
+
+import os
+import queue
+import threading
+import time
+from typing import List, Optional
+
+from flask import Flask
+
+from extensions import db
+from train_model.result_store import build_result
+from train_model.streamer import ChatStreamer
+
+# 每隔幾秒回報一次狀態（請求完成時也會回報）
+STATUS_INTERVAL = 5
+
+
+class WorkerConnection:
+    """worker 端的 Pipe，scheduler、GPT 修正的 callback 與狀態回報會從不同執行緒送出"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._lock = threading.Lock()
+
+    def send(self, message: tuple):
+        with self._lock:
+            self.conn.send(message)
+
+
+class _PipeEvents:
+    """取代 ChatStreamer 的事件佇列，put 時直接送給 model server"""
+
+    def __init__(self, connection: WorkerConnection, request_id: str):
+        self.connection = connection
+        self.request_id = request_id
+
+    def put(self, item: tuple):
+        event, data = item
+        self.connection.send(("event", self.request_id, event, data))
+
+
+class PipeStreamer(ChatStreamer):
+    """在 worker 內把 token 轉成文字片段，經由 Pipe 轉送給 model server 的 SSE 連線"""
+
+    def __init__(self, connection: WorkerConnection, request_id: str):
+        super().__init__(timeout=None)
+        self.events = _PipeEvents(connection, request_id)
+
+
+def create_app() -> Flask:
+    """只初始化資料庫，inference 需要查詢訓練檔"""
+    app = Flask(__name__)
+    app.config.from_prefixed_env()
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+    return app
+
+
+def run_worker(
+    index: int,
+    device: Optional[str],
+    max_batch_size: int,
+    warm_up_dirs: List[str],
+    conn,
+):
+    """worker process 的進入點（multiprocessing spawn）"""
+    # 必須在 import inference 之前設定，inference 在 import 時決定裝置與快取預算
+    if device:
+        os.environ["WORKER_DEVICE"] = device
+
+    from train_model.few_shot_cache import invalidate_few_shot, refresh_few_shot
+    from train_model.inference import (
+        loaded_model_dirs,
+        memory_monitor,
+        model_cache,
+        prefix_cache,
+        warm_few_shot_cache,
+        warm_up,
+    )
+    from train_model.post_edit import post_edit_stage
+    from train_model.scheduler import BatchScheduler, ChatRequest
+    from train_model.stopping import stop_stats
+
+    connection = WorkerConnection(conn)
+    request_queue: "queue.Queue[ChatRequest]" = queue.Queue()
+    # 預熱完成前收到的請求會先留在 request_queue
+    ready = False
+    warm_up_seconds: dict = {}
+
+    def status() -> dict:
+        return {
+            "ready": ready,
+            "warm_up_seconds": warm_up_seconds,
+            "loaded": loaded_model_dirs(),
+            "model_cache": model_cache.stats(),
+            "memory": memory_monitor.stats(),
+            "prefix_cache": prefix_cache.stats(),
+            "post_edit": post_edit_stage.stats(),
+            "stopping": stop_stats.stats(),
+        }
+
+    def on_complete(
+        chat_request: ChatRequest,
+        responses: Optional[List[str]],
+        error: Optional[str] = None,
+    ):
+        result = build_result(chat_request.input_text, responses, error)
+        connection.send(
+            ("done", chat_request.request_id, result, chat_request.trace.spans)
+        )
+        connection.send(("status", status()))
+
+    def read_commands():
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                # model server 已經結束
+                os._exit(0)
+            op = message[0]
+            if op == "request":
+                _, payload, stream = message
+                chat_request = ChatRequest(**payload)
+                if stream:
+                    chat_request.streamer = PipeStreamer(
+                        connection, chat_request.request_id
+                    )
+                request_queue.put(chat_request)
+            elif op == "refresh_few_shot":
+                refresh_few_shot(message[1], message[2])
+            elif op == "invalidate_few_shot":
+                invalidate_few_shot(message[1])
+
+    def report_status():
+        while True:
+            time.sleep(STATUS_INTERVAL)
+            connection.send(("status", status()))
+
+    app = create_app()
+    with app.app_context():
+        threading.Thread(target=read_commands, daemon=True).start()
+        threading.Thread(target=report_status, daemon=True).start()
+        connection.send(("status", status()))
+
+        start = time.time()
+        warm_few_shot_cache()
+        warm_up_seconds.update(warm_up(warm_up_dirs))
+        scheduler = BatchScheduler(
+            request_queue, on_complete=on_complete, max_batch_size=max_batch_size
+        )
+        ready = True
+        print(
+            f"[INFO] Inference worker {index} ready on {device or 'default device'} "
+            f"after {time.time() - start:.1f}s warm-up ({len(warm_up_seconds)} models)"
+        )
+        connection.send(("status", status()))
+        while True:
+            try:
+                scheduler.run()
+            except Exception as e:
+                print(f"[ERROR] Error in inference worker {index}: {str(e)}")
@@ -0,0 +1,121 @@
+import gc
+import os
+import resource
+from typing import Optional
+
+import torch
+
+
+def physical_memory_bytes() -> int:
+    """實體記憶體大小；在容器裡以 cgroup 的記憶體上限為準"""
+    total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    for path in (
+        "/sys/fs/cgroup/memory.max",  # cgroup v2
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",  # cgroup v1
+    ):
+        try:
+            with open(path, "r") as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit():
+            total = min(total, int(value))
+    return total
+
+
+def process_rss_bytes() -> int:
+    """目前 process 的 RSS（常駐記憶體）"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # 沒有 /proc 的平台（例如 macOS）只能拿到峰值，Linux 以 KB、macOS 以 byte 為單位
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+class MemoryMonitor:
+    """
+    依裝置量測實際的記憶體用量，給模型快取判斷是否要提早淘汰：
+
+    - GPU：torch.cuda 的 allocator 統計與裝置總記憶體。
+    - CPU：process 的 RSS 與實體記憶體（或 cgroup 上限）。
+
+    模型快取的預算仍以量測到的模型 byte 數計算，這裡補上預算估不到的部分
+    （activation、KV cache、其他 process），用量超過 high_watermark 時就繼續淘汰。
+    """
+
+    def __init__(self, device: torch.device, high_watermark: float = 0.9):
+        self.device = device
+        self.high_watermark = high_watermark
+        self.is_cuda = device.type == "cuda"
+        self.pressure_evictions = 0
+
+    def total_bytes(self) -> int:
+        if os.getenv("MEMORY_LIMIT_BYTES"):
+            return int(os.getenv("MEMORY_LIMIT_BYTES"))
+        if self.is_cuda:
+            return torch.cuda.get_device_properties(self.device).total_memory
+        return physical_memory_bytes()
+
+    def used_bytes(self) -> int:
+        if self.is_cuda:
+            return torch.cuda.memory_reserved(self.device)
+        return process_rss_bytes()
+
+    def cache_budget(self) -> int:
+        """模型快取可用的 byte 數，可用 MODEL_CACHE_BUDGET_BYTES 覆寫"""
+        if os.getenv("MODEL_CACHE_BUDGET_BYTES"):
+            return int(os.getenv("MODEL_CACHE_BUDGET_BYTES"))
+        # CPU 上還要留給 web、tokenizer 與其他 worker，只用一半
+        return int(self.total_bytes() * (0.75 if self.is_cuda else 0.5))
+
+    def under_pressure(self) -> bool:
+        return self.used_bytes() > self.total_bytes() * self.high_watermark
+
+    def release(self):
+        """把已釋放的 tensor 還給系統，量測到的用量才會下降"""
+        gc.collect()
+        if self.is_cuda:
+            torch.cuda.empty_cache()
+
+    def stats(self) -> dict:
+        used = self.used_bytes()
+        total = self.total_bytes()
+        stats = {
+            "device": str(self.device),
+            "used_bytes": used,
+            "total_bytes": total,
+            "used_ratio": used / total if total else 0.0,
+            "high_watermark": self.high_watermark,
+            "pressure_evictions": self.pressure_evictions,
+        }
+        if self.is_cuda:
+            stats["allocated_bytes"] = torch.cuda.memory_allocated(self.device)
+            stats["peak_allocated_bytes"] = torch.cuda.max_memory_allocated(self.device)
+        return stats
+
+
+def relieve_memory_pressure(
+    monitor: MemoryMonitor, cache, keep: Optional[object] = None
+) -> int:
+    """
+    實際用量超過 high_watermark 時，從快取最久沒用到的 entry 開始淘汰，回傳淘汰的數量。
+
+    CPU 上 RSS 不一定會在釋放後馬上下降（allocator 保留記憶體），
+    淘汰後用量沒有減少時就停下來，避免把整個快取清空。
+    """
+    evicted = 0
+    used = monitor.used_bytes()
+    while used > monitor.total_bytes() * monitor.high_watermark:
+        if not cache.evict_lru(keep=keep):
+            print("[WARN] Memory usage above high watermark, nothing left to evict")
+            break
+        evicted += 1
+        monitor.pressure_evictions += 1
+        monitor.release()
+        now = monitor.used_bytes()
+        if now >= used:
+            break
+        used = now
+    return evicted
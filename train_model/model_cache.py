@@ -0,0 +1,151 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+
+class ModelCache:
+    """
+    依照最近使用順序（LRU）淘汰的模型快取，容量以 byte 計算。
+
+    - 每個 entry 的大小在載入時量測後傳入 put()，不需要每次命中都查詢 GPU 記憶體。
+    - 被 pin 住的 entry 不會被淘汰（例如常用模型或正在 decode 的 adapter）。
+    - hits / misses / evictions 可透過 stats() 給維運查看。
+    """
+
+    def __init__(
+        self,
+        budget_bytes: int,
+        on_evict: Optional[Callable[[Hashable, object], None]] = None,
+    ):
+        self.budget_bytes = budget_bytes
+        self.on_evict = on_evict
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (value, nbytes)，最久沒用到的在最前面
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        # key -> pin 次數，允許在 entry 載入前先 pin
+        self._pins: Dict[Hashable, int] = {}
+        self._lock = threading.RLock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def items(self) -> List[Tuple[Hashable, object]]:
+        """目前所有 entry 的 (key, value)，不影響 LRU 順序與命中率"""
+        with self._lock:
+            return [(key, entry[0]) for key, entry in self._entries.items()]
+
+    def get(self, key: Hashable):
+        """取得 entry 並標記為最近使用，沒有的話回傳 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value, nbytes: int):
+        """放入新的 entry，超過預算時從最久沒用到且沒被 pin 的 entry 開始淘汰"""
+        with self._lock:
+            if key in self._entries:
+                self.used_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.used_bytes += nbytes
+            self._evict_over_budget(keep=key)
+
+    def remove(self, key: Hashable):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return
+            self.used_bytes -= entry[1]
+        if self.on_evict is not None:
+            self.on_evict(key, entry[0])
+
+    def evict_lru(self, keep: Optional[Hashable] = None) -> bool:
+        """
+        不管預算，淘汰最久沒用到且沒被 pin 的 entry（實際記憶體不足時使用），
+        回傳是否有淘汰。
+        """
+        with self._lock:
+            for key in self._entries:
+                if key != keep and key not in self._pins:
+                    break
+            else:
+                return False
+            value, nbytes = self._entries.pop(key)
+            self.used_bytes -= nbytes
+            self.evictions += 1
+
+        print(f"[INFO] Evicting {key} from model cache (memory pressure)")
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+        return True
+
+    def pin(self, key: Hashable):
+        with self._lock:
+            self._pins[key] = self._pins.get(key, 0) + 1
+
+    def unpin(self, key: Hashable):
+        with self._lock:
+            count = self._pins.get(key, 0) - 1
+            if count > 0:
+                self._pins[key] = count
+            else:
+                self._pins.pop(key, None)
+            self._evict_over_budget()
+
+    def is_pinned(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._pins
+
+    def set_budget(self, budget_bytes: int):
+        with self._lock:
+            self.budget_bytes = budget_bytes
+            self._evict_over_budget()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "pinned": sum(1 for key in self._entries if key in self._pins),
+                "used_bytes": self.used_bytes,
+                "budget_bytes": self.budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _evict_over_budget(self, keep: Optional[Hashable] = None):
+        evicted = []
+        with self._lock:
+            for key in list(self._entries):
+                if self.used_bytes <= self.budget_bytes:
+                    break
+                if key == keep or key in self._pins:
+                    continue
+                value, nbytes = self._entries.pop(key)
+                self.used_bytes -= nbytes
+                self.evictions += 1
+                evicted.append((key, value))
+            if self.used_bytes > self.budget_bytes:
+                print(
+                    f"[WARN] Model cache over budget ({self.used_bytes / 1e9:.2f} GB > "
+                    f"{self.budget_bytes / 1e9:.2f} GB), remaining entries are pinned"
+                )
+
+        for key, value in evicted:
+            print(f"[INFO] Evicting {key} from model cache")
+            if self.on_evict is not None:
+                self.on_evict(key, value)
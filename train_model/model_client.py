@@ -0,0 +1,184 @@
+import atexit
+import os
+import secrets
+import subprocess
+import sys
+import time
+from multiprocessing.connection import Client
+from typing import Iterator, List, Optional, Tuple
+
+# 過去寫死的金鑰，知道的人都能連上 model server，設定成這個值時拒絕啟動
+INSECURE_AUTHKEYS = {b"", b"model-server"}
+# 等待 model server 回覆的秒數（串流的 token 事件不受此限制）
+MODEL_SERVER_TIMEOUT = float(os.getenv("MODEL_SERVER_TIMEOUT", 30))
+
+
+class ModelServerUnavailable(Exception):
+    """連不上 model server，或 model server 沒有回覆（例如正在重啟）"""
+
+
+class ModelServerBusy(Exception):
+    """排程已滿（或這個 user 排隊的請求太多），estimated_wait 是估計的等待秒數"""
+
+    def __init__(self, estimated_wait: float):
+        super().__init__(f"model server is busy, estimated wait {estimated_wait:.1f}s")
+        self.estimated_wait = estimated_wait
+
+
+def model_server_address() -> Tuple[str, int]:
+    """model server 的位址，web 與 model server 兩邊要設定成一樣；使用時才讀取，.env 的設定才會生效"""
+    return (
+        os.getenv("MODEL_SERVER_HOST", "127.0.0.1"),
+        int(os.getenv("MODEL_SERVER_PORT", 6010)),
+    )
+
+
+def model_server_authkey() -> Optional[bytes]:
+    """
+    web 與 model server 之間的驗證金鑰（MODEL_SERVER_AUTHKEY）。
+
+    multiprocessing.connection 會 unpickle 收到的資料，拿到金鑰就能在 model server 執行任意程式，
+    所以沒有預設值：由 supervise_model_server 每次啟動時隨機產生並透過環境變數傳給子程序；
+    多個 web process 共用同一個 model server 時，要在每個 process 設定同一把金鑰。
+    """
+    authkey = os.getenv("MODEL_SERVER_AUTHKEY")
+    return authkey.encode() if authkey else None
+
+
+def ensure_model_server_authkey():
+    """這個 process 還沒有金鑰時隨機產生一把，之後啟動的 model server 子程序會繼承"""
+    if not os.getenv("MODEL_SERVER_AUTHKEY"):
+        os.environ["MODEL_SERVER_AUTHKEY"] = secrets.token_hex(32)
+
+
+def _connect():
+    authkey = model_server_authkey()
+    if authkey is None:
+        raise ModelServerUnavailable("MODEL_SERVER_AUTHKEY is not set")
+    try:
+        return Client(model_server_address(), authkey=authkey)
+    except OSError as e:
+        raise ModelServerUnavailable(str(e)) from e
+
+
+def _recv(conn, timeout: Optional[float] = MODEL_SERVER_TIMEOUT):
+    try:
+        if timeout is not None and not conn.poll(timeout):
+            raise ModelServerUnavailable("model server did not answer in time")
+        return conn.recv()
+    except (EOFError, OSError) as e:
+        raise ModelServerUnavailable(str(e)) from e
+
+
+def _call(op: str, timeout: float = MODEL_SERVER_TIMEOUT, **payload):
+    """送出一個指令並等待 model server 的回覆"""
+    conn = _connect()
+    try:
+        conn.send({"op": op, **payload})
+        return _recv(conn, timeout)
+    finally:
+        conn.close()
+
+
+def submit_chat(chat_request: dict):
+    """把聊天請求排進 model server 的佇列，佇列已滿時丟出 ModelServerBusy"""
+    reply = _call("submit", request=chat_request)
+    if reply["status"] != "queued":
+        raise ModelServerBusy(reply["estimated_wait"])
+
+
+def stream_chat(chat_request: dict) -> Iterator[Tuple[str, dict]]:
+    """
+    送出串流的聊天請求，回傳依序產生 (event, data) 的 iterator，最後一個事件是 "done"。
+    佇列已滿時丟出 ModelServerBusy。
+    """
+    conn = _connect()
+    try:
+        conn.send({"op": "stream", "request": chat_request})
+        reply = _recv(conn)
+    except Exception:
+        conn.close()
+        raise
+    if reply["status"] != "queued":
+        conn.close()
+        raise ModelServerBusy(reply["estimated_wait"])
+
+    def events():
+        try:
+            while True:
+                try:
+                    event, data = _recv(conn, timeout=None)
+                except ModelServerUnavailable:
+                    yield "done", {
+                        "status": "error",
+                        "message": "Model server restarted during inference",
+                    }
+                    return
+                yield event, data
+                if event == "done":
+                    return
+        finally:
+            conn.close()
+
+    return events()
+
+
+def pop_result(request_id: str, wait: float = 0) -> Optional[dict]:
+    """
+    取走已完成的結果，還沒完成（或問候語還沒到送出時間）時回傳 None。
+    wait > 0 時由 model server 最多等待 wait 秒，結果一寫入就回傳。
+    """
+    return _call(
+        "result",
+        timeout=wait + MODEL_SERVER_TIMEOUT,
+        request_id=request_id,
+        wait=wait,
+    )["result"]
+
+
+def server_stats() -> dict:
+    return _call("stats")
+
+
+def request_traces(request_id: Optional[str] = None, limit: int = 50) -> List[dict]:
+    """最近完成的請求各階段的耗時，指定 request_id 時只回傳那一筆"""
+    return _call("traces", request_id=request_id, limit=limit)["traces"]
+
+
+def server_health() -> dict:
+    """{"ready": bool, "workers": [...]}，worker 預熱完成前 ready 為 False"""
+    return _call("health")
+
+
+def refresh_few_shot(training_file_id: int, path: str):
+    """通知 model server 重新建立訓練檔的 few-shot 區塊"""
+    try:
+        _call("refresh_few_shot", training_file_id=training_file_id, path=path)
+    except ModelServerUnavailable as e:
+        # model server 之後遇到快取 miss 時會自己讀檔
+        print(f"[WARN] Failed to refresh few-shot cache on model server: {e}")
+
+
+def invalidate_few_shot(training_file_id: int):
+    """通知 model server 移除訓練檔的 few-shot 區塊"""
+    try:
+        _call("invalidate_few_shot", training_file_id=training_file_id)
+    except ModelServerUnavailable as e:
+        print(f"[WARN] Failed to invalidate few-shot cache on model server: {e}")
+
+
+def supervise_model_server(restart_delay: float = 5.0):
+    """在子程序執行 model server，結束（例如 CUDA 錯誤崩潰）後自動重啟"""
+    ensure_model_server_authkey()
+    while True:
+        print("[INFO] Starting model server process")
+        process = subprocess.Popen(
+            [sys.executable, "-m", "train_model.model_server"], env=dict(os.environ)
+        )
+        atexit.register(process.terminate)
+        code = process.wait()
+        atexit.unregister(process.terminate)
+        print(
+            f"[WARN] Model server exited with code {code}, restarting in {restart_delay}s"
+        )
+        time.sleep(restart_delay)
@@ -0,0 +1,519 @@
+"""
+獨立的 model server process：排程 inference、保存結果，
+web 透過本機 socket（multiprocessing.connection）送出請求與取回結果。
+
+    python -m train_model.model_server
+
+模型由底下的 inference worker process 載入（INFERENCE_WORKERS 個，每個使用一個裝置），
+model server 把請求分派給已經載入該模型的 worker，沒有的話交給最閒的 worker。
+多個 web process 可以共用同一個 model server，worker 崩潰時會自動重啟。
+
+每次聊天都會記到 usage log，啟動（或 worker 重啟）時依最近的聊天量預先載入
+WARM_UP_MODELS 個常用模型，全部 worker 預熱完成前 health 回報尚未就緒。
+"""
+
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from multiprocessing.connection import Listener
+from typing import Dict, List, Optional, Set
+
+from dotenv import load_dotenv
+
+# 底下的模組與這個檔案在 import 時就會讀取設定，要先載入 .env
+load_dotenv()
+
+from train_model.coalescer import RequestCoalescer
+from train_model.fair_queue import FairQueue
+from train_model.greetings import greeting_delay, is_greeting
+from train_model.inference_worker import run_worker
+from train_model.model_client import (
+    INSECURE_AUTHKEYS,
+    model_server_address,
+    model_server_authkey,
+)
+from train_model.result_store import build_result, create_result_store
+from train_model.streamer import ChatStreamer
+from train_model.tracing import TraceRecorder
+from train_model.usage_log import UsageLog
+
+# 同時 decode 的序列數上限（每個 worker）
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 8))
+# inference worker 的數量與各自使用的裝置（逗號分隔，例如 "cuda:0,cuda:1" 或 "cpu"，依序循環分配）
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 1))
+INFERENCE_DEVICES = [
+    name.strip() for name in os.getenv("INFERENCE_DEVICES", "").split(",") if name.strip()
+]
+# 每個 worker 同時處理的請求數上限，超過的請求留在 model server 的 FairQueue
+WORKER_CAPACITY = int(os.getenv("WORKER_CAPACITY", MAX_BATCH_SIZE))
+# worker 崩潰後等幾秒重啟
+WORKER_RESTART_DELAY = 5
+# 啟動時預先載入幾個最近最常聊天的模型（分配給各個 worker）
+WARM_UP_MODELS = int(os.getenv("WARM_UP_MODELS", 4))
+
+# 排程中的請求上限，以及單一 user 最多可以排幾則
+request_queue = FairQueue(
+    maxsize=int(os.getenv("REQUEST_QUEUE_SIZE", 32)),
+    per_user_limit=int(os.getenv("PER_USER_QUEUE_LIMIT", 4)),
+    concurrency=INFERENCE_WORKERS * WORKER_CAPACITY,
+)
+result_store = create_result_store()
+# 合併重複的 /chat 請求；REPLY_CACHE_TTL > 0 時相同的輸入在期限內直接回傳上次的結果
+coalescer = RequestCoalescer(
+    reply_ttl=float(os.getenv("REPLY_CACHE_TTL", 0)),
+    reply_cache_size=int(os.getenv("REPLY_CACHE_SIZE", 1024)),
+)
+# 每個請求各階段的耗時：最近的 per-request 記錄與各階段的 histogram
+trace_recorder = TraceRecorder(history=int(os.getenv("TRACE_HISTORY", 500)))
+# 每個模型最近的聊天量，半衰期預設 24 小時；遞減到 USAGE_LOG_MIN_SCORE 以下的模型會移除
+usage_log = UsageLog(
+    os.getenv("USAGE_LOG_PATH", "./train_model/usage_log.json"),
+    half_life=float(os.getenv("USAGE_LOG_HALF_LIFE", 24 * 3600)),
+    min_score=float(os.getenv("USAGE_LOG_MIN_SCORE", 0.01)),
+)
+
+
+class RoutedRequest:
+    """model server 排程中的請求，payload 會原封不動送給 worker 建立 ChatRequest"""
+
+    def __init__(self, payload: dict, streamer: Optional[ChatStreamer] = None):
+        self.payload = payload
+        self.request_id = payload["request_id"]
+        self.user_id = payload["user_id"]
+        self.input_text = payload["input_text"]
+        self.priority = payload.get("priority", "interactive")
+        # 與 worker 回報的 loaded_model_dirs() 比對
+        self.model_key = os.path.abspath(payload["model_dir"])
+        self.streamer = streamer
+        # RequestCoalescer 設定，串流請求不合併
+        self.fingerprint: Optional[str] = None
+        self.enqueued_at = time.time()
+        self.dequeued_at: Optional[float] = None
+
+
+class WorkerHandle:
+    """model server 端對一個 inference worker process 的記錄"""
+
+    def __init__(self, index: int, device: Optional[str]):
+        self.index = index
+        self.device = device
+        self.in_flight: Dict[str, RoutedRequest] = {}
+        # worker 已經載入（或已分派、正在載入）的模型目錄
+        self.loaded: Set[str] = set()
+        self.status: dict = {}
+        # 這個 worker 啟動時要預熱的模型
+        self.warm_up_dirs: List[str] = []
+        self.alive = False
+        self.restarts = 0
+        self._send_lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.alive and self.status.get("ready", False)
+
+    def start(self):
+        self.warm_up_dirs = warm_up_dirs_for(self.index)
+        # 預熱中的模型也算已載入，常用模型的請求在預熱期間就會排到這個 worker
+        self.loaded = set(self.warm_up_dirs)
+        self.status = {}
+        context = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=run_worker,
+            args=(
+                self.index,
+                self.device,
+                MAX_BATCH_SIZE,
+                self.warm_up_dirs,
+                child_conn,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.alive = True
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def send(self, message: tuple):
+        with self._send_lock:
+            self.conn.send(message)
+
+    def submit(self, routed: RoutedRequest):
+        """分派請求（呼叫時須持有 worker_available）"""
+        self.in_flight[routed.request_id] = routed
+        self.loaded.add(routed.model_key)
+        try:
+            self.send(("request", routed.payload, routed.streamer is not None))
+        except (OSError, ValueError):
+            # worker 剛好結束，_read 會負責重啟
+            self.in_flight.pop(routed.request_id, None)
+            finish_request(
+                routed,
+                build_result(routed.input_text, None, "Inference worker crashed"),
+            )
+
+    def _read(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            op = message[0]
+            if op == "event":
+                _, request_id, event, data = message
+                routed = self.in_flight.get(request_id)
+                if routed is not None and routed.streamer is not None:
+                    routed.streamer.events.put((event, data))
+            elif op == "done":
+                _, request_id, result, spans = message
+                with worker_available:
+                    routed = self.in_flight.pop(request_id, None)
+                    worker_available.notify_all()
+                if routed is not None:
+                    finish_request(routed, result, spans, worker=self.index)
+            elif op == "status":
+                with worker_available:
+                    self.status = message[1]
+                    # 已分派但還沒載入完成的模型也算在內
+                    self.loaded = set(self.status["loaded"]) | {
+                        routed.model_key for routed in self.in_flight.values()
+                    }
+                    if not self.status.get("ready", False):
+                        self.loaded |= set(self.warm_up_dirs)
+        self._restart()
+
+    def _restart(self):
+        self.process.join(timeout=5)
+        print(
+            f"[ERROR] Inference worker {self.index} exited with code "
+            f"{self.process.exitcode}, restarting in {WORKER_RESTART_DELAY}s"
+        )
+        with worker_available:
+            self.alive = False
+            failed = list(self.in_flight.values())
+            self.in_flight.clear()
+            self.loaded.clear()
+        for routed in failed:
+            finish_request(
+                routed,
+                build_result(routed.input_text, None, "Inference worker crashed"),
+            )
+        time.sleep(WORKER_RESTART_DELAY)
+        self.restarts += 1
+        with worker_available:
+            self.start()
+            worker_available.notify_all()
+
+    def stats(self) -> dict:
+        with worker_available:
+            return {
+                "index": self.index,
+                "device": self.device,
+                "alive": self.alive,
+                "ready": self.ready,
+                "restarts": self.restarts,
+                "in_flight": len(self.in_flight),
+                "loaded": sorted(self.loaded),
+                **{
+                    key: value
+                    for key, value in self.status.items()
+                    if key not in ("loaded", "ready")
+                },
+            }
+
+
+workers: List[WorkerHandle] = []
+# worker 的 in_flight / alive / loaded 有變動時通知 dispatch_requests
+worker_available = threading.Condition()
+
+
+def warm_up_dirs_for(index: int) -> List[str]:
+    """把最近最常聊天的模型輪流分配給各個 worker，同一個模型只會在一個 worker 預熱"""
+    return usage_log.top(WARM_UP_MODELS)[index::INFERENCE_WORKERS]
+
+
+def has_free_worker() -> bool:
+    return any(w.alive and len(w.in_flight) < WORKER_CAPACITY for w in workers)
+
+
+def choose_worker(routed: RoutedRequest) -> Optional[WorkerHandle]:
+    """
+    選出要處理請求的 worker（呼叫時須持有 worker_available）：
+
+    1. 已經載入該模型、還有空位的 worker 中最閒的一個，避免重複載入 adapter。
+    2. 但那個 worker 正在忙、而有其他 worker 完全閒置時，由閒置的 worker 接手（steal on idle）。
+    3. 沒有 worker 載入該模型時，交給最閒的 worker。
+    """
+    free = [w for w in workers if w.alive and len(w.in_flight) < WORKER_CAPACITY]
+    if not free:
+        return None
+    least_loaded = min(free, key=lambda w: len(w.in_flight))
+    affine = [w for w in free if routed.model_key in w.loaded]
+    if not affine:
+        return least_loaded
+    worker = min(affine, key=lambda w: len(w.in_flight))
+    if worker.in_flight and not least_loaded.in_flight:
+        return least_loaded
+    return worker
+
+
+def dispatch_requests():
+    """從 FairQueue 依公平順序取出請求，分派給 worker"""
+    while True:
+        with worker_available:
+            worker_available.wait_for(has_free_worker)
+        routed = request_queue.get()
+        with worker_available:
+            worker = choose_worker(routed)
+            while worker is None:
+                worker_available.wait()
+                worker = choose_worker(routed)
+            worker.submit(routed)
+
+
+def start_workers():
+    for index in range(INFERENCE_WORKERS):
+        device = (
+            INFERENCE_DEVICES[index % len(INFERENCE_DEVICES)]
+            if INFERENCE_DEVICES
+            else None
+        )
+        worker = WorkerHandle(index, device)
+        worker.start()
+        workers.append(worker)
+    threading.Thread(target=dispatch_requests, daemon=True).start()
+
+
+def clean_result_store():
+    while True:
+        time.sleep(60)  # 每分鐘清掉已過期的結果（put 時也會順便清理）
+        try:
+            result_store.expire()
+        except Exception as e:
+            print(f"[ERROR] Failed to expire results: {e}")
+        # 同時把聊天量寫回檔案，重啟時才知道哪些模型要預熱
+        usage_log.save()
+
+
+def record_trace(
+    routed: RoutedRequest,
+    result: dict,
+    spans: List[dict],
+    worker: Optional[int],
+):
+    """把 model server 排程等待的時間接在 worker 回報的各階段前面，寫入 trace_recorder"""
+    now = time.time()
+    queue_wait = (routed.dequeued_at or now) - routed.enqueued_at
+    trace_recorder.record(
+        {
+            "request_id": routed.request_id,
+            "user_id": routed.user_id,
+            "model_dir": routed.model_key,
+            "priority": routed.priority,
+            "worker": worker,
+            "status": result.get("status"),
+            "enqueued_at": routed.enqueued_at,
+            "total_seconds": now - routed.enqueued_at,
+            "spans": [{"name": "queue_wait", "seconds": queue_wait}] + spans,
+        }
+    )
+
+
+def finish_request(
+    routed: RoutedRequest,
+    result: dict,
+    spans: Optional[List[dict]] = None,
+    worker: Optional[int] = None,
+):
+    if routed.dequeued_at is not None:
+        request_queue.record_service_time(time.time() - routed.dequeued_at)
+    record_trace(routed, result, spans or [], worker)
+    # 串流的請求直接把結果送給 SSE，不放進 result_store
+    if routed.streamer is not None:
+        routed.streamer.end(result)
+    else:
+        result_store.put(routed.request_id, result)
+    for follower in coalescer.complete(routed, result):
+        result_store.put(follower.request_id, result)
+        request_queue.release(follower)
+    request_queue.task_done()
+
+
+def reply_to_greeting(routed: RoutedRequest):
+    """問候語不進排程也不佔用 worker，直接寫入結果，延遲到 deliver_at 之後才送出"""
+    result_store.put(
+        routed.request_id,
+        build_result(routed.input_text, [routed.input_text]),
+        deliver_at=time.time() + greeting_delay(),
+    )
+
+
+def busy_reply() -> dict:
+    return {"status": "busy", "estimated_wait": request_queue.estimated_wait()}
+
+
+def handle_submit(conn, message: dict):
+    routed = RoutedRequest(message["request"])
+    if is_greeting(routed.input_text):
+        reply_to_greeting(routed)
+        conn.send({"status": "queued"})
+        return
+    usage_log.record(routed.model_key)
+    try:
+        reply = coalescer.submit(
+            routed, request_queue.put_nowait, hold=request_queue.hold
+        )
+    except queue.Full:
+        conn.send(busy_reply())
+        return
+    if reply is not None:
+        result_store.put(routed.request_id, reply)
+    conn.send({"status": "queued"})
+
+
+def handle_stream(conn, message: dict):
+    """串流請求佔用這條連線，依序送出 (event, data) 直到 "done" 為止"""
+    routed = RoutedRequest(message["request"], streamer=ChatStreamer())
+    if is_greeting(routed.input_text):
+        conn.send({"status": "queued"})
+        # 在這條連線的執行緒等待，不佔用 inference worker
+        time.sleep(greeting_delay())
+        conn.send(("done", build_result(routed.input_text, [routed.input_text])))
+        return
+    usage_log.record(routed.model_key)
+
+    try:
+        request_queue.put_nowait(routed)
+    except queue.Full:
+        conn.send(busy_reply())
+        return
+    conn.send({"status": "queued"})
+    for event, data in routed.streamer:
+        conn.send((event, data))
+
+
+def handle_result(conn, message: dict):
+    wait = message.get("wait", 0)
+    if wait > 0:
+        # long-poll：在這條連線的執行緒等待結果寫入
+        result = result_store.wait_pop(message["request_id"], wait)
+    else:
+        result = result_store.pop(message["request_id"])
+    conn.send({"result": result})
+
+
+def handle_stats(conn, message: dict):
+    conn.send(
+        {
+            "workers": [worker.stats() for worker in workers],
+            "result_store": result_store.stats(),
+            "request_queue": request_queue.stats(),
+            "coalescer": coalescer.stats(),
+            "tracing": trace_recorder.stats(),
+        }
+    )
+
+
+def handle_traces(conn, message: dict):
+    """指定 request_id 時回傳那一筆，否則回傳最近 limit 筆"""
+    if message.get("request_id"):
+        record = trace_recorder.find(message["request_id"])
+        conn.send({"traces": [record] if record is not None else []})
+    else:
+        conn.send({"traces": trace_recorder.recent(message.get("limit", 50))})
+
+
+def handle_health(conn, message: dict):
+    """所有 worker 都啟動並預熱完成才算就緒"""
+    with worker_available:
+        states = [
+            {"index": worker.index, "alive": worker.alive, "ready": worker.ready}
+            for worker in workers
+        ]
+    conn.send(
+        {
+            "ready": bool(states) and all(state["ready"] for state in states),
+            "workers": states,
+        }
+    )
+
+
+def broadcast(message: tuple):
+    """每個 worker 都有自己的 few-shot 快取，更新時要通知全部"""
+    for worker in workers:
+        try:
+            worker.send(message)
+        except (OSError, ValueError):
+            # 重啟中的 worker 會在啟動時重新讀取所有訓練檔
+            pass
+
+
+def handle_refresh_few_shot(conn, message: dict):
+    broadcast(("refresh_few_shot", message["training_file_id"], message["path"]))
+    conn.send({"status": "ok"})
+
+
+def handle_invalidate_few_shot(conn, message: dict):
+    broadcast(("invalidate_few_shot", message["training_file_id"]))
+    conn.send({"status": "ok"})
+
+
+handlers = {
+    "submit": handle_submit,
+    "stream": handle_stream,
+    "result": handle_result,
+    "stats": handle_stats,
+    "health": handle_health,
+    "traces": handle_traces,
+    "refresh_few_shot": handle_refresh_few_shot,
+    "invalidate_few_shot": handle_invalidate_few_shot,
+}
+
+
+def handle_connection(conn):
+    try:
+        message = conn.recv()
+        handler = handlers.get(message.get("op"))
+        if handler is None:
+            conn.send({"status": "error", "message": f"Unknown op {message.get('op')}"})
+            return
+        handler(conn, message)
+    except (EOFError, OSError):
+        # web 端先斷線（例如 SSE 的使用者關掉頁面）
+        pass
+    except Exception as e:
+        print(f"[ERROR] Model server failed to handle request: {e}")
+    finally:
+        conn.close()
+
+
+def serve():
+    authkey = model_server_authkey()
+    if authkey is None or authkey in INSECURE_AUTHKEYS:
+        # 金鑰外洩等於任何本機 process 都能在這裡執行程式，寧可不啟動
+        raise SystemExit(
+            "[ERROR] MODEL_SERVER_AUTHKEY is not set or uses the old hard-coded "
+            "default; start the model server through supervise_model_server or "
+            "set a random key"
+        )
+    start_workers()
+    threading.Thread(target=clean_result_store, daemon=True).start()
+
+    address = model_server_address()
+    with Listener(address, authkey=authkey) as listener:
+        print(f"[INFO] Model server listening on {address}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # 驗證失敗或連線中斷，不影響其他連線
+                print(f"[WARN] Rejected model server connection: {e}")
+                continue
+            threading.Thread(target=handle_connection, daemon=True, args=(conn,)).start()
+
+
+if __name__ == "__main__":
+    serve()
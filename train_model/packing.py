@@ -0,0 +1,115 @@
+"""
+Sequence packing：把多筆很短的對話接成接近 CUTOFF_LEN 的訓練區塊，減少每個 epoch 的 step 數。
+
+每筆樣本在區塊內有自己的 segment id，position_ids 從 0 重新開始，
+attention 只能看到同一筆樣本（block-diagonal + causal），樣本之間以 eos 分隔，
+每筆樣本的第一個 token 不計 loss（不讓模型從上一筆的 eos 預測下一筆的開頭）。
+"""
+
+from typing import Dict, List
+
+import torch
+from transformers import Trainer
+
+
+def pack_examples(batch: Dict[str, list], block_size: int) -> Dict[str, list]:
+    """
+    給 dataset.map(batched=True, remove_columns=...) 用：
+    依序把 tokenize 後的樣本放進目前的區塊，放不下時開新的區塊。
+    """
+    packed = {
+        "input_ids": [],
+        "labels": [],
+        "position_ids": [],
+        "segment_ids": [],
+        "length": [],
+    }
+    input_ids: List[int] = []
+    labels: List[int] = []
+    position_ids: List[int] = []
+    segment_ids: List[int] = []
+
+    def flush():
+        if input_ids:
+            packed["input_ids"].append(list(input_ids))
+            packed["labels"].append(list(labels))
+            packed["position_ids"].append(list(position_ids))
+            packed["segment_ids"].append(list(segment_ids))
+            packed["length"].append(len(input_ids))
+            for values in (input_ids, labels, position_ids, segment_ids):
+                values.clear()
+
+    for example_ids, example_labels in zip(batch["input_ids"], batch["labels"]):
+        example_ids = example_ids[:block_size]
+        if len(input_ids) + len(example_ids) > block_size:
+            flush()
+        segment = segment_ids[-1] + 1 if segment_ids else 0
+        input_ids.extend(example_ids)
+        labels.extend([-100] + example_labels[1 : len(example_ids)])
+        position_ids.extend(range(len(example_ids)))
+        segment_ids.extend([segment] * len(example_ids))
+    flush()
+    return packed
+
+
+class PackedCollator:
+    """把區塊補齊到同一個 batch 最長的長度；segment_ids 的 padding 為 -1"""
+
+    def __init__(self, pad_token_id: int, pad_to_multiple_of: int = 8):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, features: List[dict]) -> Dict[str, torch.Tensor]:
+        longest = max(len(feature["input_ids"]) for feature in features)
+        length = -(-longest // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        def pad(key: str, value: int) -> torch.Tensor:
+            return torch.tensor(
+                [
+                    feature[key] + [value] * (length - len(feature[key]))
+                    for feature in features
+                ],
+                dtype=torch.long,
+            )
+
+        return {
+            "input_ids": pad("input_ids", self.pad_token_id),
+            "labels": pad("labels", -100),
+            "position_ids": pad("position_ids", 0),
+            "segment_ids": pad("segment_ids", -1),
+        }
+
+
+def block_causal_mask(segment_ids: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """
+    [batch, 1, seq, seq] 的 4D attention mask（transformers 的「已反轉」格式：
+    可以看到的位置為 0，看不到的位置為 dtype 的最小值）。
+    """
+    length = segment_ids.shape[1]
+    causal = torch.tril(
+        torch.ones(length, length, dtype=torch.bool, device=segment_ids.device)
+    )
+    same_segment = segment_ids[:, :, None] == segment_ids[:, None, :]
+    allowed = same_segment & causal & (segment_ids[:, None, :] >= 0)
+    # padding 的 query 至少看得到自己，避免整列都被遮掉
+    allowed |= torch.eye(length, dtype=torch.bool, device=segment_ids.device)
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=segment_ids.device)
+    mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+    return mask[:, None, :, :]
+
+
+class PackedTrainer(Trainer):
+    """送進模型前把 segment_ids 換成 block-diagonal 的 4D attention mask"""
+
+    def mask_dtype(self) -> torch.dtype:
+        # 4D mask 會直接加到 attention score 上，dtype 要和混合精度計算時一致
+        if self.args.fp16:
+            return torch.float16
+        if self.args.bf16:
+            return torch.bfloat16
+        return self.model.get_input_embeddings().weight.dtype
+
+    def compute_loss(self, model, inputs, return_outputs=False):
+        segment_ids = inputs.pop("segment_ids")
+        inputs["attention_mask"] = block_causal_mask(segment_ids, self.mask_dtype())
+        return super().compute_loss(model, inputs, return_outputs=return_outputs)
@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, List, Optional
+
+from train_model.trim import analyze_and_modify_response
+
+
+class PostEditStage:
+    """
+    GPT 修正（analyze_and_modify_response）的獨立階段。
+
+    - 在自己的 thread pool 平行呼叫，不佔用 GPU worker。
+    - 每次呼叫有 deadline，超過時間就直接使用模型的原始輸出。
+    - 以 (modelname, 使用者輸入, 模型原始輸出) 快取修正結果；
+      edit 回傳 None（呼叫失敗或逾時）時改用原始輸出，且不寫入快取。
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 8,
+        deadline: float = 10.0,
+        cache_size: int = 1024,
+        cache_ttl: float = 600.0,
+        edit: Callable = analyze_and_modify_response,
+    ):
+        self.deadline = deadline
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.edit = edit
+        self._edit_pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="post-edit"
+        )
+        # 等待一組修正完成再回呼，與修正本身分開，避免互相卡住 worker
+        self._join_pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="post-edit-join"
+        )
+        # key -> (修正後的文字, 寫入時間)
+        self._cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.timeouts = 0
+
+    def submit(
+        self,
+        input_text: str,
+        responses: List[str],
+        modelname: str,
+        chat: List[str],
+        session_history: List[dict],
+        callback: Callable[[List[str]], None],
+    ):
+        """送出一個請求的所有回答，全部修正完成（或超過 deadline）後以結果呼叫 callback"""
+        futures = [
+            self._edit_one(input_text, response, modelname, chat, session_history)
+            for response in responses
+        ]
+        self._join_pool.submit(self._join, futures, responses, callback)
+
+    def _edit_one(
+        self,
+        input_text: str,
+        response: str,
+        modelname: str,
+        chat: List[str],
+        session_history: List[dict],
+    ) -> Future:
+        key = (modelname, input_text, response)
+        cached = self._cache_get(key)
+        if cached is not None:
+            future = Future()
+            future.set_result(cached)
+            return future
+
+        def run() -> Optional[str]:
+            edited = self.edit(
+                input_text,
+                response,
+                modelname,
+                chat,
+                session_history,
+                timeout=self.deadline,
+            )
+            if edited:
+                self._cache_put(key, edited)
+            return edited
+
+        return self._edit_pool.submit(run)
+
+    def _join(
+        self,
+        futures: List[Future],
+        responses: List[str],
+        callback: Callable[[List[str]], None],
+    ):
+        wait(futures, timeout=self.deadline)
+        edited = []
+        for future, response in zip(futures, responses):
+            if not future.done():
+                with self._lock:
+                    self.timeouts += 1
+                print("[WARN] Post-edit deadline exceeded, using raw model output")
+                edited.append(response)
+            elif future.exception() is not None:
+                print(f"[ERROR] Post-edit failed: {future.exception()}")
+                edited.append(response)
+            else:
+                edited.append(future.result() or response)
+        try:
+            callback(edited)
+        except Exception as e:
+            print(f"[ERROR] Post-edit callback failed: {e}")
+
+    def _cache_get(self, key: tuple) -> Optional[str]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None or time.time() - entry[1] > self.cache_ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return entry[0]
+
+    def _cache_put(self, key: tuple, edited: str):
+        with self._lock:
+            self._cache[key] = (edited, time.time())
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "cache_entries": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "timeouts": self.timeouts,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+post_edit_stage = PostEditStage(
+    max_workers=int(os.getenv("POST_EDIT_WORKERS", 8)),
+    deadline=float(os.getenv("POST_EDIT_TIMEOUT", 10)),
+)
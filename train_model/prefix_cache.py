@@ -0,0 +1,54 @@
+import threading
+from typing import Hashable, Optional
+
+from train_model.model_cache import ModelCache
+
+
+def past_key_values_nbytes(past_key_values) -> int:
+    return sum(
+        key.numel() * key.element_size() + value.numel() * value.element_size()
+        for key, value in past_key_values
+    )
+
+
+class PrefixCache:
+    """
+    保存每個 (模型, few-shot 區塊) 的 past_key_values，讓 prefill 只需要計算動態的部分。
+
+    容量以 KV cache 的 byte 數計算並依 LRU 淘汰，另外統計總共省下多少 prompt token。
+    """
+
+    def __init__(self, budget_bytes: int):
+        self._cache = ModelCache(budget_bytes)
+        self._lock = threading.Lock()
+        self.prompt_tokens = 0
+        self.saved_tokens = 0
+
+    def get(self, key: Hashable):
+        return self._cache.get(key)
+
+    def put(self, key: Hashable, past_key_values):
+        self._cache.put(key, past_key_values, past_key_values_nbytes(past_key_values))
+
+    def invalidate_model(self, model_key: Hashable) -> int:
+        """模型從 ModelCache 卸載時移除它所有的前綴（key 的第一項），回傳移除的數量"""
+        keys = [key for key, _ in self._cache.items() if key[0] == model_key]
+        for key in keys:
+            self._cache.remove(key)
+        return len(keys)
+
+    def record(self, prompt_tokens: int, saved_tokens: Optional[int] = 0):
+        """記錄一次 prefill 的 prompt 長度與其中直接從快取取得的 token 數"""
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.saved_tokens += saved_tokens
+
+    def stats(self) -> dict:
+        stats = self._cache.stats()
+        with self._lock:
+            stats["prompt_tokens"] = self.prompt_tokens
+            stats["prompt_tokens_saved"] = self.saved_tokens
+            stats["saved_ratio"] = (
+                self.saved_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+            )
+        return stats
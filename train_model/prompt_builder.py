@@ -0,0 +1,100 @@
+import os
+from typing import List, Optional, Tuple
+
+# prompt 的 token 上限（不含模型生成的部分）
+prompt_token_budget = int(os.getenv("PROMPT_TOKEN_BUDGET", 256))
+# few-shot 範例固定使用的 token 預算，不隨這次輸入的長短改變，
+# 同一個訓練檔每次都組出相同的前綴，PrefixCache 才能重用它的 KV cache
+few_shot_token_budget = int(
+    os.getenv("FEW_SHOT_TOKEN_BUDGET", prompt_token_budget // 2)
+)
+
+rag_header = "System: 以下是檢索到跟使用者相關內容，如果對話提及相關話題可以參考："
+
+
+def count_tokens(tokenizer, lines: List[str]) -> int:
+    """計算一段 prompt 行（含結尾換行）的 token 數"""
+    if not lines:
+        return 0
+    text = "\n".join(lines) + "\n"
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+def _take_recent_pairs(
+    tokenizer, pairs: List[List[str]], budget: int
+) -> Tuple[List[str], int]:
+    """從最後一組開始往前放，直到放不下為止，回傳保留的行與用掉的 token 數"""
+    kept = []
+    used = 0
+    for pair in reversed(pairs):
+        cost = count_tokens(tokenizer, pair)
+        if used + cost > budget:
+            break
+        kept.insert(0, pair)
+        used += cost
+    return [line for pair in kept for line in pair], used
+
+
+def assemble_prompt(
+    tokenizer,
+    input_text: str,
+    few_shot: List[str],
+    rag_content: Optional[str],
+    session_history: List[dict],
+    budget: int = prompt_token_budget,
+    few_shot_budget: int = few_shot_token_budget,
+) -> Tuple[List[str], List[str]]:
+    """
+    依優先順序把每個段落放進 token 預算，回傳 (few-shot 前綴, 其餘的行)。
+
+    優先順序：
+    1. 這次的輸入與結尾的 "Assistant:"，一定會保留。
+    2. few-shot 範例（決定說話風格），在固定的 few_shot_budget 內從最後一組開始放，
+       選出的範例與這次的輸入無關，前綴才會穩定。
+    3. 這次 session 的對話紀錄，從最近的一輪開始放。
+    4. RAG 檢索內容，依檢索結果的順序一筆一筆放。
+
+    排列順序為 few-shot、RAG、對話紀錄、這次的輸入。
+    """
+    few_shot_pairs = [few_shot[i : i + 2] for i in range(0, len(few_shot), 2)]
+    few_shot_lines, used = _take_recent_pairs(
+        tokenizer, few_shot_pairs, min(few_shot_budget, budget - 1)
+    )
+
+    current = [f"User: {input_text}", "Assistant:"]
+    # 保留 1 個 token 給 BOS；輸入太長時由 clip_input_ids 截掉前面的部分
+    remaining = budget - 1 - used - count_tokens(tokenizer, current)
+
+    history_pairs = [
+        [f"User: {turn.get('user', '')}", f"Assistant: {turn.get('model', '')}"]
+        for turn in session_history
+        if isinstance(turn, dict)
+    ]
+    history_lines, used = _take_recent_pairs(tokenizer, history_pairs, remaining)
+    remaining -= used
+
+    rag_lines = []
+    if rag_content:
+        remaining -= count_tokens(tokenizer, [rag_header])
+        for document in rag_content.splitlines():
+            cost = count_tokens(tokenizer, [document])
+            if not document.strip() or cost > remaining:
+                continue
+            rag_lines.append(document)
+            remaining -= cost
+        if rag_lines:
+            rag_lines.insert(0, rag_header)
+
+    return few_shot_lines, rag_lines + history_lines + current
+
+
+def clip_input_ids(
+    input_ids: List[int], budget: int = prompt_token_budget
+) -> List[int]:
+    """
+    預算是以每段分開 tokenize 估算的，合併後仍超過時（例如輸入本身就很長）
+    保留開頭的 BOS 與最後面的 token，確保這次的輸入與 "Assistant:" 不會被截掉。
+    """
+    if len(input_ids) <= budget:
+        return input_ids
+    return input_ids[:1] + input_ids[len(input_ids) - budget + 1 :]
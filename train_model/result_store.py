@@ -0,0 +1,323 @@
+import heapq
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+
+def build_result(
+    input_text: str,
+    responses: Optional[List[str]],
+    error: Optional[str] = None,
+) -> dict:
+    """/chat-result 與串流 done 事件回傳的格式"""
+    if error is not None:
+        return {"status": "error", "message": error}
+    if responses is None:
+        return {"status": "error", "message": "Inference failed"}
+    return {
+        "status": "success",
+        "result": [{"input": input_text, "output": response} for response in responses],
+        "msg": f"成功取得{len(responses)}筆回答",
+    }
+
+
+class ResultStore(ABC):
+    """
+    保存還沒被取走的聊天結果。
+
+    - put / pop 都是 O(1)（SQLite 以 primary key 查詢）。
+    - 每筆結果在 ttl 秒後過期，依到期時間排序清理，不需要掃描全部結果。
+    - 總大小超過 max_bytes 時，從最早到期的結果開始丟掉。
+    - deliver_at：問候語的延遲回覆，時間到之前 pop 不會取出。
+    - wait_pop：結果還沒寫入時在 per-request 的 Event 上等待，put 時喚醒。
+    """
+
+    def __init__(self, ttl: float = 3600, max_bytes: int = 64 << 20):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.expired = 0
+        self.evicted = 0
+        # request_id -> (Event, 等待中的數量)
+        self._waiters: Dict[str, Tuple[threading.Event, int]] = {}
+        self._waiters_lock = threading.Lock()
+
+    @abstractmethod
+    def put(self, request_id: str, result: dict, deliver_at: Optional[float] = None):
+        """寫入結果，deliver_at 之前 pop 不會取出"""
+
+    @abstractmethod
+    def pop(self, request_id: str) -> Optional[dict]:
+        """取走可以送出的結果，沒有的話回傳 None"""
+
+    @abstractmethod
+    def deliver_at(self, request_id: str) -> Optional[float]:
+        """結果已寫入但還不能送出時回傳可以送出的時間，否則回傳 None"""
+
+    def wait_pop(self, request_id: str, timeout: float) -> Optional[dict]:
+        """取走結果，還沒完成時最多等待 timeout 秒"""
+        deadline = time.time() + timeout
+        with self._waiters_lock:
+            event, count = self._waiters.get(request_id, (threading.Event(), 0))
+            self._waiters[request_id] = (event, count + 1)
+        try:
+            while True:
+                result = self.pop(request_id)
+                remaining = deadline - time.time()
+                if result is not None or remaining <= 0:
+                    return result
+                deliver_at = self.deliver_at(request_id)
+                if deliver_at is not None:
+                    # 問候語已經寫入，只需要等到送出時間
+                    time.sleep(min(max(deliver_at - time.time(), 0), remaining))
+                else:
+                    event.wait(remaining)
+                    event.clear()
+        finally:
+            with self._waiters_lock:
+                event, count = self._waiters[request_id]
+                if count > 1:
+                    self._waiters[request_id] = (event, count - 1)
+                else:
+                    del self._waiters[request_id]
+
+    def _notify(self, request_id: str):
+        with self._waiters_lock:
+            waiter = self._waiters.get(request_id)
+        if waiter is not None:
+            waiter[0].set()
+
+    @abstractmethod
+    def expire(self):
+        """清掉已過期的結果，由 model server 定期呼叫"""
+
+    @abstractmethod
+    def stats(self) -> dict:
+        """給 /finetune/metrics 的統計"""
+
+
+class MemoryResultStore(ResultStore):
+    """process 內的 dict + 到期時間的 heap，model server 預設使用"""
+
+    def __init__(self, ttl: float = 3600, max_bytes: int = 64 << 20):
+        super().__init__(ttl, max_bytes)
+        # request_id -> (結果, 序列化後的大小, 到期時間, 最早送出時間)
+        self._entries: Dict[str, Tuple[dict, int, float, float]] = {}
+        # (到期時間, request_id)，pop 之後留在 heap 的舊項目在清理時略過
+        self._expiry: List[Tuple[float, str]] = []
+        self._used_bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, request_id: str, result: dict, deliver_at: Optional[float] = None):
+        now = time.time()
+        nbytes = len(json.dumps(result, ensure_ascii=False).encode("utf-8"))
+        expires_at = now + self.ttl
+        with self._lock:
+            self._remove(request_id)
+            self._entries[request_id] = (result, nbytes, expires_at, deliver_at or now)
+            self._used_bytes += nbytes
+            heapq.heappush(self._expiry, (expires_at, request_id))
+            self._expire_locked(now)
+            while self._used_bytes > self.max_bytes and self._pop_oldest():
+                self.evicted += 1
+        self._notify(request_id)
+
+    def pop(self, request_id: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(request_id)
+            if entry is None or time.time() < entry[3]:
+                return None
+            self._remove(request_id)
+            return entry[0]
+
+    def deliver_at(self, request_id: str) -> Optional[float]:
+        with self._lock:
+            entry = self._entries.get(request_id)
+        if entry is None or entry[3] <= time.time():
+            return None
+        return entry[3]
+
+    def expire(self):
+        with self._lock:
+            self._expire_locked(time.time())
+
+    def _expire_locked(self, now: float):
+        # 只刪除 heap 上已到期、而且到期時間與目前記錄相符的結果；
+        # pop 或重新 put 之後留在 heap 的舊項目直接丟掉
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, request_id = heapq.heappop(self._expiry)
+            entry = self._entries.get(request_id)
+            if entry is not None and entry[2] == expires_at:
+                self._remove(request_id)
+                self.expired += 1
+
+    def _pop_oldest(self) -> bool:
+        """超過 max_bytes 時移除最早到期、還在的結果，回傳是否真的刪掉一筆"""
+        while self._expiry:
+            expires_at, request_id = heapq.heappop(self._expiry)
+            entry = self._entries.get(request_id)
+            if entry is not None and entry[2] == expires_at:
+                self._remove(request_id)
+                return True
+        return False
+
+    def _remove(self, request_id: str):
+        entry = self._entries.pop(request_id, None)
+        if entry is not None:
+            self._used_bytes -= entry[1]
+        # heap 太多已經被取走的舊項目時重建
+        if len(self._expiry) > 2 * len(self._entries) + 64:
+            self._expiry = [
+                (entry[2], key) for key, entry in self._entries.items()
+            ]
+            heapq.heapify(self._expiry)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": "memory",
+                "entries": len(self._entries),
+                "used_bytes": self._used_bytes,
+                "max_bytes": self.max_bytes,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+
+class SQLiteResultStore(ResultStore):
+    """
+    存在 SQLite 檔案的結果，model server 重啟後還拿得到，
+    也可以讓多個 process 共用同一個檔案。
+    """
+
+    def __init__(self, path: str, ttl: float = 3600, max_bytes: int = 64 << 20):
+        super().__init__(ttl, max_bytes)
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS chat_results (
+                    request_id TEXT PRIMARY KEY,
+                    result TEXT NOT NULL,
+                    nbytes INTEGER NOT NULL,
+                    expires_at REAL NOT NULL,
+                    deliver_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS chat_results_expires_at "
+                "ON chat_results (expires_at)"
+            )
+            # 目前的總大小，put / pop / 淘汰時增減，不必每次寫入都 SUM 整張表
+            self._used_bytes = self._sum_bytes()
+
+    def put(self, request_id: str, result: dict, deliver_at: Optional[float] = None):
+        now = time.time()
+        data = json.dumps(result, ensure_ascii=False)
+        nbytes = len(data.encode("utf-8"))
+        with self._lock, self._conn:
+            replaced = self._conn.execute(
+                "SELECT nbytes FROM chat_results WHERE request_id = ?", (request_id,)
+            ).fetchone()
+            if replaced is not None:
+                self._used_bytes -= replaced[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chat_results VALUES (?, ?, ?, ?, ?)",
+                (request_id, data, nbytes, now + self.ttl, deliver_at or now),
+            )
+            self._used_bytes += nbytes
+            self._expire_locked(now)
+            while self._used_bytes > self.max_bytes:
+                row = self._conn.execute(
+                    "SELECT request_id, nbytes FROM chat_results "
+                    "ORDER BY expires_at LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    break
+                self._conn.execute(
+                    "DELETE FROM chat_results WHERE request_id = ?", (row[0],)
+                )
+                self._used_bytes -= row[1]
+                self.evicted += 1
+        self._notify(request_id)
+
+    def pop(self, request_id: str) -> Optional[dict]:
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT result, nbytes FROM chat_results "
+                "WHERE request_id = ? AND deliver_at <= ? AND expires_at > ?",
+                (request_id, time.time(), time.time()),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "DELETE FROM chat_results WHERE request_id = ?", (request_id,)
+            )
+            self._used_bytes -= row[1]
+            return json.loads(row[0])
+
+    def deliver_at(self, request_id: str) -> Optional[float]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT deliver_at FROM chat_results WHERE request_id = ?",
+                (request_id,),
+            ).fetchone()
+        if row is None or row[0] <= time.time():
+            return None
+        return row[0]
+
+    def expire(self):
+        with self._lock, self._conn:
+            self._expire_locked(time.time())
+            # 共用同一個檔案的其他 process 也會寫入，定期清理時重新對齊一次總大小
+            self._used_bytes = self._sum_bytes()
+
+    def _expire_locked(self, now: float):
+        # 以 expires_at 的索引只讀到過期的部分
+        expired_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(nbytes), 0) FROM chat_results WHERE expires_at <= ?",
+            (now,),
+        ).fetchone()[0]
+        cursor = self._conn.execute(
+            "DELETE FROM chat_results WHERE expires_at <= ?", (now,)
+        )
+        self._used_bytes -= expired_bytes
+        self.expired += cursor.rowcount
+
+    def _sum_bytes(self) -> int:
+        return self._conn.execute(
+            "SELECT COALESCE(SUM(nbytes), 0) FROM chat_results"
+        ).fetchone()[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute(
+                "SELECT COUNT(*) FROM chat_results"
+            ).fetchone()[0]
+            return {
+                "backend": "sqlite",
+                "entries": entries,
+                "used_bytes": self._used_bytes,
+                "max_bytes": self.max_bytes,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+
+def create_result_store() -> ResultStore:
+    """依 RESULT_STORE_BACKEND（memory / sqlite）建立 result store"""
+    ttl = float(os.getenv("RESULT_TTL", 3600))
+    max_bytes = int(os.getenv("RESULT_STORE_MAX_BYTES", 64 << 20))
+    backend = os.getenv("RESULT_STORE_BACKEND", "memory").lower()
+    if backend == "sqlite":
+        path = os.getenv("RESULT_STORE_PATH", "chat_results.db")
+        print(f"[INFO] Using SQLite result store at {path}")
+        return SQLiteResultStore(path, ttl=ttl, max_bytes=max_bytes)
+    return MemoryResultStore(ttl=ttl, max_bytes=max_bytes)
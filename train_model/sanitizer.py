@@ -0,0 +1,92 @@
+import re
+
+# 模型常生成的角色標記與雜訊，依序逐一移除（順序會影響結果，不能任意調換）
+tags_to_remove = [
+    "ANTER",
+    "問：",
+    "問題：",
+    "入題",
+    "回答：",
+    "答：",
+    "問題：",
+    "入題",
+    "回答：",
+    "[入戲]",
+    "ANCES",
+    "ANS",
+    "ANSE",
+    "ANSION",
+    "ANTS",
+    "[檔案]",
+    "<<SYS>>",
+    "INSTP",
+    "[/INST]",
+    "INST",
+    "[You]",
+    "[User]",
+    "User",
+    "[Assistant]",
+    "Assistant",
+    "\\n:",
+    "\\",
+    ":",
+    "[你]",
+    "[我]",
+    "[輸入]",
+    "ERM [/D]",
+    "ANCE ",
+    "S]",
+    "\\",
+    "/",
+    "(null)",
+    "null",
+    "[貼文]",
+    "[照片]",
+]
+
+# 任何標記都沒有出現時，逐一 replace 不會改變任何東西，可以直接跳過
+_tag_pattern = re.compile(
+    "|".join(re.escape(tag) for tag in dict.fromkeys(tags_to_remove))
+)
+
+
+def limit_stickers(text: str) -> str:
+    max_stickers = 2
+    sticker_tokens = text.split("[貼圖]")
+    if len(sticker_tokens) > max_stickers:
+        text = "[貼圖]".join(sticker_tokens[:max_stickers]) + sticker_tokens[max_stickers]
+
+    return text
+
+
+def remove_tags(text: str) -> str:
+    """
+    依 tags_to_remove 的順序逐一移除並 strip，輸出與過去的 replace 串接完全相同。
+
+    不能一次用單一 regex 取代：移除一個標記可能讓前後的字接成另一個標記
+    （"UsANSer" 移除 "ANS" 後變成 "User"），排在後面的標記會再被移除；
+    反過來排在前面的標記已經處理過，之後才接出來的不會被移除。
+    大部分回覆不含任何標記，先用一次 regex 搜尋跳過整串 replace。
+    """
+    text = text.strip()
+    if _tag_pattern.search(text) is None:
+        return text
+    for tag in tags_to_remove:
+        if tag in text:
+            text = text.replace(tag, "").strip()
+    return text
+
+
+def sanitize_response(generated_text: str, input_text: str) -> str:
+    """移除模型生成內容中的角色標記與雜訊"""
+    generated_text = limit_stickers(generated_text.strip())
+
+    if "Assistant:" in generated_text:
+        generated_text = generated_text.split("Assistant:")[-1].strip()
+
+    generated_text = remove_tags(generated_text)
+
+    if input_text in generated_text:
+        generated_text = generated_text.replace(input_text, "").strip()
+
+    return " ".join(line for line in generated_text.splitlines() if line.strip())
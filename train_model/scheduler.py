@@ -0,0 +1,527 @@
+import queue
+import time
+from typing import Callable, Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import (
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from train_model.inference import (
+    adapter_context,
+    build_prompt_parts,
+    cache_key_for,
+    choose_num_return_sequences,
+    free_memory,
+    load_model_for_user,
+    max_new_tokens,
+    pin_model,
+    prefix_cache,
+    temperature,
+    top_k,
+    top_p,
+    unpin_model,
+)
+from train_model.greetings import is_greeting
+from train_model.post_edit import PostEditStage, post_edit_stage
+from train_model.prompt_builder import clip_input_ids
+from train_model.sanitizer import sanitize_response
+from train_model.stopping import find_stop, stop_stats, truncate_at_stop
+from train_model.tracing import Trace, use_trace
+
+
+class ChatRequest:
+    """一筆排隊中的聊天請求"""
+
+    def __init__(
+        self,
+        request_id: str,
+        model_dir: str,
+        modelname: str,
+        input_text: str,
+        user_id: str,
+        session_history: List[dict],
+        priority: str = "interactive",
+    ):
+        self.request_id = request_id
+        self.model_dir = model_dir
+        self.modelname = modelname
+        self.input_text = input_text
+        self.user_id = user_id
+        self.session_history = session_history
+        # FairQueue 的優先等級：interactive（聊天）或 batch（批次評估）
+        self.priority = priority
+        self.num_return_sequences = choose_num_return_sequences()
+        self.attempt = 0
+        self.chat: List[str] = []
+        # chat 的前幾行是固定的 few-shot 區塊，可以重用它的 KV cache
+        self.prefix: List[str] = []
+        self.tokenizer = None
+        # 串流請求會帶一個 ChatStreamer，每 sample 一個 token 就推送一次
+        self.streamer = None
+        self.pinned = False
+        self.unfinished = 0
+        self.token_ids: Dict[int, List[int]] = {}
+        self.enqueued_at = time.time()
+        self.dequeued_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # 各階段的耗時，完成時隨結果送回 model server
+        self.decode_started_at = 0.0
+        self.trace = Trace(request_id)
+
+
+class _Sequence:
+    """running batch 中的一列，num_return_sequences=2 的請求會佔兩列"""
+
+    def __init__(self, request: ChatRequest, index: int):
+        self.request = request
+        self.index = index
+        self.token_ids: List[int] = []
+        self.finished = False
+        # 因為停止標記而提早結束（而不是 EOS 或 max_new_tokens）
+        self.stopped = False
+
+
+class _RunningBatch:
+    """同一個模型 / adapter 正在 decode 的序列與它們的 KV cache"""
+
+    def __init__(self, model, tokenizer, adapter_name: Optional[str]):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.adapter_name = adapter_name
+        self.sequences: List[_Sequence] = []
+        # 每層一組 (key, value)，shape 為 [batch, heads, kv_len, head_dim]
+        self.past_key_values = None
+        # [batch, kv_len]，左邊補 0 對齊不同長度的 prompt
+        self.attention_mask = None
+        # [batch]，已經 sample 出來但還沒送進模型的 token
+        self.next_tokens = None
+
+
+def _to_legacy_cache(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def _left_pad_kv(tensor: torch.Tensor, length: int) -> torch.Tensor:
+    return F.pad(tensor, (0, 0, length - tensor.shape[2], 0))
+
+
+def _left_pad_mask(mask: torch.Tensor, length: int) -> torch.Tensor:
+    return F.pad(mask, (length - mask.shape[1], 0), value=0)
+
+
+class BatchScheduler:
+    """
+    Continuous batching：把排隊中的聊天請求合併成同一批 decode。
+
+    每一輪迴圈會先在 decode step 之間收進新的請求（個別做 prefill 後把 KV cache
+    左補齊併入 running batch），接著每個 running batch 前進一個 token，
+    已經結束（EOS 或達到 max_new_tokens）的序列會馬上移出 batch。
+
+    PEFT 0.9 無法在同一次 forward 混用不同的 adapter，所以不同 adapter 的請求
+    各自組成一個 running batch，每一輪輪流前進一步。
+
+    生成完成後只在這裡做標記清理，GPT 修正交給 post_edit（PostEditStage）在其他
+    執行緒完成後才回呼 on_complete；post_edit 為 None 時直接回傳清理後的結果。
+    """
+
+    def __init__(
+        self,
+        request_queue: "queue.Queue[ChatRequest]",
+        on_complete: Callable,
+        max_batch_size: int = 8,
+        load_model: Callable = load_model_for_user,
+        prepare: Callable = build_prompt_parts,
+        sanitize: Callable = sanitize_response,
+        post_edit: Optional[PostEditStage] = post_edit_stage,
+        max_retries: int = 3,
+    ):
+        self.request_queue = request_queue
+        self.on_complete = on_complete
+        self.max_batch_size = max_batch_size
+        self.load_model = load_model
+        self.prepare = prepare
+        self.sanitize = sanitize
+        self.post_edit = post_edit
+        self.max_retries = max_retries
+        self.batches: Dict[tuple, _RunningBatch] = {}
+        self.retry_requests: List[ChatRequest] = []
+        self.logits_warper = LogitsProcessorList(
+            [
+                TemperatureLogitsWarper(temperature),
+                TopKLogitsWarper(top_k),
+                TopPLogitsWarper(top_p),
+            ]
+        )
+
+    def run(self, stop_when_idle: bool = False):
+        while True:
+            has_work = self.step(block=not stop_when_idle)
+            if stop_when_idle and not has_work:
+                return
+
+    def active_rows(self) -> int:
+        return sum(len(batch.sequences) for batch in self.batches.values())
+
+    def step(self, block: bool = True) -> bool:
+        """收新請求並讓每個 running batch 前進一個 token，回傳是否還有工作"""
+        self._admit(block=block and self.active_rows() == 0)
+
+        for key, batch in list(self.batches.items()):
+            try:
+                self._decode(batch)
+            except (torch.cuda.OutOfMemoryError, MemoryError):
+                print("[ERROR] Out of Memory during decode. Dropping batch...")
+                self._fail_batch(key, batch, "Out of memory")
+                free_memory()
+            except Exception as e:
+                print(f"[ERROR] Decode step failed: {e}")
+                self._fail_batch(key, batch, str(e))
+
+        return (
+            self.active_rows() > 0
+            or bool(self.retry_requests)
+            or not self.request_queue.empty()
+        )
+
+    def _next_request(self, block: bool) -> Optional[ChatRequest]:
+        if self.retry_requests:
+            return self.retry_requests.pop(0)
+        try:
+            return self.request_queue.get(block=block)
+        except queue.Empty:
+            return None
+
+    def _admit(self, block: bool):
+        while self.active_rows() < self.max_batch_size:
+            request = self._next_request(block)
+            if request is None:
+                return
+            block = False
+
+            # 問候語通常在進入排程前就已回覆，這裡只是保險，不再 sleep 佔用 worker
+            if is_greeting(request.input_text):
+                self._complete(request, [request.input_text])
+                continue
+
+            if request.dequeued_at is None:
+                request.dequeued_at = time.time()
+                request.trace.add(
+                    "worker_queue", request.dequeued_at - request.enqueued_at
+                )
+            try:
+                with use_trace(request.trace):
+                    self._prefill(request)
+            except (torch.cuda.OutOfMemoryError, MemoryError):
+                print(f"[ERROR] Out of Memory during prefill of {request.request_id}")
+                self._release(request)
+                free_memory()
+                self._complete(request, None, "Out of memory")
+            except Exception as e:
+                print(f"[ERROR] Prefill of {request.request_id} failed: {e}")
+                self._release(request)
+                self._complete(request, None, str(e))
+
+    def _prefill(self, request: ChatRequest):
+        model, tokenizer, adapter_name = self.load_model(
+            request.model_dir, request.user_id
+        )
+        # decode 期間不能讓快取把這個 adapter 卸載
+        pin_model(request.model_dir)
+        request.pinned = True
+        if not request.chat:
+            request.prefix, suffix = self.prepare(
+                request.input_text, request.user_id, request.session_history, tokenizer
+            )
+            request.chat = request.prefix + suffix
+        request.tokenizer = tokenizer
+
+        with request.trace.span("tokenize"):
+            prefix_ids, input_ids = self._tokenize(request, tokenizer)
+        position_ids = torch.arange(
+            len(prefix_ids), len(input_ids), device=model.device
+        ).unsqueeze(0)
+
+        n = request.num_return_sequences
+        with torch.no_grad(), adapter_context(model, adapter_name), request.trace.span(
+            "prefill", prompt_tokens=len(input_ids), reused_tokens=len(prefix_ids)
+        ):
+            past_key_values = None
+            if prefix_ids:
+                past_key_values = self._prefix_past_key_values(
+                    model, request, prefix_ids
+                )
+            outputs = model(
+                input_ids=torch.tensor(
+                    [input_ids[len(prefix_ids) :]], device=model.device
+                ),
+                attention_mask=torch.ones(
+                    1, len(input_ids), dtype=torch.long, device=model.device
+                ),
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+        prefix_cache.record(len(input_ids), len(prefix_ids))
+
+        past_key_values = tuple(
+            (key.repeat(n, 1, 1, 1), value.repeat(n, 1, 1, 1))
+            for key, value in _to_legacy_cache(outputs.past_key_values)
+        )
+        attention_mask = torch.ones(
+            n, len(input_ids), dtype=torch.long, device=model.device
+        )
+        next_tokens = self._sample(outputs.logits[:, -1, :].repeat(n, 1))
+
+        sequences = [_Sequence(request, i) for i in range(n)]
+        request.unfinished = n
+        request.token_ids = {}
+        request.decode_started_at = time.perf_counter()
+
+        batch_key = (id(model), adapter_name)
+        batch = self.batches.get(batch_key)
+        if batch is None:
+            batch = _RunningBatch(model, tokenizer, adapter_name)
+            self.batches[batch_key] = batch
+        self._merge(batch, sequences, past_key_values, attention_mask, next_tokens)
+        self._record(batch, sequences, next_tokens)
+        self._retire(batch_key, batch)
+
+    def _tokenize(self, request: ChatRequest, tokenizer):
+        """
+        回傳 (prefix_ids, input_ids)。
+
+        整段 prompt 一次 tokenize，與訓練時及沒有前綴的請求完全相同；
+        前綴另外 tokenize 只用來找出可以重用 KV cache 的長度，
+        兩者的開頭對不上（例如 tokenizer 在邊界合併了字元）就不重用。
+        prefix_ids 為空代表這次不重用前綴（沒有 few-shot，或超過預算被截斷）。
+        """
+        input_ids = clip_input_ids(tokenizer("\n".join(request.chat))["input_ids"])
+        prefix_ids = []
+        if request.prefix:
+            prefix_ids = tokenizer("\n".join(request.prefix) + "\n")["input_ids"]
+            if len(prefix_ids) >= len(input_ids) or (
+                input_ids[: len(prefix_ids)] != prefix_ids
+            ):
+                prefix_ids = []
+        return prefix_ids, input_ids
+
+    def _prefix_past_key_values(self, model, request: ChatRequest, prefix_ids):
+        key = (cache_key_for(request.model_dir), tuple(prefix_ids))
+        past_key_values = prefix_cache.get(key)
+        if past_key_values is None:
+            outputs = model(
+                input_ids=torch.tensor([prefix_ids], device=model.device),
+                use_cache=True,
+            )
+            past_key_values = _to_legacy_cache(outputs.past_key_values)
+            prefix_cache.put(key, past_key_values)
+        return past_key_values
+
+    def _merge(
+        self,
+        batch: _RunningBatch,
+        sequences: List[_Sequence],
+        past_key_values,
+        attention_mask: torch.Tensor,
+        next_tokens: torch.Tensor,
+    ):
+        if batch.past_key_values is None:
+            batch.past_key_values = past_key_values
+            batch.attention_mask = attention_mask
+            batch.next_tokens = next_tokens
+            batch.sequences = list(sequences)
+            return
+
+        length = max(batch.attention_mask.shape[1], attention_mask.shape[1])
+        batch.past_key_values = tuple(
+            (
+                torch.cat([_left_pad_kv(old_k, length), _left_pad_kv(new_k, length)]),
+                torch.cat([_left_pad_kv(old_v, length), _left_pad_kv(new_v, length)]),
+            )
+            for (old_k, old_v), (new_k, new_v) in zip(
+                batch.past_key_values, past_key_values
+            )
+        )
+        batch.attention_mask = torch.cat(
+            [
+                _left_pad_mask(batch.attention_mask, length),
+                _left_pad_mask(attention_mask, length),
+            ]
+        )
+        batch.next_tokens = torch.cat([batch.next_tokens, next_tokens])
+        batch.sequences.extend(sequences)
+
+    def _decode(self, batch: _RunningBatch):
+        attention_mask = F.pad(batch.attention_mask, (0, 1), value=1)
+        position_ids = attention_mask.sum(dim=-1, keepdim=True) - 1
+
+        with torch.no_grad(), adapter_context(batch.model, batch.adapter_name):
+            outputs = batch.model(
+                input_ids=batch.next_tokens.unsqueeze(-1),
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=batch.past_key_values,
+                use_cache=True,
+            )
+        batch.past_key_values = _to_legacy_cache(outputs.past_key_values)
+        batch.attention_mask = attention_mask
+        batch.next_tokens = self._sample(outputs.logits[:, -1, :])
+
+        self._record(batch, batch.sequences, batch.next_tokens)
+        self._retire((id(batch.model), batch.adapter_name), batch)
+
+    def _sample(self, logits: torch.Tensor) -> torch.Tensor:
+        scores = self.logits_warper(None, logits.float())
+        probs = torch.softmax(scores, dim=-1)
+        return torch.multinomial(probs, num_samples=1).squeeze(-1)
+
+    def _record(
+        self,
+        batch: _RunningBatch,
+        sequences: List[_Sequence],
+        tokens: torch.Tensor,
+    ):
+        eos_token_id = batch.tokenizer.eos_token_id
+        now = time.time()
+        for sequence, token in zip(sequences, tokens.tolist()):
+            request = sequence.request
+            if request.first_token_at is None:
+                request.first_token_at = now
+            if token == eos_token_id:
+                sequence.finished = True
+            else:
+                sequence.token_ids.append(token)
+                text = batch.tokenizer.decode(
+                    sequence.token_ids, skip_special_tokens=True
+                )
+                # 每一列各自判斷，遇到停止標記的序列先退出 batch，其他序列繼續 decode
+                sequence.stopped = find_stop(text) is not None
+                sequence.finished = (
+                    sequence.stopped or len(sequence.token_ids) >= max_new_tokens
+                )
+                if request.streamer is not None:
+                    request.streamer.put(
+                        sequence.index, batch.tokenizer, sequence.token_ids
+                    )
+
+    def _retire(self, batch_key: tuple, batch: _RunningBatch):
+        """把已完成的序列移出 batch，讓空出來的位置可以收新的請求"""
+        keep = [i for i, sequence in enumerate(batch.sequences) if not sequence.finished]
+        for sequence in batch.sequences:
+            if sequence.finished:
+                self._finish_sequence(sequence)
+
+        if not keep:
+            del self.batches[batch_key]
+            return
+        if len(keep) == len(batch.sequences):
+            return
+
+        index = torch.tensor(keep, device=batch.attention_mask.device)
+        attention_mask = batch.attention_mask.index_select(0, index)
+        # 移除所有列都是 padding 的最左邊欄位，避免 KV cache 只增不減
+        start = int((attention_mask.sum(dim=0) > 0).nonzero()[0])
+        batch.attention_mask = attention_mask[:, start:]
+        batch.past_key_values = tuple(
+            (
+                key.index_select(0, index)[:, :, start:],
+                value.index_select(0, index)[:, :, start:],
+            )
+            for key, value in batch.past_key_values
+        )
+        batch.next_tokens = batch.next_tokens.index_select(0, index)
+        batch.sequences = [batch.sequences[i] for i in keep]
+
+    def _finish_sequence(self, sequence: _Sequence):
+        request = sequence.request
+        stop_stats.record(len(sequence.token_ids), max_new_tokens, sequence.stopped)
+        request.token_ids[sequence.index] = sequence.token_ids
+        request.unfinished -= 1
+        if request.unfinished > 0:
+            return
+
+        # 與同一批的其他序列一起 decode，包含等待其他 batch 輪流前進的時間
+        request.trace.add(
+            "generate",
+            time.perf_counter() - request.decode_started_at,
+            tokens=sum(len(token_ids) for token_ids in request.token_ids.values()),
+        )
+        with request.trace.span("sanitize"):
+            responses = [
+                self.sanitize(
+                    truncate_at_stop(
+                        request.tokenizer.decode(
+                            request.token_ids[index], skip_special_tokens=True
+                        )
+                    ),
+                    request.input_text,
+                )
+                for index in sorted(request.token_ids)
+            ]
+        # 已經不在 decode 了，在 GPU 執行緒就先解除 pin（解除時可能觸發 adapter 卸載）
+        self._release(request)
+
+        if any(responses):
+            self._post_edit(request, responses)
+        elif request.attempt + 1 < self.max_retries:
+            print(f"[WARN] Attempt {request.attempt + 1}: Empty response. Retrying...")
+            request.attempt += 1
+            if request.streamer is not None:
+                request.streamer.reset(request.attempt)
+            request.num_return_sequences = choose_num_return_sequences()
+            self.retry_requests.append(request)
+        else:
+            print("[ERROR] All inference attempts failed or returned empty responses.")
+            self._complete(request, None, "Inference failed")
+
+    def _post_edit(self, request: ChatRequest, responses: List[str]):
+        if self.post_edit is None:
+            self._complete(request, responses)
+            return
+        start = time.perf_counter()
+
+        def callback(edited: List[str]):
+            request.trace.add("post_edit", time.perf_counter() - start)
+            self._complete(request, edited)
+
+        self.post_edit.submit(
+            request.input_text,
+            responses,
+            request.modelname,
+            request.chat,
+            request.session_history,
+            callback=callback,
+        )
+
+    def _fail_batch(self, batch_key: tuple, batch: _RunningBatch, message: str):
+        self.batches.pop(batch_key, None)
+        failed = {id(sequence.request): sequence.request for sequence in batch.sequences}
+        for request in failed.values():
+            self._release(request)
+            self._complete(request, None, message)
+
+    def _complete(
+        self,
+        request: ChatRequest,
+        responses: Optional[List[str]],
+        error: Optional[str] = None,
+    ):
+        # 可能在 post-edit 的執行緒被呼叫，這裡不能碰模型或模型快取
+        request.finished_at = time.time()
+        try:
+            self.on_complete(request, responses, error)
+        finally:
+            self.request_queue.task_done()
+
+    def _release(self, request: ChatRequest):
+        if request.pinned:
+            unpin_model(request.model_dir)
+            request.pinned = False
@@ -0,0 +1,80 @@
+import os
+import threading
+from typing import List, Optional
+
+# 模型開始下一輪對話或輸出 prompt 標記時就停止 decode，後面的內容清理時也會被丟掉
+stop_sequences = [
+    "User:",
+    "Assistant:",
+    "[User]",
+    "[Assistant]",
+    "[You]",
+    "[INST]",
+    "[/INST]",
+    "<<SYS>>",
+    "問：",
+    "問題：",
+]
+# 換行通常代表模型開始編下一句對話，STOP_ON_NEWLINE=false 時保留多行回覆
+if os.getenv("STOP_ON_NEWLINE", "true").lower() == "true":
+    stop_sequences.append("\n")
+
+
+def find_stop(text: str, stops: List[str] = stop_sequences) -> Optional[int]:
+    """
+    回傳最早出現的停止標記位置；標記前面還沒有任何文字時不算，
+    避免模型一開頭先輸出換行或 "Assistant:" 就被當成空回答。
+    """
+    earliest = None
+    for stop in stops:
+        start = 0
+        while True:
+            index = text.find(stop, start)
+            if index < 0:
+                break
+            if text[:index].strip():
+                if earliest is None or index < earliest:
+                    earliest = index
+                break
+            start = index + 1
+    return earliest
+
+
+def truncate_at_stop(text: str) -> str:
+    index = find_stop(text)
+    return text if index is None else text[:index]
+
+
+class StopStats:
+    """統計停止標記省下多少 decode token（相對於每次都生成到 max_new_tokens）"""
+
+    def __init__(self):
+        self.replies = 0
+        self.stopped = 0
+        self.tokens_generated = 0
+        self.tokens_saved = 0
+        self._lock = threading.Lock()
+
+    def record(self, generated: int, max_new_tokens: int, stopped: bool):
+        with self._lock:
+            self.replies += 1
+            self.tokens_generated += generated
+            if stopped:
+                self.stopped += 1
+                self.tokens_saved += max(max_new_tokens - generated, 0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "replies": self.replies,
+                "stopped_early": self.stopped,
+                "tokens_generated": self.tokens_generated,
+                "tokens_saved": self.tokens_saved,
+                "tokens_saved_per_reply": (
+                    self.tokens_saved / self.replies if self.replies else 0.0
+                ),
+            }
+
+
+stop_stats = StopStats()
+
@@ -0,0 +1,46 @@
+import queue
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+class ChatStreamer:
+    """
+    接收 scheduler 每一步 sample 出來的 token，轉成文字片段給 SSE endpoint 讀取。
+
+    事件依序為：
+    - ("token", {"index": 第幾個回答, "text": 新增的文字})
+    - ("retry", {"attempt": 第幾次重試})：回答為空、重新生成，先前的 token 作廢
+    - ("done", 與 /chat-result 相同格式的最終結果)
+    """
+
+    def __init__(self, timeout: Optional[float] = 300):
+        self.timeout = timeout
+        self.events: "queue.Queue[Tuple[str, dict]]" = queue.Queue()
+        self._printed: Dict[int, int] = {}
+
+    def put(self, index: int, tokenizer, token_ids: List[int]):
+        text = tokenizer.decode(token_ids, skip_special_tokens=True)
+        # 中文字可能被拆成多個 token，還沒湊成完整字元前先不輸出
+        if text.endswith("�"):
+            return
+        printed = self._printed.get(index, 0)
+        if len(text) > printed:
+            self.events.put(("token", {"index": index, "text": text[printed:]}))
+            self._printed[index] = len(text)
+
+    def reset(self, attempt: int):
+        self._printed = {}
+        self.events.put(("retry", {"attempt": attempt}))
+
+    def end(self, result: dict):
+        self.events.put(("done", result))
+
+    def __iter__(self) -> Iterator[Tuple[str, dict]]:
+        while True:
+            try:
+                event, data = self.events.get(timeout=self.timeout)
+            except queue.Empty:
+                yield "done", {"status": "error", "message": "Inference timed out"}
+                return
+            yield event, data
+            if event == "done":
+                return
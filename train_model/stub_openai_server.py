@@ -0,0 +1,82 @@
+"""
+本機的 OpenAI Chat Completions 替身伺服器，用來測試 GPT 修正階段的並行、逾時與快取。
+
+    python -m train_model.stub_openai_server --port 8765 --delay 2
+    OPENAI_API_BASE=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub python main.py
+
+回傳的內容是 prompt 中 "Output:" 後面那一段（也就是模型的原始輸出）加上前綴，
+--delay 可模擬遠端延遲，超過 POST_EDIT_TIMEOUT 時應該直接拿到原始輸出；
+--status 500 等可模擬 API 錯誤。
+"""
+
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+    prefix = "[edited] "
+    status = 200
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        prompt = body.get("messages", [{}])[-1].get("content", "")
+        raw_output = prompt.split("Output: ")[-1].split("\n")[0]
+
+        time.sleep(self.delay)
+        if self.status != 200:
+            self.send_error(self.status)
+            return
+
+        payload = {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": self.prefix + raw_output,
+                    },
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        print(f"[INFO] stub openai: {format % args}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--status", type=int, default=200)
+    args = parser.parse_args()
+
+    StubOpenAIHandler.delay = args.delay
+    StubOpenAIHandler.status = args.status
+    server = ThreadingHTTPServer((args.host, args.port), StubOpenAIHandler)
+    print(f"[INFO] Stub OpenAI server listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+
+class Trace:
+    """
+    一個聊天請求各階段的耗時（span），例如 load_model、retrieval、generate。
+
+    同一個階段可能出現多次（例如重試時重新 prefill），彙總時分開計算。
+    """
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.spans: List[dict] = []
+
+    def add(self, name: str, seconds: float, **attrs):
+        self.spans.append({"name": name, "seconds": seconds, **attrs})
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """
+        量測 with 區塊的耗時；yield 出來的 dict 可以在區塊內補上屬性（例如 cache_hit）。
+        區塊丟出例外時也會記錄，並標上 error。
+        """
+        start = time.perf_counter()
+        try:
+            yield attrs
+        except BaseException:
+            attrs["error"] = True
+            raise
+        finally:
+            self.add(name, time.perf_counter() - start, **attrs)
+
+    def to_dict(self) -> dict:
+        return {"request_id": self.request_id, "spans": self.spans}
+
+
+_local = threading.local()
+
+
+@contextmanager
+def use_trace(trace: Optional["Trace"]):
+    """在 with 區塊內把 trace 設為這個執行緒目前的 trace，讓深層的函式也能記錄 span"""
+    previous = getattr(_local, "trace", None)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def current_trace() -> Optional[Trace]:
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """記錄到目前執行緒的 trace，沒有 trace 時（例如啟動預熱）什麼都不做"""
+    trace = current_trace()
+    if trace is None:
+        yield attrs
+        return
+    with trace.span(name, **attrs) as span_attrs:
+        yield span_attrs
+
+
+# 秒，由 1ms 到 60s，涵蓋快取命中到第一次載入 base model
+DEFAULT_BUCKETS = [
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    25.0,
+    60.0,
+]
+
+
+class Histogram:
+    """固定 bucket 的耗時分布，百分位數以 bucket 上界估計"""
+
+    def __init__(self, buckets: List[float] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # 最後一格是超過最大 bucket 的數量
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def stats(self) -> dict:
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            # 累計數量：[上界（秒）, 耗時 <= 上界的請求數]
+            "buckets": buckets,
+        }
+
+
+class TraceRecorder:
+    """
+    model server 彙總所有 worker 送回的 trace：
+
+    - 每個階段（以及整個請求的 total）各一個 Histogram。
+    - 保留最近 history 筆完整的 per-request 記錄，可依 request_id 查詢。
+    """
+
+    def __init__(self, history: int = 500):
+        self.history = history
+        self._histograms: Dict[str, Histogram] = {}
+        # request_id -> 記錄，最舊的在最前面
+        self._records: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, record: dict):
+        with self._lock:
+            for span_record in record["spans"]:
+                self._observe(span_record["name"], span_record["seconds"])
+            self._observe("total", record["total_seconds"])
+            self._records[record["request_id"]] = record
+            self._records.move_to_end(record["request_id"])
+            while len(self._records) > self.history:
+                self._records.popitem(last=False)
+
+    def _observe(self, name: str, seconds: float):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def find(self, request_id: str) -> Optional[dict]:
+        with self._lock:
+            return self._records.get(request_id)
+
+    def recent(self, limit: int = 50) -> List[dict]:
+        """最近完成的請求，最新的在最前面"""
+        with self._lock:
+            records = list(self._records.values())
+        return records[::-1][:limit]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {name: h.stats() for name, h in self._histograms.items()}
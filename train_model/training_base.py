@@ -0,0 +1,122 @@
+"""
+訓練用的 4-bit base model 常駐在記憶體，連續的微調工作不必每次重新載入與量化。
+
+每個工作在常駐的 base 上掛一個新的 LoRA adapter，結束後把 adapter 拔掉（unload），
+base 的權重不會被訓練改到，下一個工作可以直接使用。
+同一個 (model_dir, device) 只常駐一份；同時有兩個工作要用時，第二個工作自己載入一份，用完即丟。
+閒置超過 TRAINING_BASE_IDLE_TIMEOUT 秒就釋放，把顯示卡記憶體還給 inference。
+"""
+
+import gc
+import threading
+import time
+from typing import Callable, Dict, Tuple
+
+import torch
+
+
+class ResidentEntry:
+    def __init__(self, model, tokenizer, load_seconds: float):
+        self.model = model
+        self.tokenizer = tokenizer
+        # 第一次載入花的時間，之後沿用時以此估算省下的時間
+        self.load_seconds = load_seconds
+        self.in_use = False
+        self.last_used = time.time()
+
+
+class ResidentBase:
+    def __init__(self, enabled: bool = True, idle_timeout: float = 600):
+        self.enabled = enabled
+        self.idle_timeout = idle_timeout
+        # (model_dir, device) -> ResidentEntry
+        self.entries: Dict[Tuple[str, str], ResidentEntry] = {}
+        self.loads = 0
+        self.reuses = 0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(
+        self, model_dir: str, device: str, load: Callable[[], tuple]
+    ) -> Tuple[object, object, bool]:
+        """
+        回傳 (model, tokenizer, reused)。load 回傳 (model, tokenizer)，
+        只有沒有可用的常駐 base 時才會呼叫；用完一定要呼叫 release。
+        """
+        key = (model_dir, device)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and not entry.in_use:
+                entry.in_use = True
+                self.reuses += 1
+                self.saved_seconds += entry.load_seconds
+                return entry.model, entry.tokenizer, True
+            keep = self.enabled and entry is None
+
+        start = time.time()
+        model, tokenizer = load()
+        load_seconds = time.time() - start
+        with self._lock:
+            self.loads += 1
+            if keep and key not in self.entries:
+                entry = ResidentEntry(model, tokenizer, load_seconds)
+                entry.in_use = True
+                self.entries[key] = entry
+        return model, tokenizer, False
+
+    def release(self, model_dir: str, device: str, model) -> bool:
+        """
+        工作結束後呼叫，model 是已經拔掉 adapter 的 base。
+        回傳 True 表示 base 繼續常駐，False 表示呼叫端要自行釋放。
+        """
+        with self._lock:
+            entry = self.entries.get((model_dir, device))
+            if entry is None or entry.model is not model:
+                return False
+            entry.in_use = False
+            entry.last_used = time.time()
+            return True
+
+    def discard(self, model_dir: str, device: str, model):
+        """adapter 沒辦法乾淨拔掉時丟掉這份 base，下一個工作重新載入"""
+        with self._lock:
+            entry = self.entries.get((model_dir, device))
+            if entry is not None and entry.model is model:
+                del self.entries[(model_dir, device)]
+
+    def release_idle(self) -> int:
+        """釋放閒置太久的 base，回傳釋放的數量"""
+        now = time.time()
+        with self._lock:
+            idle = [
+                key
+                for key, entry in self.entries.items()
+                if not entry.in_use and now - entry.last_used >= self.idle_timeout
+            ]
+            for key in idle:
+                del self.entries[key]
+        if idle:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            for model_dir, device in idle:
+                print(f"[INFO] Released idle training base {model_dir} on {device}")
+        return len(idle)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "resident": [
+                    {
+                        "model_dir": model_dir,
+                        "device": device,
+                        "in_use": entry.in_use,
+                        "load_seconds": round(entry.load_seconds, 1),
+                    }
+                    for (model_dir, device), entry in self.entries.items()
+                ],
+                "loads": self.loads,
+                "reuses": self.reuses,
+                "saved_seconds": round(self.saved_seconds, 1),
+            }
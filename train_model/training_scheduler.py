@@ -0,0 +1,204 @@
+"""
+微調工作的排程：/finetune/train_model 只把工作寫進 training_job 資料表，
+這裡依序取出執行，每個裝置同時最多跑 TRAINING_CONCURRENCY_PER_DEVICE 個工作。
+
+工作記錄在資料庫，process 重啟後還沒開始的工作會繼續排隊；
+執行到一半的工作在 heartbeat 逾時後重新排隊（最多 TRAINING_MAX_ATTEMPTS 次）。
+"""
+
+import gc
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import torch
+
+from extensions import db
+from models.training_job import TrainingJob
+from repository.trainedmodel_repo import TrainedModelRepo
+from repository.trainingfile_repo import TrainingFileRepo
+from repository.trainingjob_repo import TrainingJobRepo
+from train_model.finetune import TrainingCancelled, resident_bases, train
+
+# 多久檢查一次資料表（有新工作時會立刻喚醒）
+POLL_INTERVAL = 5
+# running 的工作超過幾秒沒有 heartbeat 就視為執行它的 process 已經結束
+STALE_AFTER = float(os.getenv("TRAINING_STALE_AFTER", 120))
+# 訓練中每隔幾秒查一次使用者是否取消
+CANCEL_CHECK_INTERVAL = 10
+
+
+def default_training_devices() -> List[str]:
+    """TRAINING_DEVICES 以逗號分隔，例如 "cuda:0,cuda:1"；未設定時使用第一張 GPU 或 CPU"""
+    devices = [
+        name.strip()
+        for name in os.getenv("TRAINING_DEVICES", "").split(",")
+        if name.strip()
+    ]
+    if devices:
+        return devices
+    return ["cuda:0" if torch.cuda.is_available() else "cpu"]
+
+
+class TrainingScheduler:
+    def __init__(
+        self,
+        app,
+        devices: List[str],
+        concurrency_per_device: int = 1,
+        max_attempts: int = 2,
+    ):
+        self.app = app
+        self.devices = devices
+        self.concurrency_per_device = concurrency_per_device
+        self.max_attempts = max_attempts
+        # job_id -> 執行中的裝置
+        self.running: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def notify(self):
+        """有新的工作或工作結束時呼叫，不用等到下一次 poll"""
+        self._wakeup.set()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _free_device(self) -> Optional[str]:
+        with self._lock:
+            for device in self.devices:
+                used = sum(1 for d in self.running.values() if d == device)
+                if used < self.concurrency_per_device:
+                    return device
+        return None
+
+    def _run(self):
+        with self.app.app_context():
+            # 排程可能比第一個 request 更早執行，先確保資料表存在
+            db.create_all()
+            while True:
+                try:
+                    self._poll()
+                except Exception as e:
+                    print(f"[ERROR] Training scheduler failed: {e}")
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+
+    def _poll(self):
+        with self._lock:
+            running_ids = list(self.running)
+        TrainingJobRepo.heartbeat(running_ids)
+        for job in TrainingJobRepo.recover_stale_jobs(STALE_AFTER, self.max_attempts):
+            print(f"[WARN] Training job {job.id} was interrupted, now {job.status}")
+            if job.status != TrainingJob.QUEUED:
+                self._release_training_file(job)
+        resident_bases.release_idle()
+
+        device = self._free_device()
+        while device is not None:
+            job = TrainingJobRepo.claim_next_job(device)
+            if job is None:
+                return
+            with self._lock:
+                self.running[job.id] = device
+            threading.Thread(target=self._execute, args=(job.id,), daemon=True).start()
+            device = self._free_device()
+
+    def _execute(self, job_id: int):
+        with self.app.app_context():
+            job = TrainingJobRepo.find_job_by_id(job_id)
+            print(
+                f"[INFO] Training job {job.id} (model {job.model_id}) "
+                f"started on {job.device}, attempt {job.attempts}"
+            )
+            TrainedModelRepo.start_trainedmodel(
+                user_id=job.user_id, model_id=job.model_id
+            )
+            checked_at = time.time()
+            cancelled = False
+
+            def should_stop() -> bool:
+                # 每個 step 都會呼叫，隔一段時間才查一次資料庫
+                nonlocal checked_at, cancelled
+                if time.time() - checked_at >= CANCEL_CHECK_INTERVAL:
+                    checked_at = time.time()
+                    cancelled = TrainingJobRepo.is_cancel_requested(job.id)
+                return cancelled
+
+            def on_started(startup_seconds: float, base_reused: bool):
+                TrainingJobRepo.record_startup(job.id, startup_seconds, base_reused)
+
+            try:
+                train(
+                    str(job.model_id),
+                    job.training_file_id,
+                    job.base_model_dir,
+                    job.save_dir,
+                    job.data_path,
+                    device=job.device,
+                    should_stop=should_stop,
+                    on_started=on_started,
+                )
+                TrainingJobRepo.finish_job(job.id, TrainingJob.DONE)
+                print(f"[INFO] Training job {job.id} done")
+            except TrainingCancelled:
+                TrainingJobRepo.finish_job(job.id, TrainingJob.CANCELLED)
+                self._release_training_file(job)
+                print(f"[INFO] Training job {job.id} cancelled")
+            except Exception as e:
+                TrainingJobRepo.finish_job(job.id, TrainingJob.FAILED, str(e))
+                self._release_training_file(job)
+                print(f"[ERROR] Training job {job.id} failed: {e}")
+            finally:
+                with self._lock:
+                    self.running.pop(job_id, None)
+                gc.collect()
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                self.notify()
+
+    def _release_training_file(self, job: TrainingJob):
+        """訓練沒有完成，讓使用者可以重新送出"""
+        training_file = TrainingFileRepo.find_training_file_by_id(job.training_file_id)
+        if training_file is not None:
+            training_file.start_train = False
+            TrainingFileRepo.save_training_file()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "devices": self.devices,
+                "concurrency_per_device": self.concurrency_per_device,
+                "running": dict(self.running),
+                "training_base": resident_bases.stats(),
+            }
+
+
+training_scheduler: Optional[TrainingScheduler] = None
+
+
+def start_training_scheduler(app) -> TrainingScheduler:
+    """在 web process 啟動排程；多個 web process 時只需要在其中一個啟動"""
+    global training_scheduler
+    training_scheduler = TrainingScheduler(
+        app,
+        default_training_devices(),
+        concurrency_per_device=int(os.getenv("TRAINING_CONCURRENCY_PER_DEVICE", 1)),
+        max_attempts=int(os.getenv("TRAINING_MAX_ATTEMPTS", 2)),
+    )
+    training_scheduler.start()
+    return training_scheduler
+
+
+def training_scheduler_stats() -> Optional[dict]:
+    """給 /finetune/metrics；這個 process 沒有排程時回傳 None"""
+    if training_scheduler is None:
+        return None
+    return training_scheduler.stats()
+
+
+def notify_training_scheduler():
+    """新的工作寫入資料庫後呼叫；這個 process 沒有排程時由其他 process poll 到"""
+    if training_scheduler is not None:
+        training_scheduler.notify()
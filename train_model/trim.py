@@ -1,13 +1,17 @@
 import openai
 import os
-from typing import List
+from typing import List, Optional
 from dotenv import load_dotenv
 
 
 load_dotenv(override=True)
 openai.api_key = os.getenv("OPENAI_API_KEY")
+# 可以指向本機的替身伺服器做測試，例如 http://127.0.0.1:8765/v1
+if os.getenv("OPENAI_API_BASE"):
+    openai.api_base = os.getenv("OPENAI_API_BASE")
 
-def analyze_and_modify_response(input:str,response: str,name: str,chat_history_context:str,session_history:List[dict]) -> str:
+def analyze_and_modify_response(input:str,response: str,name: str,chat_history_context:str,session_history:List[dict],timeout: Optional[float] = None) -> Optional[str]:
+    """回傳 GPT 修正後的回答；呼叫失敗或逾時回傳 None，由呼叫端決定改用原始輸出"""
     prompt = (
         f"以下是用戶的歷史對話記錄，請模仿該用戶 output 的說話風格進行回應：\n"
         f"{chat_history_context}\n\n"
@@ -38,11 +42,12 @@ def analyze_and_modify_response(input:str,response: str,name: str,chat_history_c
                 {"role": "user", "content": prompt},
             ],
             temperature=0.8,
+            request_timeout=timeout,
         )
 
         return final_response["choices"][0]["message"]["content"]
 
         
     except Exception as e:
-        print(f"Error in inference API")
-        return response
\ No newline at end of file
+        print(f"Error in inference API: {e}")
+        return None
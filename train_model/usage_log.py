@@ -0,0 +1,99 @@
+import json
+import math
+import os
+import threading
+import time
+from typing import Dict, List
+
+
+class UsageLog:
+    """
+    記錄每個模型目錄最近的聊天量，model server 重啟時依此決定要預先載入哪些模型。
+
+    - 分數以 half_life 秒為半衰期遞減，越近的聊天權重越高。
+    - 遞減到 min_score 以下的模型（例如已經刪除、很久沒人聊天）在載入與儲存時移除，
+      檔案不會無限制地變大。
+    - 存成 JSON 檔，save() 以暫存檔加 os.replace 寫入，崩潰時不會留下寫到一半的檔案。
+    """
+
+    def __init__(
+        self, path: str, half_life: float = 24 * 3600, min_score: float = 0.01
+    ):
+        self.path = path
+        self.half_life = half_life
+        self.min_score = min_score
+        # model_dir -> (分數, 更新時間)
+        self._scores: Dict[str, tuple] = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._scores = {
+                model_dir: (entry["score"], entry["updated_at"])
+                for model_dir, entry in data.items()
+            }
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"[WARN] Failed to load usage log {self.path}: {e}")
+        self._prune(time.time())
+
+    def _decayed(self, score: float, updated_at: float, now: float) -> float:
+        return score * math.pow(0.5, max(now - updated_at, 0) / self.half_life)
+
+    def _prune(self, now: float):
+        stale = [
+            model_dir
+            for model_dir, (score, updated_at) in self._scores.items()
+            if self._decayed(score, updated_at, now) < self.min_score
+        ]
+        for model_dir in stale:
+            del self._scores[model_dir]
+        if stale:
+            self._dirty = True
+
+    def record(self, model_dir: str):
+        now = time.time()
+        with self._lock:
+            score, updated_at = self._scores.get(model_dir, (0.0, now))
+            self._scores[model_dir] = (self._decayed(score, updated_at, now) + 1, now)
+            self._dirty = True
+
+    def top(self, k: int) -> List[str]:
+        """最近聊天量最高的 k 個模型目錄（已經不存在的目錄會略過）"""
+        now = time.time()
+        with self._lock:
+            ranked = sorted(
+                self._scores.items(),
+                key=lambda item: self._decayed(item[1][0], item[1][1], now),
+                reverse=True,
+            )
+        return [model_dir for model_dir, _ in ranked if os.path.isdir(model_dir)][:k]
+
+    def save(self):
+        with self._lock:
+            self._prune(time.time())
+            if not self._dirty:
+                return
+            data = {
+                model_dir: {"score": score, "updated_at": updated_at}
+                for model_dir, (score, updated_at) in self._scores.items()
+            }
+            self._dirty = False
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"[WARN] Failed to save usage log {self.path}: {e}")
+            with self._lock:
+                self._dirty = True
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._scores)